@@ -0,0 +1,67 @@
+import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, List
+
+from chunking import COPY_BUFFER_SIZE
+
+# Threads dedicated to file I/O for request handlers, kept apart from the
+# chunking workers so a big upload cannot starve small requests
+IO_WORKERS = int(os.environ.get("IO_WORKERS", "8"))
+
+# Blocks read per trip to the I/O pool when streaming a file
+IO_BATCH_BLOCKS = int(os.environ.get("IO_BATCH_BLOCKS", "4"))
+
+io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io")
+
+
+async def run_io(fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """
+    Run a blocking file operation on the I/O pool and await its result
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(io_executor, lambda: fn(*args, **kwargs))
+
+
+async def exists(path: str) -> bool:
+    return await run_io(os.path.exists, path)
+
+
+def _read_batch(fd: int, offset: int, length: int, block_size: int, blocks: int) -> List[bytes]:
+    """
+    Read up to blocks consecutive blocks in one go (one pool round trip)
+    """
+    batch = []
+    for _ in range(blocks):
+        if length <= 0:
+            break
+        block = os.pread(fd, min(block_size, length), offset)
+        if not block:
+            break
+        batch.append(block)
+        offset += len(block)
+        length -= len(block)
+    return batch
+
+
+async def iter_range(path: str, offset: int, length: int,
+                     block_size: int = COPY_BUFFER_SIZE) -> AsyncIterator[bytes]:
+    """
+    Stream length bytes of path starting at offset in block_size pieces
+
+    Reads are batched IO_BATCH_BLOCKS blocks per trip to the I/O pool, so
+    a 25MB chunk costs a handful of thread hand-offs rather than one per
+    block.
+    """
+    fd = await run_io(os.open, path, os.O_RDONLY)
+    try:
+        while length > 0:
+            batch = await run_io(_read_batch, fd, offset, length, block_size, IO_BATCH_BLOCKS)
+            if not batch:
+                break
+            for block in batch:
+                offset += len(block)
+                length -= len(block)
+                yield block
+    finally:
+        os.close(fd)
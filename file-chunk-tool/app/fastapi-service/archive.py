@@ -0,0 +1,140 @@
+import os
+import time
+import zlib
+import struct
+import tarfile
+from typing import Any, Dict, List, Tuple, Union
+
+from chunking import COPY_BUFFER_SIZE
+
+ARCHIVE_FORMATS = ("tar", "zip")
+
+# An archive is laid out up front as a list of parts, each either literal
+# bytes (headers, padding, directories) or a (path, offset, length) range
+# of a file on disk, so it can be streamed with sendfile and its exact
+# size is known before the first byte is sent
+Part = Union[bytes, Tuple[str, int, int]]
+
+# Member: {"name", "path", "offset", "length", "header", "mtime"} and, for
+# ZIP, "crc32" of the member contents (header included); the member's data
+# is header followed by length bytes of path at offset
+Member = Dict[str, Any]
+
+_ZIP32_LIMIT = 0xFFFFFFFF
+
+
+def crc32_fd(fd: int, offset: int, length: int, header: bytes = b"") -> int:
+    """
+    CRC-32 of header followed by length bytes of fd from offset
+    """
+    crc = zlib.crc32(header)
+    while length > 0:
+        block = os.pread(fd, min(COPY_BUFFER_SIZE, length), offset)
+        if not block:
+            break
+        crc = zlib.crc32(block, crc)
+        offset += len(block)
+        length -= len(block)
+    return crc
+
+
+def _member_parts(member: Member) -> List[Part]:
+    parts: List[Part] = []
+    if member["header"]:
+        parts.append(member["header"])
+    if member["length"]:
+        parts.append((member["path"], member["offset"], member["length"]))
+    return parts
+
+
+def _coalesce(parts: List[Part]) -> List[Part]:
+    # Merge neighbouring byte strings so they go out in one send
+    merged: List[Part] = []
+    for part in parts:
+        if isinstance(part, bytes) and merged and isinstance(merged[-1], bytes):
+            merged[-1] += part
+        elif part != b"":
+            merged.append(part)
+    return merged
+
+
+def tar_parts(members: List[Member]) -> List[Part]:
+    """
+    Lay out a POSIX (pax) tar archive of members
+    """
+    parts: List[Part] = []
+    for member in members:
+        size = len(member["header"]) + member["length"]
+        info = tarfile.TarInfo(member["name"])
+        info.size = size
+        info.mtime = int(member["mtime"])
+        info.mode = 0o644
+        parts.append(info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape"))
+        parts += _member_parts(member)
+        parts.append(b"\0" * (-size % tarfile.BLOCKSIZE))
+    # End-of-archive marker: two empty blocks
+    parts.append(b"\0" * (2 * tarfile.BLOCKSIZE))
+    return _coalesce(parts)
+
+
+def _dos_time(mtime: float) -> Tuple[int, int]:
+    t = time.localtime(max(mtime, 315532800))  # ZIP times start in 1980
+    return (t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2,
+            (t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday)
+
+
+def zip_parts(members: List[Member]) -> List[Part]:
+    """
+    Lay out a ZIP archive of members, stored without compression
+
+    Chunks are compressed audio already, so deflating them would cost CPU
+    for next to no gain and rule out sendfile. ZIP64 records are added
+    for members and archives past 4GB.
+    """
+    parts: List[Part] = []
+    central = []
+    offset = 0
+    for member in members:
+        name = member["name"].encode("utf-8")
+        size = len(member["header"]) + member["length"]
+        dos_time, dos_date = _dos_time(member["mtime"])
+        # Sizes and offsets past 4GB move to a ZIP64 extra field, with the
+        # 32-bit field set to 0xFFFFFFFF
+        local_extra = sizes = b""
+        header_size = size
+        if size >= _ZIP32_LIMIT:
+            sizes = struct.pack("<QQ", size, size)
+            local_extra = struct.pack("<HH", 1, len(sizes)) + sizes
+            header_size = _ZIP32_LIMIT
+        header_offset = offset
+        offsets = b""
+        if offset >= _ZIP32_LIMIT:
+            offsets = struct.pack("<Q", offset)
+            header_offset = _ZIP32_LIMIT
+        extra = struct.pack("<HH", 1, len(sizes + offsets)) + sizes + offsets if sizes or offsets else b""
+        version = 45 if extra else 20
+
+        # Bit 11: the name is UTF-8
+        local = struct.pack("<4sHHHHHLLLHH", b"PK\x03\x04", 45 if local_extra else 20, 0x800, 0,
+                            dos_time, dos_date, member["crc32"], header_size, header_size, len(name),
+                            len(local_extra)) + name + local_extra
+        parts.append(local)
+        parts += _member_parts(member)
+
+        central.append(struct.pack("<4sHHHHHHLLLHHHHHLL", b"PK\x01\x02", 3 << 8 | version, version, 0x800, 0,
+                                   dos_time, dos_date, member["crc32"], header_size, header_size, len(name),
+                                   len(extra), 0, 0, 0, 0o100644 << 16, header_offset) + name + extra)
+        offset += len(local) + size
+
+    directory = b"".join(central)
+    count = len(central)
+    end = b""
+    if count >= 0xFFFF or offset >= _ZIP32_LIMIT or len(directory) >= _ZIP32_LIMIT:
+        zip64_end_offset = offset + len(directory)
+        end += struct.pack("<4sQHHLLQQQQ", b"PK\x06\x06", 44, 45, 45, 0, 0, count, count,
+                           len(directory), offset)
+        end += struct.pack("<4sLQL", b"PK\x06\x07", 0, zip64_end_offset, 1)
+    end += struct.pack("<4sHHHHLLH", b"PK\x05\x06", 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+                       min(len(directory), _ZIP32_LIMIT), min(offset, _ZIP32_LIMIT), 0)
+    parts.append(directory + end)
+    return _coalesce(parts)
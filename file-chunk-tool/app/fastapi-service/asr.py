@@ -0,0 +1,291 @@
+import os
+import time
+import random
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+import requests
+
+from transcripts import TranscriptCache, transcript_key
+
+# Speech recognition backend used by POST /transcribe: "openai" (Whisper
+# API) or "stub" (fake transcripts, for testing without an API key)
+ASR_BACKEND = os.environ.get("ASR_BACKEND", "openai")
+ASR_MODEL = os.environ.get("ASR_MODEL", "whisper-1")
+
+# Chunks transcribed at the same time, and how often a chunk is retried
+# after a rate limit or a transient error
+ASR_CONCURRENCY = int(os.environ.get("ASR_CONCURRENCY", "4"))
+ASR_RETRIES = int(os.environ.get("ASR_RETRIES", "5"))
+ASR_BACKOFF = float(os.environ.get("ASR_BACKOFF", "1.0"))
+
+OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
+OPENAI_BASE_URL = os.environ.get("OPENAI_BASE_URL", "https://api.openai.com/v1")
+
+# Seconds the stub backend pretends each chunk takes
+ASR_STUB_LATENCY = float(os.environ.get("ASR_STUB_LATENCY", "0"))
+
+
+class ASRError(Exception):
+    """
+    A transcription failed; retryable errors are worth another attempt
+    """
+
+    def __init__(self, message: str, retryable: bool = False, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+class RateLimited(ASRError):
+    """
+    The backend asked us to slow down (HTTP 429)
+    """
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message, retryable=True, retry_after=retry_after)
+
+
+class ASRBackend:
+    """
+    Interface for speech recognition services
+
+    transcribe() gets the audio of one chunk and returns
+    {"text": ..., "segments": [{"start", "end", "text"}, ...], "duration": ...}
+    with times in seconds from the start of the chunk ("segments" and
+    "duration" may be missing). It raises ASRError on failure.
+    """
+
+    name = ""
+
+    def transcribe(self, audio: bytes, filename: str, options: Dict[str, Any]) -> Dict[str, Any]:
+        raise NotImplementedError
+
+
+class StubBackend(ASRBackend):
+    """
+    Fake transcripts describing the chunk, for tests and local development
+    """
+
+    name = "stub"
+
+    def __init__(self, latency: float = ASR_STUB_LATENCY):
+        self.latency = latency
+
+    def transcribe(self, audio: bytes, filename: str, options: Dict[str, Any]) -> Dict[str, Any]:
+        time.sleep(self.latency)
+        duration = options.get("duration") or 0.0
+        text = f"[{filename}: {len(audio)} bytes]"
+        return {"text": text, "segments": [{"start": 0.0, "end": duration, "text": text}], "duration": duration}
+
+
+class OpenAIBackend(ASRBackend):
+    """
+    OpenAI's transcription API (Whisper)
+
+    One session is shared by all workers, so its keep-alive connections
+    are reused between chunks.
+    """
+
+    name = "openai"
+
+    def __init__(self, api_key: Optional[str] = OPENAI_API_KEY, model: str = ASR_MODEL,
+                 base_url: str = OPENAI_BASE_URL):
+        if not api_key:
+            raise RuntimeError("The openai ASR backend requires OPENAI_API_KEY")
+        self.model = model
+        self.url = f"{base_url.rstrip('/')}/audio/transcriptions"
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = f"Bearer {api_key}"
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(ASR_CONCURRENCY, 10))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def transcribe(self, audio: bytes, filename: str, options: Dict[str, Any]) -> Dict[str, Any]:
+        data = {"model": options.get("model") or self.model, "response_format": "verbose_json"}
+        for name in ("language", "prompt"):
+            if options.get(name):
+                data[name] = options[name]
+        try:
+            response = self.session.post(self.url, data=data, files={"file": (filename, audio)}, timeout=600)
+        except requests.exceptions.RequestException as e:
+            raise ASRError(f"Transcription request failed: {e}", retryable=True)
+        if response.status_code == 429:
+            raise RateLimited("Rate limited by the transcription API", _retry_after(response))
+        if response.status_code >= 500:
+            raise ASRError(f"Transcription API error {response.status_code}", retryable=True,
+                           retry_after=_retry_after(response))
+        if response.status_code != 200:
+            raise ASRError(f"Transcription API error {response.status_code}: {response.text}")
+        result = response.json()
+        return {
+            "text": result.get("text", ""),
+            "segments": [{"start": s["start"], "end": s["end"], "text": s["text"]}
+                         for s in result.get("segments") or []],
+            "duration": result.get("duration"),
+            "language": result.get("language")
+        }
+
+
+def _retry_after(response: requests.Response) -> Optional[float]:
+    try:
+        return float(response.headers["retry-after"])
+    except (KeyError, ValueError):
+        return None
+
+
+def create_backend(kind: str = ASR_BACKEND) -> ASRBackend:
+    """
+    Build the ASR backend selected by ASR_BACKEND
+    """
+    if kind == "stub":
+        return StubBackend()
+    if kind == "openai":
+        return OpenAIBackend()
+    raise ValueError(f"Unknown ASR_BACKEND: {kind}")
+
+
+class Throttle:
+    """
+    Shared pause for all workers once the backend reports a rate limit,
+    so they back off together instead of each hammering it in turn
+    """
+
+    def __init__(self):
+        self._resume_at = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            delay = self._resume_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self._resume_at = max(self._resume_at, time.monotonic() + seconds)
+
+
+def transcribe_with_retry(backend: ASRBackend, audio: bytes, filename: str, options: Dict[str, Any],
+                          throttle: Throttle, retries: int = ASR_RETRIES,
+                          backoff: float = ASR_BACKOFF) -> Dict[str, Any]:
+    """
+    backend.transcribe, retried on rate limits and transient errors
+
+    Waits for the server's Retry-After if it sent one, otherwise for a
+    jittered exponential backoff. Rate limits pause every worker sharing
+    the throttle.
+    """
+    for attempt in range(retries + 1):
+        throttle.wait()
+        try:
+            return backend.transcribe(audio, filename, options)
+        except ASRError as e:
+            if not e.retryable or attempt == retries:
+                raise
+            delay = e.retry_after if e.retry_after is not None else random.uniform(0, backoff * 2 ** attempt)
+            if isinstance(e, RateLimited):
+                throttle.pause(delay)
+            else:
+                time.sleep(delay)
+
+
+def transcribe_chunks(backend: ASRBackend, chunks: List[Dict[str, Any]],
+                      read_chunk: Callable[[Dict[str, Any]], bytes], options: Dict[str, Any],
+                      concurrency: int = ASR_CONCURRENCY, cache: Optional[TranscriptCache] = None,
+                      on_chunk: Optional[Callable[[Dict[str, Any], int, int], None]] = None
+                      ) -> List[Dict[str, Any]]:
+    """
+    Transcribe chunks on up to concurrency worker threads
+
+    Each chunk's audio is read with read_chunk only once a worker picks it
+    up, so at most concurrency chunks are in memory at a time.
+
+    With a cache, each chunk is first looked up by its content hash (its
+    "sha256", or the hash of its audio) and the ASR parameters, and only
+    misses are sent to the backend. Cached results are marked "cached".
+
+    on_chunk(chunk, chunks_done, num_chunks) is called on the calling
+    thread as chunks finish, in order.
+
+    Returns:
+        Backend results in the order of chunks
+    """
+    throttle = Throttle()
+    params = {"backend": backend.name, "model": options.get("model") or getattr(backend, "model", None),
+              "language": options.get("language"), "prompt": options.get("prompt")}
+
+    def cached(digest: str) -> Optional[Dict[str, Any]]:
+        result = cache.get(transcript_key(digest, **params))
+        if result is not None:
+            result["cached"] = True
+        return result
+
+    def transcribe(chunk: Dict[str, Any]) -> Dict[str, Any]:
+        # A known hash saves reading the chunk at all on a hit
+        if cache is not None and "sha256" in chunk:
+            result = cached(chunk["sha256"])
+            if result is not None:
+                return result
+        audio = read_chunk(chunk)
+        digest = chunk.get("sha256")
+        if cache is not None and digest is None:
+            digest = hashlib.sha256(audio).hexdigest()
+            result = cached(digest)
+            if result is not None:
+                return result
+        chunk_options = dict(options)
+        if "start_time" in chunk:
+            chunk_options["duration"] = chunk["end_time"] - chunk["start_time"]
+        result = transcribe_with_retry(backend, audio, chunk["chunk_filename"], chunk_options, throttle)
+        if cache is not None:
+            cache.put(transcript_key(digest, **params), result)
+        return result
+
+    results = []
+    with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="asr") as pool:
+        for chunk, result in zip(chunks, pool.map(transcribe, chunks)):
+            results.append(result)
+            if on_chunk is not None:
+                on_chunk(chunk, len(results), len(chunks))
+    return results
+
+
+def merge_transcripts(chunks: List[Dict[str, Any]], results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Join per-chunk transcripts into one, with times from the start of the file
+
+    Each chunk's segments are shifted by its start_time (or, without
+    timestamps, by the durations of the chunks before it). Where chunks
+    overlap, segments are taken from the earlier chunk up to the middle
+    of the overlap and from the later one after it, so repeated words
+    appear once.
+    """
+    segments = []
+    offset = 0.0
+    previous_end = None
+    for chunk, result in zip(chunks, results):
+        offset = chunk.get("start_time", offset)
+        # Middle of the overlap with the previous chunk, if any
+        cut = (offset + previous_end) / 2 if previous_end is not None and previous_end > offset else None
+        chunk_segments = result.get("segments") or [{"start": 0.0, "end": result.get("duration") or 0.0,
+                                                     "text": result.get("text", "")}]
+        if cut is not None:
+            # Drop the earlier chunk's segments past the cut...
+            while segments and (segments[-1]["start"] + segments[-1]["end"]) / 2 >= cut:
+                segments.pop()
+        for segment in chunk_segments:
+            start, end = offset + segment["start"], offset + segment["end"]
+            # ...and this chunk's before it
+            if cut is not None and (start + end) / 2 < cut:
+                continue
+            segments.append({"chunk_number": chunk["chunk_number"], "start": round(start, 3),
+                             "end": round(end, 3), "text": segment["text"].strip()})
+        previous_end = chunk.get("end_time")
+        offset = previous_end if previous_end is not None else offset + (result.get("duration") or 0.0)
+    return {
+        "text": " ".join(segment["text"] for segment in segments if segment["text"]),
+        "segments": segments
+    }
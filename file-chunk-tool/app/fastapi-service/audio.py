@@ -0,0 +1,566 @@
+import os
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Callable, List, Optional, Sequence, Tuple
+
+from chunking import COPY_BUFFER_SIZE, ChunkRange
+
+# How far back from a size limit we look for a frame/page boundary
+SEARCH_WINDOW = {"mp3": 64 * 1024, "aac": 64 * 1024, "ogg": 256 * 1024}
+
+# Largest possible frame/page, used to read enough to validate a boundary
+MAX_FRAME_SIZE = {"mp3": 2881, "aac": 8191, "ogg": 65307}
+
+# Bytes needed to parse a frame/page header
+_MIN_HEADER_SIZE = {"mp3": 4, "aac": 7, "ogg": 27 + 255}
+
+# Number of consecutive well-formed frames needed to trust a sync word
+CHAIN_FRAMES = 4
+
+# Frames/pages at the start of a stream whose average bitrate is used to
+# estimate chunk times (see AudioStream.plan_estimated)
+ESTIMATE_FRAMES = 500
+
+_MP3_BITRATES = {
+    (3, 3): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (3, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (3, 1): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (2, 3): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (2, 1): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+_MP3_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+_ADTS_SAMPLE_RATES = [96000, 88200, 64000, 48000, 44100, 32000, 24000,
+                      22050, 16000, 12000, 11025, 8000, 7350]
+
+
+def parse_mp3_frame(buf: bytes, i: int) -> Optional[Tuple[int, int, int, tuple]]:
+    """
+    Parse an MPEG audio frame header at buf[i]
+
+    Returns:
+        (frame_length, samples, sample_rate, stream_key) or None if there
+        is no valid header at i
+    """
+    if i + 4 > len(buf) or buf[i] != 0xFF or buf[i + 1] & 0xE0 != 0xE0:
+        return None
+    version = (buf[i + 1] >> 3) & 3
+    layer = (buf[i + 1] >> 1) & 3
+    bitrate_index = buf[i + 2] >> 4
+    rate_index = (buf[i + 2] >> 2) & 3
+    if version == 1 or layer == 0 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    padding = (buf[i + 2] >> 1) & 1
+    bitrate = _MP3_BITRATES[(3 if version == 3 else 2, layer)][bitrate_index] * 1000
+    sample_rate = _MP3_SAMPLE_RATES[version][rate_index]
+    if layer == 3:
+        samples = 384
+        length = (12 * bitrate // sample_rate + padding) * 4
+    elif layer == 2 or version == 3:
+        samples = 1152
+        length = 144 * bitrate // sample_rate + padding
+    else:
+        samples = 576
+        length = 72 * bitrate // sample_rate + padding
+    return length, samples, sample_rate, (version, layer, rate_index)
+
+
+def parse_adts_frame(buf: bytes, i: int) -> Optional[Tuple[int, int, int, tuple]]:
+    """
+    Parse an AAC ADTS frame header at buf[i]
+
+    Returns:
+        (frame_length, samples, sample_rate, stream_key) or None if there
+        is no valid header at i
+    """
+    if i + 7 > len(buf) or buf[i] != 0xFF or buf[i + 1] & 0xF6 != 0xF0:
+        return None
+    rate_index = (buf[i + 2] >> 2) & 0xF
+    if rate_index >= len(_ADTS_SAMPLE_RATES):
+        return None
+    header_length = 7 if buf[i + 1] & 1 else 9
+    length = ((buf[i + 3] & 3) << 11) | (buf[i + 4] << 3) | (buf[i + 5] >> 5)
+    if length < header_length:
+        return None
+    samples = 1024 * ((buf[i + 6] & 3) + 1)
+    profile = buf[i + 2] >> 6
+    return length, samples, _ADTS_SAMPLE_RATES[rate_index], (profile, rate_index)
+
+
+def parse_ogg_page(buf: bytes, i: int) -> Optional[Tuple[int, int, int, tuple]]:
+    """
+    Parse an Ogg page header at buf[i]
+
+    Returns:
+        (page_length, granule_position, header_type, stream_key) or None if
+        there is no valid page header at i
+    """
+    if i + 27 > len(buf) or buf[i:i + 4] != b"OggS" or buf[i + 4] != 0:
+        return None
+    header_type = buf[i + 5]
+    granule, serial = struct.unpack_from("<qI", buf, i + 6)
+    segments = buf[i + 26]
+    if i + 27 + segments > len(buf):
+        return None
+    length = 27 + segments + sum(buf[i + 27:i + 27 + segments])
+    return length, granule, header_type, (serial,)
+
+
+_PARSERS = {"mp3": parse_mp3_frame, "aac": parse_adts_frame, "ogg": parse_ogg_page}
+
+
+def _skip_id3(buf: bytes) -> int:
+    """
+    Length of a leading ID3v2 tag, or 0 if there is none
+    """
+    if len(buf) < 10 or buf[:3] != b"ID3":
+        return 0
+    size = (buf[6] << 21) | (buf[7] << 14) | (buf[8] << 7) | buf[9]
+    footer = 10 if buf[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def _chain_ok(fmt: str, buf: bytes, i: int, buf_end_is_eof: bool) -> bool:
+    """
+    Check that CHAIN_FRAMES well-formed frames of one stream start at buf[i]
+    """
+    parse = _PARSERS[fmt]
+    key = None
+    for n in range(CHAIN_FRAMES):
+        if i + _MIN_HEADER_SIZE[fmt] > len(buf):
+            # Ran off the buffer: fine at end of file or after a few good frames
+            return n >= 1 if buf_end_is_eof else n >= 2
+        frame = parse(buf, i)
+        if frame is None or (key is not None and frame[3] != key):
+            # Allow trailing tags (e.g. ID3v1) after the last frame
+            return buf_end_is_eof and n >= 1 and len(buf) - i <= 128
+        key = frame[3]
+        i += frame[0]
+    return True
+
+
+def detect_format(fd: int, file_size: int) -> Optional[str]:
+    """
+    Identify a container we can split on frame boundaries
+
+    Returns:
+        "wav", "ogg", "mp3", "aac" or None
+    """
+    head = os.pread(fd, 64 * 1024, 0)
+    if head[:4] == b"RIFF" and head[8:12] == b"WAVE":
+        return "wav"
+    if head[:4] == b"OggS":
+        return "ogg"
+    start = _skip_id3(head)
+    if start:
+        head = os.pread(fd, 64 * 1024, start)
+    eof = start + len(head) >= file_size
+    for fmt in ("mp3", "aac"):
+        if _chain_ok(fmt, head, 0, eof):
+            return fmt
+    return None
+
+
+def find_boundary(fd: int, fmt: str, target: int, floor: int, file_size: int) -> Optional[int]:
+    """
+    Find the last frame/page boundary at or before target and after floor
+
+    Candidate sync words are only trusted when followed by a chain of
+    well-formed frames from the same stream, which rules out sync-like
+    byte patterns inside compressed data.
+    """
+    lo = max(floor + 1, target - SEARCH_WINDOW[fmt])
+    if lo > target:
+        return None
+    buf = os.pread(fd, target - lo + CHAIN_FRAMES * MAX_FRAME_SIZE[fmt], lo)
+    eof = lo + len(buf) >= file_size
+    pattern = b"OggS" if fmt == "ogg" else b"\xff"
+    fallback = None
+    end = target - lo + len(pattern)
+    while True:
+        i = buf.rfind(pattern, 0, end)
+        if i < 0:
+            return fallback
+        if _chain_ok(fmt, buf, i, eof):
+            # Prefer Ogg pages that do not continue a packet from the previous page
+            if fmt != "ogg" or not buf[i + 5] & 1:
+                return lo + i
+            if fallback is None:
+                fallback = lo + i
+        end = i - 1 + len(pattern)
+
+
+def _ogg_header_pages(fd: int, file_size: int) -> Optional[int]:
+    """
+    End offset of the codec header pages (granule position 0) of an Ogg stream
+    """
+    offset = 0
+    while offset < file_size:
+        buf = os.pread(fd, 27 + 255, offset)
+        page = parse_ogg_page(buf, 0)
+        if page is None:
+            return None
+        if page[1] not in (0, -1):
+            return offset
+        offset += page[0]
+    return None
+
+
+def _ogg_granule_rate(header: bytes) -> Optional[int]:
+    """
+    Granule positions per second of the codec in an Ogg stream's first page
+    """
+    page = parse_ogg_page(header, 0)
+    if page is None:
+        return None
+    packet = header[27 + header[26]:page[0]]
+    if packet.startswith(b"OpusHead"):
+        return 48000
+    if packet.startswith(b"\x01vorbis") and len(packet) >= 16:
+        return struct.unpack_from("<I", packet, 12)[0] or None
+    return None
+
+
+class _WavGrid(Sequence):
+    """
+    Sample-frame boundaries start, start + align, ..., end of a WAV stream
+    as a read-only sequence, either as byte offsets or (with byte_rate) as
+    times, without listing them all
+    """
+
+    def __init__(self, start: int, end: int, align: int, byte_rate: Optional[int] = None):
+        self.start, self.end, self.align, self.byte_rate = start, end, align, byte_rate
+
+    def __len__(self) -> int:
+        return -(-(self.end - self.start) // self.align) + 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        offset = min(self.start + i * self.align, self.end)
+        return offset if self.byte_rate is None else (offset - self.start) / self.byte_rate
+
+
+class AudioStream:
+    """
+    Layout of an audio file we can cut without re-encoding
+
+    Attributes:
+        fmt: "mp3", "aac", "ogg" or "wav"
+        start: Offset where the first chunk starts
+        end: Offset where the last chunk ends
+        align: Cuts are made at multiples of this from start (WAV sample frames)
+    """
+
+    def __init__(self, fd: int, fmt: str, file_size: int, start: int = 0, end: Optional[int] = None,
+                 align: int = 1, stream_header: bytes = b"", fmt_chunk: bytes = b""):
+        self.fd = fd
+        self.fmt = fmt
+        self.file_size = file_size
+        self.start = start
+        self.end = file_size if end is None else end
+        self.align = align
+        self.stream_header = stream_header
+        self.fmt_chunk = fmt_chunk
+
+    @classmethod
+    def open(cls, fd: int, file_size: int, chunk_size: int) -> Optional["AudioStream"]:
+        """
+        Inspect the file behind fd; None if it is not a format we can cut
+        """
+        fmt = detect_format(fd, file_size)
+        if fmt == "wav":
+            return cls._open_wav(fd, file_size)
+        if fmt == "ogg":
+            header_end = _ogg_header_pages(fd, file_size)
+            if header_end is None or header_end > chunk_size // 2:
+                return None
+            return cls(fd, fmt, file_size, stream_header=os.pread(fd, header_end, 0))
+        if fmt in ("mp3", "aac"):
+            return cls(fd, fmt, file_size)
+        return None
+
+    @classmethod
+    def _open_wav(cls, fd: int, file_size: int) -> Optional["AudioStream"]:
+        offset = 12
+        fmt_chunk = None
+        while offset + 8 <= file_size:
+            chunk_id, size = struct.unpack("<4sI", os.pread(fd, 8, offset))
+            if chunk_id == b"fmt ":
+                fmt_chunk = os.pread(fd, 8 + size + (size & 1), offset)
+            elif chunk_id == b"data":
+                break
+            offset += 8 + size + (size & 1)
+        else:
+            return None
+        if fmt_chunk is None or len(fmt_chunk) < 24:
+            return None
+
+        data_start = offset + 8
+        # Streamed WAVs may carry a placeholder data size
+        data_end = data_start + min(size, file_size - data_start)
+        block_align = struct.unpack_from("<H", fmt_chunk, 20)[0] or 1
+        return cls(fd, "wav", file_size, start=data_start, end=data_end,
+                   align=block_align, fmt_chunk=fmt_chunk)
+
+    @property
+    def byte_rate(self) -> int:
+        """
+        Bytes per second of a WAV stream
+        """
+        return struct.unpack_from("<I", self.fmt_chunk, 16)[0]
+
+    def header(self, first: bool, length: int) -> bytes:
+        """
+        Bytes to write before a chunk of length bytes so it decodes on its own
+        """
+        if self.fmt == "wav":
+            return (b"RIFF" + struct.pack("<I", 4 + len(self.fmt_chunk) + 8 + length) + b"WAVE" +
+                    self.fmt_chunk + b"data" + struct.pack("<I", length))
+        # The first Ogg chunk already starts with the codec header pages
+        return b"" if first else self.stream_header
+
+    def frame_cut(self, position: int, limit: int) -> int:
+        """
+        Last frame boundary in (position, limit], or limit if there is none
+        """
+        if self.fmt == "wav":
+            return self.start + (limit - self.start) // self.align * self.align
+        cut = find_boundary(self.fd, self.fmt, limit, position, self.file_size)
+        return limit if cut is None else cut
+
+    def plan(self, chunk_size: int, choose_cut: Optional[Callable[[int, int], int]] = None) -> List[ChunkRange]:
+        """
+        Plan chunks of at most chunk_size bytes including their headers
+
+        Args:
+            chunk_size: Maximum size of each chunk
+            choose_cut: Picks a cut in (position, limit] for a chunk starting
+                at position; defaults to the last frame boundary
+
+        Returns:
+            List of (offset, length, header) ranges
+        """
+        choose_cut = choose_cut or self.frame_cut
+        ranges = []
+        position = self.start
+        while True:
+            first = not ranges
+            budget = chunk_size - len(self.header(first, 0))
+            if self.end - position <= budget:
+                length = self.end - position
+                ranges.append((position, length, self.header(first, length)))
+                return ranges
+            cut = choose_cut(position, position + budget)
+            if cut <= position:
+                cut = position + budget
+            ranges.append((position, cut - position, self.header(first, cut - position)))
+            position = cut
+
+    def timeline(self) -> Optional[Tuple[array, array]]:
+        """
+        Byte offset and start time (seconds) of every frame/page
+
+        WAV streams have no frames, so their timeline is not enumerated
+        (use byte_rate instead). Stops at the first damaged frame.
+
+        Returns:
+            (offsets, times) arrays, or None if timing is unknown
+        """
+        scan = self._scan()
+        return scan[:2] if scan else None
+
+    def _scan(self, limit: Optional[int] = None) -> Optional[Tuple[array, array, float]]:
+        """
+        timeline() plus the time at which the last frame/page ends, for at
+        most limit frames/pages
+        """
+        if self.fmt == "wav":
+            return None
+        offsets, times = array("q"), array("d")
+        parse = _PARSERS[self.fmt]
+        if self.fmt == "ogg":
+            rate = _ogg_granule_rate(self.stream_header)
+            if rate is None:
+                return None
+            position = len(self.stream_header)
+        else:
+            position = _skip_id3(os.pread(self.fd, 10, 0))
+        elapsed = 0
+        end_time = 0.0
+        buf, buf_start = b"", position
+        while position < self.end and (limit is None or len(offsets) < limit):
+            i = position - buf_start
+            if i + MAX_FRAME_SIZE[self.fmt] > len(buf) and buf_start + len(buf) < self.end:
+                buf, buf_start, i = os.pread(self.fd, COPY_BUFFER_SIZE, position), position, 0
+            frame = parse(buf, i)
+            if frame is None:
+                break
+            offsets.append(position)
+            if self.fmt == "ogg":
+                # Granule positions count samples up to the end of the page
+                times.append(elapsed / rate)
+                if frame[1] > 0:
+                    elapsed = frame[1]
+                end_time = elapsed / rate
+            else:
+                times.append(elapsed / frame[2])
+                elapsed += frame[1]
+                end_time = elapsed / frame[2]
+            position += frame[0]
+        return offsets, times, end_time
+
+    def boundaries(self) -> Optional[Tuple[Sequence[int], Sequence[float]]]:
+        """
+        Byte offset and time (seconds) of every point a chunk may start or
+        end at, read from frame/page headers without decoding. The last
+        entry is the end of the stream.
+
+        Returns:
+            (offsets, times) sequences, or None if timing is unknown
+        """
+        if self.fmt == "wav":
+            return (_WavGrid(self.start, self.end, self.align),
+                    _WavGrid(self.start, self.end, self.align, self.byte_rate))
+        scan = self._scan()
+        if scan is None or not scan[0]:
+            return None
+        offsets, times, end_time = scan
+        # The first chunk also carries whatever precedes the first frame
+        # (ID3 tag, Ogg codec header pages), the last whatever follows the
+        # last one (e.g. an ID3v1 tag)
+        offsets[0] = self.start
+        offsets.append(self.end)
+        times.append(end_time)
+        return offsets, times
+
+    def plan_estimated(self, chunk_size: int) -> Optional[Tuple[List[ChunkRange], List[Tuple[float, float]]]]:
+        """
+        plan() with the start and end time of each chunk estimated from the
+        average bitrate of the first ESTIMATE_FRAMES frames/pages
+
+        Much cheaper than plan_timed on long files, which reads every frame
+        header. Only done for WAV and constant-bitrate MP3, where it is
+        exact to within a frame: the bitrate of AAC, Ogg and VBR MP3 varies
+        along the stream, and times estimated from its start drift.
+
+        Returns:
+            (ranges, times) as for plan_timed, or None if timing is unknown
+            or the bitrate is not constant
+        """
+        if self.fmt == "wav":
+            base, rate = self.start, self.byte_rate
+        elif self.fmt == "mp3":
+            scan = self._scan(ESTIMATE_FRAMES)
+            if scan is None or len(scan[0]) < 2 or scan[1][-1] <= scan[1][0] or \
+                    not self._constant_bitrate(scan[0]):
+                return None
+            offsets, times, _ = scan
+            base, rate = offsets[0], (offsets[-1] - offsets[0]) / (times[-1] - times[0])
+        else:
+            return None
+        if not rate:
+            return None
+        ranges = self.plan(chunk_size)
+        # The first chunk also carries whatever precedes the first frame
+        spans = [(max(0.0, (offset - base) / rate) if i else 0.0, (offset + length - base) / rate)
+                 for i, (offset, length, _) in enumerate(ranges)]
+        return ranges, spans
+
+    def _constant_bitrate(self, offsets: Sequence[int]) -> bool:
+        # Frames of one size, give or take a padding slot, and no Xing/VBRI
+        # header announcing a variable bitrate in the first frame ("Info"
+        # is the same header written by encoders for CBR files)
+        sizes = [b - a for a, b in zip(offsets, offsets[1:])]
+        if max(sizes) - min(sizes) > 4:
+            return False
+        first = os.pread(self.fd, sizes[0], offsets[0])
+        return b"Xing" not in first and b"VBRI" not in first
+
+    def plan_timed(self, chunk_size: int, max_duration: Optional[float] = None,
+                   overlap: float = 0) -> Optional[Tuple[List[ChunkRange], List[Tuple[float, float]]]]:
+        """
+        Plan chunks on frame boundaries with their start and end times
+
+        Each chunk ends at the last boundary that keeps it within chunk_size
+        bytes and max_duration seconds. The next one starts overlap seconds
+        before that, so boundary words appear in both chunks. The overlap is
+        capped at half a chunk so the plan always moves forward.
+
+        Returns:
+            (ranges, times): (offset, length, header) ranges and the
+            (start, end) time in seconds of each, or None if timing is unknown
+        """
+        bounds = self.boundaries()
+        if bounds is None:
+            return None
+        offsets, times = bounds
+        last = len(offsets) - 1
+        ranges, spans = [], []
+        first = 0
+        while True:
+            header_size = len(self.header(not ranges, 0))
+            end = min(last, bisect_right(offsets, offsets[first] + chunk_size - header_size) - 1)
+            if max_duration:
+                end = min(end, bisect_right(times, times[first] + max_duration) - 1)
+            end = max(end, first + 1)
+            length = offsets[end] - offsets[first]
+            if length + header_size > chunk_size:
+                # Frames stopped parsing well before the end (damaged data)
+                return None
+            ranges.append((offsets[first], length, self.header(not ranges, length)))
+            spans.append((times[first], times[end]))
+            if end == last:
+                return ranges, spans
+            next_first = bisect_left(times, times[end] - overlap) if overlap else end
+            first = max(next_first, (first + end + 1) // 2)
+
+
+def plan_audio_ranges(fd: int, file_size: int, chunk_size: int) -> Optional[List[ChunkRange]]:
+    """
+    Plan chunks that start and end on frame boundaries of an audio stream
+
+    MP3 and ADTS/AAC are cut between frames, Ogg between pages (with the
+    codec header pages repeated at the start of every chunk) and WAV on
+    sample frames (with a fresh RIFF header per chunk), so every chunk is
+    independently decodable without re-encoding.
+
+    Returns:
+        List of (offset, length, header) ranges, or None if the file is not
+        in a recognised format
+    """
+    stream = AudioStream.open(fd, file_size, chunk_size)
+    return stream.plan(chunk_size) if stream else None
+
+
+def plan_timed_ranges(fd: int, file_size: int, chunk_size: int, max_duration: Optional[float] = None,
+                      overlap: float = 0) -> Optional[Tuple[List[ChunkRange], List[Tuple[float, float]]]]:
+    """
+    plan_audio_ranges with start/end times, a duration limit and overlap
+
+    See AudioStream.plan_timed.
+
+    Returns:
+        (ranges, times), or None if the file is not in a recognised format
+        or its timing cannot be read
+    """
+    stream = AudioStream.open(fd, file_size, chunk_size)
+    return stream.plan_timed(chunk_size, max_duration, overlap) if stream else None
+
+
+def plan_estimated_ranges(fd: int, file_size: int,
+                          chunk_size: int) -> Optional[Tuple[List[ChunkRange], List[Tuple[float, float]]]]:
+    """
+    plan_audio_ranges with start/end times estimated from the bitrate
+
+    See AudioStream.plan_estimated.
+
+    Returns:
+        (ranges, times), or None if the file is not WAV or constant-bitrate
+        MP3, or its timing cannot be read
+    """
+    stream = AudioStream.open(fd, file_size, chunk_size)
+    return stream.plan_estimated(chunk_size) if stream else None
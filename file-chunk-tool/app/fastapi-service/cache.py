@@ -0,0 +1,103 @@
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+
+class TTLCache:
+    """
+    Size- and time-bounded LRU cache with negative caching and single-flight
+    loading
+
+    Values expire ttl seconds after they are stored; keys that were looked
+    up and found missing are remembered for negative_ttl seconds. Once
+    maxsize entries are held, the least recently used one is evicted.
+    Concurrent get_or_load() calls for the same key share one load.
+    """
+
+    _MISSING = object()
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300, negative_ttl: float = 30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self.stats = {"hits": 0, "misses": 0, "loads": 0, "evictions": 0}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _lookup(self, key: Hashable) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def get(self, key: Hashable) -> Tuple[bool, Optional[Any]]:
+        """
+        Returns:
+            (found, value); a negatively cached key is found with value None
+        """
+        entry = self._lookup(key)
+        if entry is None:
+            return False, None
+        value = entry[1]
+        return True, None if value is self._MISSING else value
+
+    def set(self, key: Hashable, value: Optional[Any]):
+        """
+        Store value under key; None records the key as missing
+        """
+        if value is None:
+            expires_at, value = time.monotonic() + self.negative_ttl, self._MISSING
+        else:
+            expires_at = time.monotonic() + self.ttl
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def invalidate(self, key: Hashable):
+        self._entries.pop(key, None)
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Optional[Any]]]) -> Optional[Any]:
+        """
+        Cached value for key, calling loader on a miss
+
+        loader returns the value, or None if the key does not exist (which
+        is then negatively cached). If it raises, nothing is cached and the
+        error is passed on to every caller waiting on this load.
+        """
+        found, value = self.get(key)
+        if found:
+            self.stats["hits"] += 1
+            return value
+        self.stats["misses"] += 1
+
+        # Someone is already loading this key: wait for their result
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            return await asyncio.shield(inflight)
+
+        future = asyncio.get_running_loop().create_future()
+        # Mark a failed load's error as retrieved even if nobody else was waiting
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._inflight[key] = future
+        try:
+            self.stats["loads"] += 1
+            value = await loader()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            del self._inflight[key]
+        self.set(key, value)
+        future.set_result(value)
+        return value
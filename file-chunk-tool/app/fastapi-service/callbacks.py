@@ -0,0 +1,108 @@
+import os
+import time
+import random
+import socket
+import ipaddress
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict
+from urllib.parse import urlparse
+
+import requests
+
+# Delivery of callback_url webhooks: attempts after the first, base delay
+# of the jittered exponential backoff between them, and request timeout
+CALLBACK_RETRIES = int(os.environ.get("CALLBACK_RETRIES", "5"))
+CALLBACK_BACKOFF = float(os.environ.get("CALLBACK_BACKOFF", "1.0"))
+CALLBACK_TIMEOUT = float(os.environ.get("CALLBACK_TIMEOUT", "10"))
+
+# Longest wait between attempts, whatever Retry-After asks for, and the
+# time after which a delivery is given up
+CALLBACK_MAX_DELAY = float(os.environ.get("CALLBACK_MAX_DELAY", "60"))
+CALLBACK_MAX_TIME = float(os.environ.get("CALLBACK_MAX_TIME", "300"))
+
+# Callbacks are delivered on threads of their own, so a slow receiver
+# never holds up a chunking worker
+CALLBACK_WORKERS = int(os.environ.get("CALLBACK_WORKERS", "2"))
+
+# Hosts callbacks may be sent to (comma-separated). Unset, any host is
+# allowed whose addresses are all public, which keeps callbacks away from
+# the service's own network (loopback, private ranges, cloud metadata)
+CALLBACK_ALLOWED_HOSTS = {host.strip().lower() for host in os.environ.get("CALLBACK_ALLOWED_HOSTS", "").split(",")
+                          if host.strip()}
+
+callback_executor = ThreadPoolExecutor(max_workers=CALLBACK_WORKERS, thread_name_prefix="callback")
+
+
+def _public_address(address: str) -> bool:
+    ip = ipaddress.ip_address(address.split("%")[0])
+    if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+def valid_callback_url(url: str) -> bool:
+    """
+    Whether url is an http(s) URL callbacks may be sent to
+
+    Without CALLBACK_ALLOWED_HOSTS, the host is resolved and every address
+    it resolves to must be public. This does DNS lookups, so call it off
+    the event loop.
+    """
+    parsed = urlparse(url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        return False
+    if CALLBACK_ALLOWED_HOSTS:
+        return parsed.hostname.lower() in CALLBACK_ALLOWED_HOSTS
+    try:
+        addresses = socket.getaddrinfo(parsed.hostname, parsed.port or 80, proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, UnicodeError, ValueError):
+        return False
+    return bool(addresses) and all(_public_address(address[4][0]) for address in addresses)
+
+
+def post_callback(url: str, payload: Dict[str, Any], retries: int = CALLBACK_RETRIES,
+                  backoff: float = CALLBACK_BACKOFF, timeout: float = CALLBACK_TIMEOUT,
+                  max_delay: float = CALLBACK_MAX_DELAY, max_time: float = CALLBACK_MAX_TIME) -> Dict[str, Any]:
+    """
+    POST payload as JSON to url, retrying on connection errors, 429 and 5xx
+
+    Other 4xx responses, and redirects, are final: the receiver rejected
+    the payload and sending it again would not help. A Retry-After header
+    is honoured up to max_delay seconds, and no attempt is started after
+    max_time seconds. The URL is checked again before every attempt, as
+    its host may resolve differently by then.
+
+    Returns:
+        Delivery report: url, delivered, attempts and the last status_code
+        or error
+    """
+    report: Dict[str, Any] = {"url": url, "delivered": False, "attempts": 0}
+    deadline = time.monotonic() + max_time
+    for attempt in range(retries + 1):
+        delay = random.uniform(0, backoff * 2 ** attempt)
+        if not valid_callback_url(url):
+            report["error"] = "callback_url is not allowed"
+            return report
+        report["attempts"] = attempt + 1
+        try:
+            response = requests.post(url, json=payload, allow_redirects=False,
+                                     timeout=max(0.1, min(timeout, deadline - time.monotonic())))
+        except requests.exceptions.RequestException as e:
+            report["error"] = str(e)
+        else:
+            report["status_code"] = response.status_code
+            report.pop("error", None)
+            if response.status_code < 300:
+                report["delivered"] = True
+                return report
+            if response.status_code != 429 and response.status_code < 500:
+                return report
+            try:
+                delay = float(response.headers["retry-after"])
+            except (KeyError, ValueError):
+                pass
+        delay = min(max(delay, 0.0), max_delay)
+        if attempt == retries or time.monotonic() + delay >= deadline:
+            break
+        time.sleep(delay)
+    return report
@@ -0,0 +1,309 @@
+import os
+import errno
+import fcntl
+import struct
+import base64
+import hashlib
+from typing import BinaryIO, Callable, Dict, Any, List, Optional, Tuple
+
+# Size of the blocks read from an incoming upload stream
+COPY_BUFFER_SIZE = 1024 * 1024  # 1MB in bytes
+
+# ioctl request to share extents between files (btrfs, XFS with reflink=1, ...)
+FICLONERANGE = 0x4020940D
+
+# Errors meaning "this copy method is not available here", as opposed to real I/O errors
+_UNSUPPORTED_ERRNOS = {
+    errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL,
+    errno.ENOSYS, errno.EBADF, errno.ETXTBSY,
+}
+
+# Copy methods tried in order by copy_range; set CHUNK_COPY_METHODS to restrict them
+COPY_METHODS = [
+    method.strip() for method in
+    os.environ.get("CHUNK_COPY_METHODS", "reflink,copy_file_range,sendfile").split(",")
+    if method.strip()
+]
+
+# A chunk to produce: (offset into the original, length, header bytes written before it)
+ChunkRange = Tuple[int, int, bytes]
+
+
+def chunk_filename(chunk_number: int, num_chunks: int, filename: str) -> str:
+    """
+    Build the on-disk name of a chunk, e.g. chunk_1_of_3_example.mp3
+    """
+    return f"chunk_{chunk_number}_of_{num_chunks}_{filename}"
+
+
+def byte_ranges(file_size: int, chunk_size: int) -> List[ChunkRange]:
+    """
+    Plain byte split: consecutive chunk_size ranges of the file
+    """
+    return [
+        (offset, min(chunk_size, file_size - offset), b"")
+        for offset in range(0, max(file_size, 1), chunk_size)
+    ]
+
+
+def stream_size(stream: BinaryIO) -> int:
+    """
+    Size of a seekable stream without consuming it
+    """
+    position = stream.tell()
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(position)
+    return size
+
+
+def _reflink(src_fd: int, dst_fd: int, offset: int, length: int) -> int:
+    dst_offset = os.lseek(dst_fd, 0, os.SEEK_CUR)
+    fcntl.ioctl(dst_fd, FICLONERANGE, struct.pack("qQQQ", src_fd, offset, length, dst_offset))
+    return length
+
+
+def _copy_file_range(src_fd: int, dst_fd: int, offset: int, length: int) -> int:
+    copied = 0
+    while copied < length:
+        n = os.copy_file_range(src_fd, dst_fd, length - copied, offset + copied)
+        if n == 0:
+            break
+        copied += n
+    return copied
+
+
+def _sendfile(src_fd: int, dst_fd: int, offset: int, length: int) -> int:
+    copied = 0
+    while copied < length:
+        n = os.sendfile(dst_fd, src_fd, offset + copied, length - copied)
+        if n == 0:
+            break
+        copied += n
+    return copied
+
+
+def _buffered_copy(src_fd: int, dst_fd: int, offset: int, length: int) -> int:
+    copied = 0
+    while copied < length:
+        block = os.pread(src_fd, min(COPY_BUFFER_SIZE, length - copied), offset + copied)
+        if not block:
+            break
+        os.write(dst_fd, block)
+        copied += len(block)
+    return copied
+
+
+_COPY_FUNCTIONS = {
+    "reflink": _reflink,
+    "copy_file_range": _copy_file_range if hasattr(os, "copy_file_range") else None,
+    "sendfile": _sendfile if hasattr(os, "sendfile") else None,
+}
+
+
+def copy_range(src_fd: int, dst_path: str, offset: int, length: int, header: bytes = b"") -> int:
+    """
+    Copy length bytes starting at offset of src_fd into a new file at dst_path,
+    optionally preceded by header bytes
+
+    The copy is done inside the kernel where possible: a reflink (shared
+    extents, no data copied at all), then copy_file_range, then sendfile.
+    If none of them is supported the data is copied through a small
+    reusable buffer instead of one chunk-sized allocation.
+
+    Returns:
+        Number of bytes written to dst_path
+    """
+    dst_fd = os.open(dst_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        if header:
+            os.write(dst_fd, header)
+        for method in COPY_METHODS:
+            copy = _COPY_FUNCTIONS.get(method)
+            if copy is None:
+                continue
+            try:
+                return len(header) + copy(src_fd, dst_fd, offset, length)
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED_ERRNOS:
+                    raise
+                # Start over from a clean destination for the next method
+                os.ftruncate(dst_fd, len(header))
+                os.lseek(dst_fd, len(header), os.SEEK_SET)
+        return len(header) + _buffered_copy(src_fd, dst_fd, offset, length)
+    finally:
+        os.close(dst_fd)
+
+
+def _write_all(fd: int, data: memoryview):
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def _split_copying_original(src_fd: int, original_path: str, paths: List[str], file_size: int,
+                            ranges: List[ChunkRange], on_done: Callable[[int, int], None]):
+    # One sequential read of the source: each block goes to the original
+    # and to the chunk files whose ranges it overlaps. Ranges are in file
+    # order, but may overlap or leave gaps.
+    chunk_fds: Dict[int, int] = {}
+    written: Dict[int, int] = {}
+    next_chunk = 0
+    original_fd = os.open(original_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        position = 0
+        while position < file_size:
+            block = memoryview(os.pread(src_fd, min(COPY_BUFFER_SIZE, file_size - position), position))
+            if not block:
+                break
+            end = position + len(block)
+            _write_all(original_fd, block)
+            while next_chunk < len(ranges) and ranges[next_chunk][0] < end:
+                header = ranges[next_chunk][2]
+                chunk_fds[next_chunk] = os.open(paths[next_chunk], os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                _write_all(chunk_fds[next_chunk], memoryview(header))
+                written[next_chunk] = len(header)
+                next_chunk += 1
+            for i in sorted(chunk_fds):
+                offset, length, _ = ranges[i]
+                start, stop = max(offset, position), min(offset + length, end)
+                if stop > start:
+                    _write_all(chunk_fds[i], block[start - position:stop - position])
+                    written[i] += stop - start
+                if offset + length <= end:
+                    os.close(chunk_fds.pop(i))
+                    on_done(i, written[i])
+            position = end
+
+        # Ranges the data never reached: empty chunks, or past a short source
+        for i in range(len(ranges)):
+            if i in chunk_fds:
+                os.close(chunk_fds.pop(i))
+                on_done(i, written[i])
+            elif i >= next_chunk:
+                on_done(i, copy_range(src_fd, paths[i], 0, 0, ranges[i][2]))
+    finally:
+        os.close(original_fd)
+        for fd in chunk_fds.values():
+            os.close(fd)
+
+
+def split_file(source: BinaryIO, chunk_dir: str, filename: str, file_size: int,
+               chunk_size: int, ranges: Optional[List[ChunkRange]] = None,
+               on_chunk: Optional[Callable[[Dict[str, Any], int, int], None]] = None,
+               original_path: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    Produce chunk files from a file on disk
+
+    ranges defaults to a plain byte split. The source must have a file
+    descriptor: uploads are always on disk by the time they are chunked
+    (spooled to a temporary file, staged, or stored as the original).
+
+    Chunks are written with kernel-side copies (see copy_range). With
+    original_path, the source is also copied there, and the chunk files
+    are written in the same single read pass as that copy instead.
+
+    on_chunk(chunk_info, chunks_done, num_chunks) is called after each
+    chunk file is written.
+
+    Returns:
+        List of chunk information dicts
+    """
+    src_fd = source.fileno()
+
+    # Make sure anything buffered in Python is visible through the descriptor
+    if hasattr(source, "flush"):
+        source.flush()
+
+    if ranges is None:
+        ranges = byte_ranges(file_size, chunk_size)
+    names = [chunk_filename(i + 1, len(ranges), filename) for i in range(len(ranges))]
+    paths = [os.path.join(chunk_dir, name) for name in names]
+
+    if original_path is not None:
+        done: Dict[int, Dict[str, Any]] = {}
+
+        def on_done(i: int, size: int):
+            done[i] = {"chunk_number": i + 1, "chunk_filename": names[i], "chunk_path": paths[i],
+                       "chunk_size": size}
+            if on_chunk is not None:
+                on_chunk(done[i], len(done), len(ranges))
+
+        _split_copying_original(src_fd, original_path, paths, file_size, ranges, on_done)
+        return [done[i] for i in range(len(ranges))]
+
+    chunks_info = []
+    for i, (offset, length, header) in enumerate(ranges):
+        size = copy_range(src_fd, paths[i], offset, length, header)
+        chunks_info.append({
+            "chunk_number": i + 1,
+            "chunk_filename": names[i],
+            "chunk_path": paths[i],
+            "chunk_size": size
+        })
+        if on_chunk is not None:
+            on_chunk(chunks_info[-1], i + 1, len(ranges))
+    return chunks_info
+
+
+def hash_fd(fd: int, offset: int, length: int, header: bytes = b"") -> str:
+    """
+    SHA-256 hex digest of header followed by length bytes of fd starting at offset
+    """
+    digest = hashlib.sha256(header)
+    position = offset
+    remaining = length
+    while remaining > 0:
+        block = os.pread(fd, min(COPY_BUFFER_SIZE, remaining), position)
+        if not block:
+            break
+        digest.update(block)
+        position += len(block)
+        remaining -= len(block)
+    return digest.hexdigest()
+
+
+def hash_range(path: str, offset: int, length: int, header: bytes = b"") -> str:
+    """
+    SHA-256 hex digest of header followed by length bytes of path starting at offset
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return hash_fd(fd, offset, length, header)
+    finally:
+        os.close(fd)
+
+
+def plan_chunks(filename: str, file_size: int, chunk_size: int,
+                ranges: Optional[List[ChunkRange]] = None) -> List[Dict[str, Any]]:
+    """
+    Describe virtual chunks as (offset, length) ranges of the original file
+
+    No data is copied, so this is O(1) per chunk regardless of file size.
+    Header bytes that must precede a range (e.g. a WAV header) are stored
+    base64-encoded in the chunk's "header" field.
+
+    Returns:
+        List of chunk information dicts
+    """
+    if ranges is None:
+        ranges = byte_ranges(file_size, chunk_size)
+    chunks_info = []
+    for i, (offset, length, header) in enumerate(ranges):
+        chunk = {
+            "chunk_number": i + 1,
+            "chunk_filename": chunk_filename(i + 1, len(ranges), filename),
+            "chunk_size": len(header) + length,
+            "offset": offset,
+            "length": length
+        }
+        if header:
+            chunk["header"] = base64.b64encode(header).decode()
+        chunks_info.append(chunk)
+    return chunks_info
+
+
+def chunk_header(chunk: Dict[str, Any]) -> bytes:
+    """
+    Header bytes stored with a virtual chunk, if any
+    """
+    return base64.b64decode(chunk["header"]) if "header" in chunk else b""
@@ -0,0 +1,149 @@
+import io
+import os
+import zlib
+import tarfile
+import zipfile
+import mimetypes
+from typing import BinaryIO, Iterator, Optional, Tuple
+
+from chunking import COPY_BUFFER_SIZE
+from transcode import probe_streams, segmenting_available
+
+# Archives and videos uploaded to /upload are unpacked: the audio files in
+# an archive, or the audio streams of a video, are processed as uploads of
+# their own. At most MAX_ARCHIVE_MEMBERS files are taken from an archive,
+# and extraction stops at MAX_EXTRACTED_BYTES in total
+UNPACK_CONTAINERS = os.environ.get("UNPACK_CONTAINERS", "true").lower() in ("1", "true", "yes")
+MAX_ARCHIVE_MEMBERS = int(os.environ.get("MAX_ARCHIVE_MEMBERS", "100"))
+MAX_EXTRACTED_BYTES = int(os.environ.get("MAX_EXTRACTED_BYTES", str(10 * 1024 ** 3)))
+
+
+class ArchiveError(Exception):
+    """Raised when an archive is damaged, truncated or encrypted"""
+
+
+class ExtractionLimit(Exception):
+    """Raised when an archive member would go past MAX_EXTRACTED_BYTES"""
+
+
+# What zipfile and tarfile raise for archives they cannot read
+_ARCHIVE_ERRORS = (zipfile.BadZipFile, tarfile.TarError, zlib.error, EOFError, RuntimeError)
+
+
+class _PreadReader(io.RawIOBase):
+    # Reads fd from the start with pread, leaving its file position alone
+    def __init__(self, fd: int):
+        self.fd = fd
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        data = os.pread(self.fd, len(buffer), self.position)
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+def _is_compressed_tar(fd: int) -> bool:
+    # Decompress just far enough to parse the first member header; a
+    # gzip/bzip2/xz file that is not a tar fails there
+    try:
+        with tarfile.open(fileobj=_PreadReader(fd), mode="r|*") as archive:
+            return archive.next() is not None
+    except _ARCHIVE_ERRORS + (OSError,):
+        return False
+
+
+def detect_container(fd: int) -> Optional[str]:
+    """
+    Recognise archives and videos from their contents
+
+    Returns:
+        "zip", "tar", "video" (a container with a real video stream, as
+        opposed to audio-only MP4/M4A, MKV or WebM files) or None
+    """
+    head = os.pread(fd, 512, 0)
+    if head.startswith(b"PK\x03\x04"):
+        return "zip"
+    if head[257:262] == b"ustar":
+        return "tar"
+    if head.startswith((b"\x1f\x8b", b"BZh", b"\xfd7zXZ\x00")) and _is_compressed_tar(fd):
+        return "tar"
+
+    # MP4/MOV/3GP (ftyp box), Matroska/WebM (EBML header) or AVI
+    media = head[4:8] == b"ftyp" or head.startswith(b"\x1a\x45\xdf\xa3") or \
+        (head.startswith(b"RIFF") and head[8:12] == b"AVI ")
+    if media and segmenting_available():
+        streams = probe_streams(fd) or []
+        if any(stream["codec_type"] == "video" and not stream["attached_pic"] for stream in streams):
+            return "video"
+    return None
+
+
+def is_media_name(name: str) -> bool:
+    """
+    Whether an archive member looks like an audio or video file worth
+    processing (and not e.g. macOS resource fork metadata)
+    """
+    base = os.path.basename(name)
+    if not base or base.startswith(".") or name.startswith("__MACOSX/"):
+        return False
+    media_type = mimetypes.guess_type(base)[0] or ""
+    return media_type.startswith(("audio/", "video/"))
+
+
+def iter_archive(source: BinaryIO, kind: str) -> Iterator[Tuple[str, BinaryIO]]:
+    """
+    Yield (name, stream) for each regular file in a zip or tar archive
+
+    Members are read one at a time: tar archives (compressed or not) in a
+    single forward pass, zip archives through their central directory.
+    A member's stream is only valid until the next one is yielded.
+
+    Raises:
+        ArchiveError: if the archive cannot be read
+    """
+    source.seek(0)
+    try:
+        if kind == "zip":
+            with zipfile.ZipFile(source) as archive:
+                for info in archive.infolist():
+                    if not info.is_dir():
+                        with archive.open(info) as stream:
+                            yield info.filename, stream
+        else:
+            with tarfile.open(fileobj=source, mode="r|*") as archive:
+                for info in archive:
+                    if info.isfile():
+                        yield info.name, archive.extractfile(info)
+    except _ARCHIVE_ERRORS as e:
+        raise ArchiveError(str(e)) from e
+
+
+def copy_member(stream: BinaryIO, dst_path: str, limit: int) -> int:
+    """
+    Write an archive member to dst_path, failing once it passes limit bytes
+    (declared sizes can lie, so the limit is enforced on the data itself)
+
+    Returns:
+        Number of bytes written
+
+    Raises:
+        ArchiveError: if the member cannot be read (e.g. a bad CRC)
+        ExtractionLimit: past limit bytes
+    """
+    written = 0
+    with open(dst_path, "wb") as dst:
+        while True:
+            try:
+                block = stream.read(COPY_BUFFER_SIZE)
+            except _ARCHIVE_ERRORS as e:
+                raise ArchiveError(str(e)) from e
+            if not block:
+                return written
+            written += len(block)
+            if written > limit:
+                raise ExtractionLimit(f"Archive contents exceed {MAX_EXTRACTED_BYTES} bytes")
+            dst.write(block)
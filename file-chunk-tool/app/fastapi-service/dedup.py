@@ -0,0 +1,68 @@
+import os
+import uuid
+from typing import Any, Dict, List
+
+from chunking import hash_range
+
+
+def upload_key(content_sha256: str, **options) -> str:
+    """
+    Content-hash index key of an upload
+
+    The processing options are part of the key: the same file chunked with
+    another split mode or transcode profile gives different chunks.
+    """
+    settings = ",".join(f"{name}={options[name]}" for name in sorted(options))
+    return f"sha256:{content_sha256}:{settings}"
+
+
+def files_present(file_info: Dict[str, Any]) -> bool:
+    """
+    Whether the files a metadata record points at are still on disk
+    """
+    paths = [chunk["chunk_path"] for chunk in file_info["chunks"] if "chunk_path" in chunk]
+    # Transcoded uploads read their audio from the transcoded file
+    path = file_info.get("transcoded_path") or file_info.get("original_path")
+    if path and (not file_info.get("chunked", True) or file_info.get("storage") == "virtual"):
+        paths.append(path)
+    return all(os.path.exists(path) for path in paths)
+
+
+def store_chunk_objects(chunks_info: List[Dict[str, Any]], object_dir: str) -> int:
+    """
+    Deduplicate chunk files through a content-addressed object store
+
+    Every chunk file is hashed (the digest is kept as its "sha256") and
+    hard-linked into object_dir under that digest. A chunk whose content is
+    already stored is replaced by a link to the existing object, so
+    identical chunks take up disk space only once. Chunk paths stay the
+    same either way.
+
+    Returns:
+        Number of bytes saved
+    """
+    saved = 0
+    for chunk in chunks_info:
+        path = chunk.get("chunk_path")
+        if path is None:
+            continue
+        digest = hash_range(path, 0, chunk["chunk_size"])
+        chunk["sha256"] = digest
+        object_path = os.path.join(object_dir, digest[:2], digest)
+        try:
+            if os.path.exists(object_path):
+                # Swap the new copy for a link to the stored object
+                temp_path = f"{path}.{uuid.uuid4().hex}.link"
+                os.link(object_path, temp_path)
+                os.replace(temp_path, path)
+                saved += chunk["chunk_size"]
+            else:
+                os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                os.link(path, object_path)
+        except FileExistsError:
+            # Another upload stored the same chunk just now; keep our copy
+            pass
+        except OSError:
+            # No hard links on this filesystem: chunks simply aren't shared
+            pass
+    return saved
@@ -0,0 +1,198 @@
+import os
+import re
+from urllib.parse import quote
+from typing import Dict, List, Optional, Tuple, Union
+
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+import aio
+
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class RangeNotSatisfiable(Exception):
+    """Raised when a Range header does not overlap the resource"""
+
+
+def parse_range(range_header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parse a single-range HTTP Range header
+
+    Args:
+        range_header: Value of the Range header, if any
+        size: Size of the resource in bytes
+
+    Returns:
+        (start, end) with end inclusive, or None to serve the whole resource.
+        Malformed and multi-range headers are ignored, as RFC 9110 allows.
+
+    Raises:
+        RangeNotSatisfiable: if the range lies entirely outside the resource
+    """
+    if not range_header:
+        return None
+    match = _RANGE_RE.match(range_header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        suffix = int(last)
+        if suffix == 0:
+            raise RangeNotSatisfiable()
+        return max(0, size - suffix), size - 1
+    start = int(first)
+    end = int(last) if last else size - 1
+    if start >= size or end < start:
+        raise RangeNotSatisfiable()
+    return start, min(end, size - 1)
+
+
+def etag_matches(header: Optional[str], etag: str) -> bool:
+    """
+    Check an If-None-Match header against an ETag
+
+    Weak validators (W/"...") compare equal to the same strong tag, which
+    is the weak comparison If-None-Match calls for.
+    """
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def content_disposition(filename: str) -> str:
+    """
+    attachment Content-Disposition for any filename (RFC 6266)
+
+    Non-ASCII names go in filename* and get a lossy ASCII fallback in
+    filename, since header values themselves must be Latin-1.
+    """
+    fallback = filename.encode("ascii", "replace").decode().replace("\\", "_").replace('"', "_")
+    if fallback == filename:
+        return f'attachment; filename="{filename}"'
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename)}"
+
+
+class FileRangeResponse(Response):
+    """
+    Stream a byte range of a file on disk, optionally preceded by header bytes
+
+    Uses the ASGI zero-copy send extension (sendfile) when the server
+    supports it and otherwise reads the range in small blocks on the I/O
+    pool, so memory use does not depend on the range size.
+    """
+
+    def __init__(self, path: str, offset: int, length: int, status_code: int = 200,
+                 headers: Optional[Dict[str, str]] = None,
+                 media_type: str = "application/octet-stream", header: bytes = b""):
+        self.path = path
+        self.header = header
+        self.offset = offset
+        self.length = length
+        self.status_code = status_code
+        self.media_type = media_type
+        self.background = None
+        self.init_headers(headers)
+        self.headers["content-length"] = str(len(header) + length)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send({
+            "type": "http.response.start",
+            "status": self.status_code,
+            "headers": self.raw_headers,
+        })
+        if scope.get("method") == "HEAD":
+            await send({"type": "http.response.body", "body": b""})
+            return
+        if self.header or self.length == 0:
+            await send({"type": "http.response.body", "body": self.header, "more_body": self.length > 0})
+            if self.length == 0:
+                return
+
+        await send_file_range(scope, send, self.path, self.offset, self.length)
+
+
+async def send_file_range(scope: Scope, send: Send, path: str, offset: int, length: int,
+                          more_body: bool = False) -> None:
+    """
+    Send length bytes of path from offset as response body messages
+
+    Uses the ASGI zero-copy send extension (sendfile) when the server
+    supports it, and otherwise reads the range in small blocks on the I/O
+    pool. With more_body, the response is left open for more parts.
+    """
+    if "http.response.zerocopysend" in scope.get("extensions", {}):
+        fd = await aio.run_io(os.open, path, os.O_RDONLY)
+        try:
+            await send({
+                "type": "http.response.zerocopysend",
+                "file": fd,
+                "offset": offset,
+                "count": length,
+                "more_body": more_body,
+            })
+        finally:
+            os.close(fd)
+        return
+
+    remaining = length
+    async for block in aio.iter_range(path, offset, length):
+        remaining -= len(block)
+        await send({
+            "type": "http.response.body",
+            "body": block,
+            "more_body": more_body or remaining > 0,
+        })
+    if remaining > 0:
+        if more_body:
+            # Later parts would land at the wrong offsets; abort the response
+            raise OSError(f"{path} shrank while it was being sent")
+        # File shrank underneath us; end the body rather than hang the client
+        await send({"type": "http.response.body", "body": b""})
+
+
+class ConcatResponse(Response):
+    """
+    Stream a sequence of parts, each literal bytes or a (path, offset,
+    length) range of a file on disk, as one body
+
+    Used for archives laid out up front (see archive.py): the size is
+    known before sending, and file ranges go out with sendfile where the
+    server supports it, so memory use does not depend on the file sizes.
+    """
+
+    def __init__(self, parts: List[Union[bytes, Tuple[str, int, int]]], status_code: int = 200,
+                 headers: Optional[Dict[str, str]] = None,
+                 media_type: str = "application/octet-stream"):
+        self.parts = parts
+        self.status_code = status_code
+        self.media_type = media_type
+        self.background = None
+        self.init_headers(headers)
+        self.headers["content-length"] = str(sum(
+            len(part) if isinstance(part, bytes) else part[2] for part in parts))
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send({
+            "type": "http.response.start",
+            "status": self.status_code,
+            "headers": self.raw_headers,
+        })
+        if scope.get("method") != "HEAD":
+            for part in self.parts:
+                if isinstance(part, bytes):
+                    await send({"type": "http.response.body", "body": part, "more_body": True})
+                else:
+                    await send_file_range(scope, send, *part, more_body=True)
+        await send({"type": "http.response.body", "body": b""})
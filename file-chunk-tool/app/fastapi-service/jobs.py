@@ -0,0 +1,238 @@
+import os
+import time
+import uuid
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+from aio import run_io
+from metadata import MetadataStore
+
+# Finished jobs are forgotten JOB_TTL seconds after they finish (jobs
+# in the metadata store, JOB_TTL seconds after their last update)
+JOB_TTL = float(os.environ.get("JOB_TTL", "3600"))
+
+# How often events() checks the metadata store for new events of a job
+# run by another worker process
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", "1"))
+
+
+class JobQueue:
+    """
+    Runs blocking work on a bounded worker pool and tracks its status
+
+    Jobs move through queued -> running -> completed / failed. A completed
+    job holds the return value of its function in "result"; a failed one
+    holds an "error" message (and "status_code" for HTTPExceptions).
+
+    Every status change, and every progress report made by the job's
+    function through report(), is also appended to the job's event log,
+    which events() streams to any number of listeners.
+
+    With a store, job records and events are written through to it, so
+    get() and events() work for jobs run by any worker process. Writing
+    to the store blocks, so call submit() and get() off the event loop.
+    Jobs are dropped ttl seconds after they finish.
+    """
+
+    def __init__(self, workers: int, store: Optional[MetadataStore] = None, ttl: float = JOB_TTL):
+        self.workers = workers
+        self.store = store
+        self.ttl = ttl
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self.jobs: Dict[str, Dict[str, Any]] = {}
+        self._events: Dict[str, List[Dict[str, Any]]] = {}
+        self._listeners: Dict[str, List[Tuple[asyncio.AbstractEventLoop, asyncio.Queue]]] = {}
+        self._current = threading.local()
+        self._lock = threading.Lock()
+        # Keeps writes to the store in the order they were made in memory
+        self._store_lock = threading.Lock()
+
+    def submit(self, fn: Callable[..., Any], *args,
+               on_finish: Optional[Callable[[Dict[str, Any]], None]] = None, **kwargs) -> Dict[str, Any]:
+        """
+        Queue fn(*args, **kwargs) and return its job record
+
+        on_finish, if given, is called on the worker with the final job
+        record once the job has completed or failed.
+        """
+        self._expire()
+        job_id = str(uuid.uuid4())
+        now = time.time()
+        job = {
+            "job_id": job_id,
+            "status": "queued",
+            "created_at": now,
+            "updated_at": now,
+            "started_at": None,
+            "finished_at": None,
+            "result": None,
+            "error": None
+        }
+        with self._store_lock:
+            with self._lock:
+                self.jobs[job_id] = job
+                self._events[job_id] = []
+                snapshot = dict(job)
+            if self.store is not None:
+                self.store.put_job(snapshot)
+        self._emit(job_id, {"type": "status", "status": "queued"})
+        self.executor.submit(self._run, job_id, fn, args, kwargs, on_finish)
+        return snapshot
+
+    def _run(self, job_id: str, fn: Callable[..., Any], args: tuple, kwargs: dict,
+             on_finish: Optional[Callable[[Dict[str, Any]], None]]):
+        self._update(job_id, status="running", started_at=time.time())
+        self._current.job_id = job_id
+        try:
+            result = fn(*args, **kwargs)
+        except HTTPException as e:
+            self._update(job_id, status="failed", finished_at=time.time(),
+                         error=e.detail, status_code=e.status_code)
+        except Exception as e:
+            self._update(job_id, status="failed", finished_at=time.time(), error=str(e))
+        else:
+            self._update(job_id, status="completed", finished_at=time.time(), result=result)
+        finally:
+            self._current.job_id = None
+        if on_finish is not None:
+            on_finish(self.get(job_id))
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            expired = [job_id for job_id, job in self.jobs.items()
+                       if job["finished_at"] is not None and job["finished_at"] < cutoff]
+            for job_id in expired:
+                del self.jobs[job_id]
+                del self._events[job_id]
+        if self.store is not None:
+            self.store.expire_jobs(cutoff)
+
+    def _update(self, job_id: str, **fields):
+        with self._store_lock:
+            with self._lock:
+                self.jobs[job_id].update(fields, updated_at=time.time())
+                job = dict(self.jobs[job_id])
+            if self.store is not None:
+                self.store.put_job(job)
+        if "status" in fields:
+            event = {"type": "status", "status": job["status"]}
+            event.update((key, job[key]) for key in ("result", "error", "status_code") if job.get(key) is not None)
+            self._emit(job_id, event)
+
+    def _emit(self, job_id: str, event: Dict[str, Any]):
+        with self._store_lock:
+            with self._lock:
+                events = self._events[job_id]
+                event = {"id": len(events), "time": time.time(), **event}
+                events.append(event)
+                listeners = list(self._listeners.get(job_id, ()))
+            if self.store is not None:
+                self.store.add_job_event(job_id, event)
+        for loop, queue in listeners:
+            loop.call_soon_threadsafe(queue.put_nowait, event)
+
+    def report(self, **progress):
+        """
+        Record progress of the job running on the calling thread
+
+        The fields become a "progress" event and the job's "progress".
+        Does nothing outside a job, e.g. for work done through run().
+        """
+        job_id = getattr(self._current, "job_id", None)
+        if job_id is None:
+            return
+        self._update(job_id, progress=progress)
+        self._emit(job_id, {"type": "progress", **progress})
+
+    def annotate(self, job_id: str, **fields):
+        """
+        Add fields to a job record (e.g. from an on_finish callback)
+        """
+        self._update(job_id, **fields)
+
+    async def events(self, job_id: str, after: int = -1,
+                     heartbeat: Optional[float] = None) -> AsyncIterator[Optional[Dict[str, Any]]]:
+        """
+        Events of a job with an id above after, past ones first, then live
+        ones until the job has completed or failed
+
+        With heartbeat, yields None whenever that many seconds pass
+        without an event, so the caller can keep its connection alive.
+        """
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        listener = (loop, queue)
+        # Taking the backlog and subscribing under one lock means no event is missed or repeated
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is not None:
+                backlog = [event for event in self._events[job_id] if event["id"] > after]
+                finished = job["status"] in ("completed", "failed")
+                if not finished:
+                    self._listeners.setdefault(job_id, []).append(listener)
+        if job is None:
+            if self.store is not None:
+                async for event in self._follow(job_id, after, heartbeat):
+                    yield event
+            return
+        try:
+            for event in backlog:
+                yield event
+            while not finished:
+                try:
+                    event = await asyncio.wait_for(queue.get(), heartbeat)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                if event["id"] > after:
+                    yield event
+                finished = event["type"] == "status" and event["status"] in ("completed", "failed")
+        finally:
+            with self._lock:
+                listeners = self._listeners.get(job_id, [])
+                if listener in listeners:
+                    listeners.remove(listener)
+                if not listeners:
+                    self._listeners.pop(job_id, None)
+
+    async def _follow(self, job_id: str, after: int,
+                      heartbeat: Optional[float]) -> AsyncIterator[Optional[Dict[str, Any]]]:
+        # A job of another worker process: poll its events in the store
+        idle = 0.0
+        while True:
+            events = await run_io(self.store.job_events, job_id, after)
+            for event in events:
+                yield event
+                after = event["id"]
+                if event["type"] == "status" and event["status"] in ("completed", "failed"):
+                    return
+            if events:
+                idle = 0.0
+            elif await run_io(self.store.get_job, job_id) is None:
+                return
+            elif heartbeat is not None and idle >= heartbeat:
+                yield None
+                idle = 0.0
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+            idle += JOB_POLL_INTERVAL
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Snapshot of a job record, or None if the job is unknown
+        """
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is not None:
+                return dict(job)
+        return self.store.get_job(job_id) if self.store is not None else None
+
+    async def run(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        Run fn on the worker pool and wait for it without blocking the event loop
+        """
+        return await asyncio.wrap_future(self.executor.submit(fn, *args, **kwargs))
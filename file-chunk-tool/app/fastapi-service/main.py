@@ -1,25 +1,128 @@
 import os
-import math
+import json
 import uuid
 import shutil
-from typing import List, Dict, Any
-from fastapi import FastAPI, UploadFile, File, Request, HTTPException
-from fastapi.responses import JSONResponse
+import asyncio
+import mimetypes
+from contextlib import ExitStack, suppress
+from typing import BinaryIO, List, Dict, Any, Optional
+from fastapi import FastAPI, UploadFile, File, Query, Request, HTTPException
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+import aio
+import archive
+import asr
+import callbacks
+import containers
+from audio import plan_audio_ranges, plan_estimated_ranges, plan_timed_ranges
+from chunking import COPY_BUFFER_SIZE, chunk_header, copy_range, hash_fd, hash_range, plan_chunks, split_file, stream_size
+from dedup import files_present, store_chunk_objects, upload_key
+from jobs import JobQueue
+from metadata import create_store
+from storage import create_storage
+from transcripts import create_transcript_cache
+from silence import plan_silence_ranges, silence_available
+from transcode import (SEGMENT_WORKERS, TRANSCODE_PROFILES, demuxed_extension, extract_audio, plan_segments,
+                       probe_duration, probe_streams, segment_file, segmenting_available, transcode_available,
+                       transcode_file, transcoded_filename)
+from resumable import (MAX_UPLOAD_SIZE, create_upload, data_path, expire_uploads, read_upload, record_part,
+                       update_upload, upload_offset)
+from http_responses import (ConcatResponse, FileRangeResponse, RangeNotSatisfiable, content_disposition, etag_matches,
+                       parse_range)
 
 app = FastAPI(title="File Chunker API", 
               description="Service to chunk large files into smaller pieces for Whisper transcription")
 
+# Storage backend (see STORAGE_BACKEND). Uploads and chunks are always
+# processed in local directories - under STORAGE_ROOT for the local
+# backend - and a remote backend gets a copy of each stored file
+file_storage = create_storage()
+WORK_DIR = file_storage.local_path("") or "."
+
 # Create a directory to store uploaded files and chunks
-UPLOAD_DIR = "uploads"
-CHUNK_DIR = "chunks"
+UPLOAD_DIR = os.path.join(WORK_DIR, "uploads")
+CHUNK_DIR = os.path.join(WORK_DIR, "chunks")
 MAX_CHUNK_SIZE = 25 * 1024 * 1024  # 25MB in bytes
 
+# How chunks are stored: "files" writes a file per chunk, "virtual" records
+# (offset, length) ranges into the original and serves them from it
+CHUNK_STORAGE = os.environ.get("CHUNK_STORAGE", "files")
+CHUNK_STORAGE_MODES = ("files", "virtual")
+
+# Where chunks are cut: "frames" cuts audio (MP3, AAC/ADTS, WAV, Ogg) on frame
+# boundaries, "silence" on the quietest frame boundary near each limit; both
+# fall back to "bytes" for anything else. "segments" cuts by time with ffmpeg
+CHUNK_SPLIT = os.environ.get("CHUNK_SPLIT", "frames")
+CHUNK_SPLIT_MODES = ("bytes", "frames", "silence", "segments")
+
+# Uploads waiting for a background job are staged here (same volume as
+# uploads), each worker process in a directory of its own. Resumable
+# uploads are assembled directly in INCOMING_DIR
+INCOMING_DIR = os.path.join(UPLOAD_DIR, "incoming")
+STAGING_DIR = os.path.join(INCOMING_DIR, f"staged-{os.getpid()}")
+
+# Identical uploads (same content and options) return the first upload's
+# file_id and chunks instead of being stored and chunked again, and
+# identical chunk files are stored once in CHUNK_OBJECT_DIR
+DEDUP = os.environ.get("DEDUP", "true").lower() in ("1", "true", "yes")
+CHUNK_OBJECT_DIR = os.path.join(CHUNK_DIR, "objects")
+
+# Number of uploads chunked at the same time
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "4"))
+
+# Speech recognition backend for POST /transcribe (see ASR_BACKEND),
+# created on first use so the service starts without ASR credentials
+asr_backend = None
+
+# Transcripts of chunks already seen, by content hash (see TRANSCRIPT_CACHE_MAX_BYTES)
+transcript_cache = create_transcript_cache()
+
 # Create directories if they don't exist
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(CHUNK_DIR, exist_ok=True)
+os.makedirs(INCOMING_DIR, exist_ok=True)
+
+def remove_stale_staging():
+    """
+    Remove the staging directories of worker processes that are gone
+    
+    Their staged uploads belong to jobs that died with the process. A
+    directory with this process's own PID was left by an earlier process
+    too, as this one has not staged anything yet.
+    """
+    for name in os.listdir(INCOMING_DIR):
+        if not name.startswith("staged-"):
+            continue
+        try:
+            pid = int(name[len("staged-"):])
+            if pid != os.getpid():
+                os.kill(pid, 0)
+                continue
+        except ProcessLookupError:
+            pass
+        except (ValueError, PermissionError):
+            # Not ours, or a process of another user that is still running
+            continue
+        shutil.rmtree(os.path.join(INCOMING_DIR, name), ignore_errors=True)
+
+remove_stale_staging()
+os.makedirs(STAGING_DIR, exist_ok=True)
+expire_uploads(INCOMING_DIR)
+
+# Store information about chunked files (SQLite by default, see METADATA_STORE)
+metadata_store = create_store()
 
-# Store information about chunked files
-chunked_files = {}
+# Worker pool that does the blocking chunking work off the event loop. Job
+# status is kept in the metadata store, so any worker process can report it
+job_queue = JobQueue(JOB_WORKERS, metadata_store)
+
+# Most files accepted by one POST /upload/batch, and most IDs looked up by
+# one GET /chunks?ids=...
+MAX_BATCH_FILES = int(os.environ.get("MAX_BATCH_FILES", "20"))
+MAX_BATCH_IDS = int(os.environ.get("MAX_BATCH_IDS", "100"))
+
+# Seconds between keep-alive comments on an idle GET /jobs/{job_id}/events stream
+SSE_HEARTBEAT = float(os.environ.get("SSE_HEARTBEAT", "15"))
 
 @app.post("/process")
 async def process(request: Request):
@@ -27,95 +130,1123 @@ async def process(request: Request):
     data = await request.json()
     return {"response": f"Received: {data}"}
 
-@app.post("/upload", response_model=Dict[str, Any])
-async def upload_file(file: UploadFile = File(...)):
+def process_upload(file_id: str, source: BinaryIO, filename: str, keep_original: bool = True,
+                   storage: str = CHUNK_STORAGE, split: str = CHUNK_SPLIT,
+                   transcode: Optional[str] = None, dedup: bool = DEDUP,
+                   max_duration: Optional[float] = None, overlap_seconds: float = 0,
+                   staged_path: Optional[str] = None,
+                   unpack: bool = containers.UNPACK_CONTAINERS) -> Dict[str, Any]:
     """
-    Upload a file and chunk it if larger than 25MB
-    Returns information about the original file and its chunks
+    Store an uploaded file and chunk it if larger than 25MB
+    
+    Args:
+        file_id: ID to store the file under
+        source: Seekable file object with a file descriptor holding the upload
+        filename: Name of the uploaded file
+        keep_original, storage, split, transcode, dedup, max_duration,
+            overlap_seconds: See upload_file
+        staged_path: Path of source if it is a staged copy that may be moved
+            into place as the original
+        unpack: Process the audio in archives and videos instead of the
+            file itself (see process_container)
+        
+    Returns:
+        Information about the original file and its chunks
     """
-    # Generate a unique ID for this upload
-    file_id = str(uuid.uuid4())
+    original_filename = filename
+    upload_size = stream_size(source)
     
-    # Create a directory for this specific upload's chunks
-    file_chunk_dir = os.path.join(CHUNK_DIR, file_id)
-    os.makedirs(file_chunk_dir, exist_ok=True)
+    if unpack:
+        source.flush()
+        kind = containers.detect_container(source.fileno())
+        if kind is not None:
+            return process_container(file_id, source, filename, kind, keep_original=keep_original,
+                                     storage=storage, split=split, transcode=transcode, dedup=dedup,
+                                     max_duration=max_duration, overlap_seconds=overlap_seconds)
     
-    # Save the uploaded file
-    file_path = os.path.join(UPLOAD_DIR, f"{file_id}_{file.filename}")
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
-    
-    # Get file size
-    file_size = os.path.getsize(file_path)
-    
-    # Check if file needs chunking
-    if file_size <= MAX_CHUNK_SIZE:
-        # File is small enough, no need to chunk
-        return {
-            "file_id": file_id,
-            "original_filename": file.filename,
-            "original_size": file_size,
-            "chunked": False,
-            "message": "File is under 25MB, no chunking needed"
-        }
-    
-    # Calculate number of chunks needed
-    num_chunks = math.ceil(file_size / MAX_CHUNK_SIZE)
-    chunks_info = []
-    
-    # Open the file and create chunks
-    with open(file_path, "rb") as f:
-        for i in range(num_chunks):
-            # Create chunk file
-            chunk_filename = f"chunk_{i+1}_of_{num_chunks}_{file.filename}"
-            chunk_path = os.path.join(file_chunk_dir, chunk_filename)
-            
-            # Read chunk data
-            chunk_data = f.read(MAX_CHUNK_SIZE)
+    file_size = upload_size
+    file_path = os.path.join(UPLOAD_DIR, f"{file_id}_{filename}")
+    transcoded_path = None
+    extra = {}
+    
+    # Return the earlier result if exactly this file was already processed
+    content_key = None
+    if dedup:
+        source.flush()
+        content_key = upload_key(hash_fd(source.fileno(), 0, upload_size), chunk_size=MAX_CHUNK_SIZE,
+                                 keep_original=keep_original, storage=storage, split=split,
+                                 transcode=transcode, max_duration=max_duration,
+                                 overlap_seconds=overlap_seconds)
+        duplicate = find_duplicate(content_key)
+        if duplicate is not None:
+            return duplicate
+    
+    # Cut time segments with parallel ffmpeg processes, transcoding each if asked
+    if split == "segments" and (transcode or file_size > MAX_CHUNK_SIZE or max_duration):
+        result = segment_upload(file_id, source, filename, file_size, keep_original=keep_original,
+                                transcode=transcode, dedup=dedup, content_key=content_key,
+                                max_duration=max_duration, overlap_seconds=overlap_seconds,
+                                staged_path=staged_path)
+        if result is not None:
+            return result
+    
+    with ExitStack() as stack:
+        # Re-encode first so the size check and chunking see the compact file
+        if transcode:
+            filename = transcoded_filename(filename, transcode)
+            transcoded_path = os.path.join(UPLOAD_DIR, f"{file_id}_transcoded_{filename}")
+            job_queue.report(stage="transcoding")
+            try:
+                transcode_file(source.fileno(), transcoded_path, transcode)
+            except RuntimeError as e:
+                raise HTTPException(status_code=422, detail=str(e))
+            # The upload itself is kept as it was, next to the transcoded file
+            if keep_original:
+                _store_original(source, file_path, upload_size, staged_path)
+            source = stack.enter_context(open(transcoded_path, "rb"))
+            file_size = os.path.getsize(transcoded_path)
+            extra = {"transcoded": transcode, "transcoded_filename": filename, "transcoded_size": file_size}
+        
+        # Frame boundaries with their times, read from every frame/page header.
+        # Needed up front when a duration limit may split even a small file
+        timed = None
+        if split in ("frames", "segments") and (max_duration or overlap_seconds):
+            timed = plan_timed_ranges(source.fileno(), file_size, MAX_CHUNK_SIZE, max_duration, overlap_seconds)
+            if timed is None:
+                raise HTTPException(status_code=422, detail="Could not read the audio timing of this file; "
+                                                            "try split=segments")
+        elif split in ("frames", "segments") and file_size > MAX_CHUNK_SIZE:
+            # Only the size limit applies. For WAV and constant-bitrate MP3 the
+            # times follow from the bitrate, which saves reading every frame
+            # header of a long file; otherwise they are read from the frames,
+            # as the transcript merge uses them as offsets and estimates drift
+            timed = plan_estimated_ranges(source.fileno(), file_size, MAX_CHUNK_SIZE)
+            if timed is not None:
+                extra["estimated_times"] = True
+            else:
+                timed = plan_timed_ranges(source.fileno(), file_size, MAX_CHUNK_SIZE)
+        
+        # Check if file needs chunking
+        if file_size <= MAX_CHUNK_SIZE and (timed is None or len(timed[0]) == 1):
+            # File is small enough, no need to chunk - just save it
+            if not transcode:
+                _store_original(source, file_path, file_size, staged_path)
+            blob_url = publish_file(transcoded_path or file_path)
+            if transcode and keep_original:
+                original_url = publish_file(file_path)
+                if original_url:
+                    extra["original_url"] = original_url
             
-            # Write chunk to file
-            with open(chunk_path, "wb") as chunk_file:
-                chunk_file.write(chunk_data)
+            # Record the file too, so a duplicate upload can be answered from it
+            metadata_store.put(file_id, {
+                "original_filename": original_filename,
+                "original_size": upload_size,
+                **extra,
+                "chunked": False,
+                **({"blob_url": blob_url} if blob_url else {}),
+                "num_chunks": 0,
+                "storage": storage,
+                "original_path": file_path if keep_original or not transcode else None,
+                **({"transcoded_path": transcoded_path} if transcoded_path else {}),
+                "chunks": []
+            }, content_hash=content_key)
             
-            # Get chunk size
-            chunk_size = os.path.getsize(chunk_path)
+            return {
+                "file_id": file_id,
+                "original_filename": original_filename,
+                "original_size": upload_size,
+                **extra,
+                "chunked": False,
+                **({"blob_url": blob_url} if blob_url else {}),
+                "message": "File is under 25MB, no chunking needed"
+            }
+        
+        # Store the original unless asked not to (or already stored before transcoding).
+        # A staged upload is moved into place; otherwise, with chunk files to
+        # write, the copy is made in the same pass as the chunk files
+        store_original = keep_original and not transcode
+        copy_original = store_original and storage != "virtual" and \
+            not (staged_path is not None and os.path.exists(staged_path))
+        if store_original and not copy_original:
+            _store_original(source, file_path, file_size, staged_path)
+            source = stack.enter_context(open(file_path, "rb"))
+        
+        # Find audio frame boundaries to cut on, if this is a format we understand
+        ranges = timed[0] if timed else None
+        if split == "silence":
+            try:
+                ranges = plan_silence_ranges(source.fileno(), file_size, MAX_CHUNK_SIZE)
+            except RuntimeError:
+                # Undecodable audio: plain frame boundaries are still better than bytes
+                ranges = None
+        if split in ("frames", "silence", "segments") and ranges is None:
+            ranges = plan_audio_ranges(source.fileno(), file_size, MAX_CHUNK_SIZE)
+        
+        if storage == "virtual":
+            # Chunks are just ranges of the original, nothing more to write
+            chunks_info = plan_chunks(filename, file_size, MAX_CHUNK_SIZE, ranges)
+        else:
+            # Create a directory for this specific upload's chunks
+            file_chunk_dir = os.path.join(CHUNK_DIR, file_id)
+            os.makedirs(file_chunk_dir, exist_ok=True)
             
-            # Store chunk info
-            chunks_info.append({
-                "chunk_number": i + 1,
-                "chunk_filename": chunk_filename,
-                "chunk_path": chunk_path,
-                "chunk_size": chunk_size
-            })
+            # Produce the chunk files with kernel-side copies, or alongside the original
+            chunks_info = split_file(source, file_chunk_dir, filename, file_size, MAX_CHUNK_SIZE, ranges,
+                                     on_chunk=report_chunk, original_path=file_path if copy_original else None)
+        
+        if timed:
+            for chunk, (start_time, end_time) in zip(chunks_info, timed[1]):
+                chunk["start_time"] = round(start_time, 3)
+                chunk["end_time"] = round(end_time, 3)
+    
+    # A transcoded file was only needed to chunk from, unless the chunks are ranges of it
+    if transcode and storage != "virtual":
+        os.remove(transcoded_path)
+        transcoded_path = None
+    
+    return record_chunks(file_id, original_filename, upload_size, chunks_info, storage=storage,
+                         original_path=file_path if keep_original else None, extra=extra,
+                         dedup=dedup, content_key=content_key, transcoded_path=transcoded_path)
+
+def report_chunk(chunk: Dict[str, Any], chunks_done: int, num_chunks: int, stage: str = "chunking"):
+    """
+    Progress callback reporting a finished chunk to the running job, if
+    any (see GET /jobs/{job_id}/events)
+    """
+    job_queue.report(stage=stage, chunks_done=chunks_done, num_chunks=num_chunks,
+                     **{key: chunk[key] for key in ("chunk_number", "chunk_size", "start_time", "end_time")
+                        if key in chunk})
+
+def deliver_callback(url: str, file_id: str, job: Dict[str, Any]):
+    """
+    POST a finished job to its callback_url and record the delivery on the
+    job; runs on the callback executor, not on a chunking worker
+    """
+    delivery = callbacks.post_callback(url, {"file_id": file_id, **job})
+    job_queue.annotate(job["job_id"], callback=delivery)
+
+def process_staged_upload(file_id: str, staged_path: str, filename: str, **options) -> Dict[str, Any]:
+    """
+    process_upload for an upload staged by a background job
+    
+    The staged file is moved into place as the original where possible
+    instead of being copied, and removed once processing is done.
+    """
+    try:
+        with open(staged_path, "rb") as source:
+            return process_upload(file_id, source, filename, staged_path=staged_path, **options)
+    finally:
+        if os.path.exists(staged_path):
+            os.remove(staged_path)
+
+def process_container(file_id: str, source: BinaryIO, filename: str, kind: str, **options) -> Dict[str, Any]:
+    """
+    Process the audio inside an archive or a video as separate uploads
+    
+    Archive members that look like audio or video are extracted one at a
+    time into STAGING_DIR and each processed as an upload with its own
+    file_id; videos among them are handled like uploaded videos, nested
+    archives are skipped. From a video, every audio stream is copied out
+    with ffmpeg (no re-encoding) and processed the same way. The container
+    itself is not stored, only a record listing what came out of it.
+    
+    Args:
+        file_id: ID of the container upload
+        source: The uploaded archive or video
+        filename: Name of the upload
+        kind: "zip", "tar" or "video", from containers.detect_container
+        options: process_upload options, applied to every extracted file
+    
+    Returns:
+        Manifest of the extracted files keyed by their file_id, like
+        POST /upload/batch returns
+    """
+    container_size = stream_size(source)
+    container_name = "video" if kind == "video" else "archive"
+    results: List[Dict[str, Any]] = []
+    skipped: List[Dict[str, Any]] = []
+    
+    def process_extracted(staged_path: str, source_name: str, name: str):
+        member_id = os.path.basename(staged_path)
+        try:
+            results.append({"source": source_name,
+                            **process_staged_upload(member_id, staged_path, name, unpack=False, **options)})
+        except HTTPException as e:
+            results.append({"file_id": member_id, "source": source_name, "error": e.detail,
+                            "status_code": e.status_code})
+    
+    def process_video(video: BinaryIO, name: str):
+        streams = [stream for stream in probe_streams(video.fileno()) or [] if stream["codec_type"] == "audio"]
+        if not streams:
+            skipped.append({"source": name, "reason": "no audio stream"})
+        stem = os.path.splitext(os.path.basename(name))[0]
+        for n, stream in enumerate(streams):
+            suffix = f"_{n + 1}" if len(streams) > 1 else ""
+            audio_name = f"{stem}{suffix}{demuxed_extension(stream['codec_name'])}"
+            staged_path = os.path.join(STAGING_DIR, str(uuid.uuid4()))
+            try:
+                extract_audio(video.fileno(), staged_path, stream["index"], stream["codec_name"])
+            except RuntimeError as e:
+                skipped.append({"source": f"{name}#{stream['index']}", "reason": str(e)})
+                continue
+            process_extracted(staged_path, f"{name}#{stream['index']}" if suffix else name, audio_name)
+    
+    job_queue.report(stage="unpacking", container=kind)
+    if kind == "video":
+        process_video(source, filename)
+    else:
+        budget = containers.MAX_EXTRACTED_BYTES
+        try:
+            for name, stream in containers.iter_archive(source, kind):
+                if not containers.is_media_name(name):
+                    skipped.append({"source": name, "reason": "not an audio or video file"})
+                    continue
+                if len(results) >= containers.MAX_ARCHIVE_MEMBERS:
+                    skipped.append({"source": name, "reason": "too many files in the archive"})
+                    continue
+                staged_path = os.path.join(STAGING_DIR, str(uuid.uuid4()))
+                try:
+                    budget -= containers.copy_member(stream, staged_path, budget)
+                    with open(staged_path, "rb") as member:
+                        member_kind = containers.detect_container(member.fileno())
+                        if member_kind == "video":
+                            process_video(member, name)
+                except BaseException:
+                    # Keep the original error even if the member was never written
+                    with suppress(FileNotFoundError):
+                        os.remove(staged_path)
+                    raise
+                if member_kind is None:
+                    process_extracted(staged_path, name, os.path.basename(name))
+                    continue
+                os.remove(staged_path)
+                if member_kind != "video":
+                    skipped.append({"source": name, "reason": "nested archive"})
+        except containers.ExtractionLimit as e:
+            if not results:
+                raise HTTPException(status_code=413, detail=str(e))
+            skipped.append({"source": filename, "reason": str(e)})
+        except containers.ArchiveError as e:
+            # Damaged or encrypted archive: keep what was extracted before the error
+            if not results:
+                raise HTTPException(status_code=422, detail=f"Could not read the archive: {e}")
+            skipped.append({"source": filename, "reason": f"could not read the rest of the archive: {e}"})
+    
+    if not results:
+        raise HTTPException(status_code=422, detail=f"No audio found in this {container_name}")
+    
+    file_ids = [result["file_id"] for result in results]
+    failed = sum(1 for result in results if "error" in result)
+    manifest = {
+        "original_filename": filename,
+        "original_size": container_size,
+        "container": kind,
+        "num_files": len(results),
+        "failed": failed,
+        "file_ids": file_ids,
+        "files": {result["file_id"]: result for result in results},
+        "skipped": skipped
+    }
+    # Recorded so GET /chunks/{file_id} of the container lists what came out of it
+    metadata_store.put(file_id, {**manifest, "num_chunks": 0, "storage": options.get("storage"),
+                                 "original_path": None, "chunks": []})
+    return {
+        "file_id": file_id,
+        **manifest,
+        "message": f"Extracted {len(results) - failed} audio file(s) from the {container_name}"
+    }
+
+def _store_original(source: BinaryIO, file_path: str, file_size: int, staged_path: Optional[str]):
+    # A staged upload can simply be moved into place
+    if staged_path is not None and os.path.exists(staged_path):
+        os.replace(staged_path, file_path)
+    else:
+        copy_range(source.fileno(), file_path, 0, file_size)
+
+def find_duplicate(content_key: str) -> Optional[Dict[str, Any]]:
+    """
+    Upload response of an earlier upload with the same content key, if its
+    files are still around
+    """
+    file_id = metadata_store.find_by_hash(content_key)
+    if file_id is None:
+        return None
+    file_info = metadata_store.get(file_id)
+    if file_info is None or not files_present(file_info):
+        # The stored files are gone, so the record can no longer be used
+        metadata_store.delete(file_id)
+        return None
+    
+    response = {"file_id": file_id}
+    response.update((key, value) for key, value in file_info.items()
+                    if key not in ("storage", "original_path", "transcoded_path"))
+    if not file_info.get("chunked", True):
+        del response["num_chunks"], response["chunks"]
+    response.update({
+        "chunked": file_info.get("chunked", True),
+        "deduplicated": True,
+        "message": "Identical file was already uploaded, returning its existing chunks"
+    })
+    return response
+
+def publish_file(path: str) -> Optional[str]:
+    """
+    Copy a stored file to the storage backend under its path relative to WORK_DIR
+    
+    Returns:
+        URL of the copy, or None with the local backend, where the file
+        already is in storage
+    """
+    if file_storage.local_path("") is not None:
+        return None
+    key = os.path.relpath(path, WORK_DIR).replace(os.sep, "/")
+    with open(path, "rb") as f:
+        return file_storage.put_file(key, f.fileno())["url"]
+
+def record_chunks(file_id: str, original_filename: str, original_size: int,
+                  chunks_info: List[Dict[str, Any]], storage: str = "files",
+                  original_path: Optional[str] = None,
+                  extra: Optional[Dict[str, Any]] = None, dedup: bool = False,
+                  content_key: Optional[str] = None,
+                  transcoded_path: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Store information about a chunked file and build the upload response
+    
+    With dedup, chunk files are stored through the content-addressed
+    object store; content_key indexes the record for duplicate uploads.
+    transcoded_path is the transcoded file virtual chunks are ranges of.
+    """
+    extra = dict(extra or {})
+    num_chunks = len(chunks_info)
+    job_queue.report(stage="storing", num_chunks=num_chunks)
+    if dedup:
+        store_chunk_objects(chunks_info, CHUNK_OBJECT_DIR)
+    for chunk in chunks_info:
+        chunk["chunk_url"] = f"/chunks/{file_id}/{chunk['chunk_number']}"
+        if "chunk_path" in chunk:
+            blob_url = publish_file(chunk["chunk_path"])
+            if blob_url:
+                chunk["blob_url"] = blob_url
+    if original_path is not None:
+        original_url = publish_file(original_path)
+        if original_url:
+            extra["original_url"] = original_url
     
     # Store information about this chunked file
-    chunked_files[file_id] = {
-        "original_filename": file.filename,
-        "original_size": file_size,
+    metadata_store.put(file_id, {
+        "original_filename": original_filename,
+        "original_size": original_size,
+        **extra,
         "num_chunks": num_chunks,
+        "storage": storage,
+        "original_path": original_path,
+        **({"transcoded_path": transcoded_path} if transcoded_path else {}),
         "chunks": chunks_info
-    }
+    }, content_hash=content_key)
     
     # Return information about the chunked file
     return {
         "file_id": file_id,
-        "original_filename": file.filename,
-        "original_size": file_size,
+        "original_filename": original_filename,
+        "original_size": original_size,
+        **extra,
         "chunked": True,
         "num_chunks": num_chunks,
         "chunks": chunks_info,
         "message": f"File successfully chunked into {num_chunks} parts"
     }
 
+def segment_upload(file_id: str, source: BinaryIO, filename: str, file_size: int,
+                   keep_original: bool = True, transcode: Optional[str] = None,
+                   dedup: bool = False, content_key: Optional[str] = None,
+                   max_duration: Optional[float] = None, overlap_seconds: float = 0,
+                   staged_path: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """
+    Chunk an upload into time segments with parallel ffmpeg processes
+    
+    Returns:
+        The upload response, or None if the file fits in a single segment
+        and should go through the normal flow instead
+    """
+    duration = probe_duration(source.fileno())
+    if duration is None:
+        raise HTTPException(status_code=422, detail="Could not determine the media duration")
+    segments = plan_segments(duration, file_size, MAX_CHUNK_SIZE, transcode, max_duration, overlap_seconds)
+    if len(segments) == 1:
+        return None
+    
+    file_path = os.path.join(UPLOAD_DIR, f"{file_id}_{filename}")
+    if keep_original:
+        _store_original(source, file_path, file_size, staged_path)
+    
+    # Create a directory for this specific upload's chunks
+    file_chunk_dir = os.path.join(CHUNK_DIR, file_id)
+    os.makedirs(file_chunk_dir, exist_ok=True)
+    
+    chunk_name = transcoded_filename(filename, transcode) if transcode else filename
+    try:
+        chunks_info = segment_file(source.fileno(), file_chunk_dir, chunk_name, segments,
+                                   MAX_CHUNK_SIZE, profile=transcode, on_chunk=report_chunk,
+                                   overlap=overlap_seconds)
+    except RuntimeError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    
+    extra = {"segment_workers": SEGMENT_WORKERS}
+    if transcode:
+        extra.update({
+            "transcoded": transcode,
+            "transcoded_filename": chunk_name,
+            "transcoded_size": sum(chunk["chunk_size"] for chunk in chunks_info)
+        })
+    return record_chunks(file_id, filename, file_size, chunks_info,
+                         original_path=file_path if keep_original else None, extra=extra,
+                         dedup=dedup, content_key=content_key)
+
+def validate_options(storage: str, split: str, transcode: Optional[str], keep_original: bool,
+                     max_duration: Optional[float] = None, overlap_seconds: float = 0):
+    """
+    Check the processing options of an upload
+    
+    Raises:
+        HTTPException: 400 if an option is invalid or unavailable here
+    """
+    if storage not in CHUNK_STORAGE_MODES:
+        raise HTTPException(status_code=400, detail=f"storage must be one of {', '.join(CHUNK_STORAGE_MODES)}")
+    if split not in CHUNK_SPLIT_MODES:
+        raise HTTPException(status_code=400, detail=f"split must be one of {', '.join(CHUNK_SPLIT_MODES)}")
+    if split == "silence" and not silence_available():
+        raise HTTPException(status_code=400, detail="split=silence requires numpy and ffmpeg")
+    if transcode is not None and transcode not in TRANSCODE_PROFILES:
+        raise HTTPException(status_code=400, detail=f"transcode must be one of {', '.join(TRANSCODE_PROFILES)}")
+    if split == "segments" and not segmenting_available():
+        raise HTTPException(status_code=400, detail="split=segments requires ffmpeg and ffprobe")
+    if split == "segments" and storage == "virtual":
+        raise HTTPException(status_code=400, detail="split=segments writes chunk files and cannot use virtual storage")
+    if transcode is not None and not transcode_available():
+        raise HTTPException(status_code=400, detail="transcode requires ffmpeg")
+    if storage == "virtual" and not keep_original:
+        raise HTTPException(status_code=400, detail="Virtual chunks require keep_original=true")
+    if (max_duration or overlap_seconds) and split not in ("frames", "segments"):
+        raise HTTPException(status_code=400, detail="max_duration and overlap_seconds require split=frames or segments")
+    if max_duration is not None and max_duration <= 0:
+        raise HTTPException(status_code=400, detail="max_duration must be positive")
+    if overlap_seconds < 0 or (max_duration and overlap_seconds >= max_duration):
+        raise HTTPException(status_code=400, detail="overlap_seconds must be at least 0 and less than max_duration")
+
+@app.post("/upload", response_model=Dict[str, Any])
+async def upload_file(file: UploadFile = File(...), keep_original: bool = True,
+                      storage: str = CHUNK_STORAGE, split: str = CHUNK_SPLIT,
+                      transcode: Optional[str] = None, background: bool = False,
+                      dedup: bool = DEDUP, max_duration: Optional[float] = None,
+                      overlap_seconds: float = 0, callback_url: Optional[str] = None):
+    """
+    Upload a file and chunk it if larger than 25MB
+    Returns information about the original file and its chunks
+
+    Chunking runs on the job worker pool, so it never blocks other
+    requests. With background=true the upload is staged and the request
+    returns 202 straight away with a job ID; poll GET /jobs/{job_id} for
+    the status and, once completed, the same payload as a normal upload.
+
+    With storage=files, chunk files are produced with kernel-side copies
+    (reflink, copy_file_range or sendfile) where the filesystem allows it.
+    Set keep_original=false to skip storing the original copy of files
+    that need chunking.
+
+    With storage=virtual, no chunk files are written: each chunk is an
+    (offset, length) range of the stored original, served by
+    GET /chunks/{file_id}/{chunk_number}.
+
+    With split=frames, audio files are cut on the last frame/page boundary
+    below 25MB instead of at exact byte offsets, and WAV chunks get their
+    own header, so every chunk can be decoded on its own. split=silence
+    additionally decodes the audio with ffmpeg and picks the quietest
+    frame boundary shortly before each limit, so cuts avoid landing
+    mid-word.
+
+    With transcode=opus16k (or mp3_16k), the audio is first downmixed to
+    mono 16kHz and re-encoded at a speech bitrate; chunking then applies
+    to the transcoded file, which often no longer needs it.
+
+    With split=segments, ffprobe reads the duration and the audio is cut
+    into equal time segments by up to SEGMENT_WORKERS parallel ffmpeg
+    processes, stream-copied or transcoded per segment. This also handles
+    containers the frame splitter does not understand (e.g. M4A).
+
+    With max_duration (seconds), chunks are also cut so none plays for
+    longer; with overlap_seconds, each chunk starts that long before the
+    previous one ends, so words cut at a boundary appear whole in one of
+    them. Both work with split=frames (times read from the frame headers)
+    and split=segments. Chunks then carry start_time/end_time; without
+    these options, split=frames computes them from the bitrate of WAV and
+    constant-bitrate MP3 files ("estimated_times": true) and reads them
+    from the frame headers of other files.
+
+    With dedup=true (the default), an upload whose content and options
+    match an earlier one returns that upload's file_id and chunks with
+    "deduplicated": true, and identical chunk files share disk space.
+
+    Archives (zip, tar, tar.gz) and videos (MP4/MOV, MKV/WebM, AVI with
+    a video stream) are unpacked: each audio file in the archive, and
+    each audio stream of the video (copied out without re-encoding), is
+    processed as its own upload with its own file_id. The response then
+    lists them keyed by file_id, like POST /upload/batch.
+
+    With callback_url, the upload is always processed in the background
+    and the finished job (the GET /jobs/{job_id} payload plus file_id) is
+    POSTed to that URL, with retries. GET /jobs/{job_id}/events streams
+    the job's progress as Server-Sent Events.
+    """
+    validate_options(storage, split, transcode, keep_original, max_duration, overlap_seconds)
+    if callback_url is not None and not await aio.run_io(callbacks.valid_callback_url, callback_url):
+        raise HTTPException(status_code=400, detail="callback_url must be an http(s) URL of a public or "
+                                                    "allowed host (see CALLBACK_ALLOWED_HOSTS)")
+    
+    # Generate a unique ID for this upload
+    file_id = str(uuid.uuid4())
+    options = {"keep_original": keep_original, "storage": storage, "split": split, "transcode": transcode,
+               "dedup": dedup, "max_duration": max_duration, "overlap_seconds": overlap_seconds}
+    
+    if not background and callback_url is None:
+        return await job_queue.run(process_upload, file_id, file.file, file.filename, **options)
+    
+    # Persist the upload before the request (and its temporary file) goes away
+    staged_path = os.path.join(STAGING_DIR, file_id)
+    await aio.run_io(copy_range, file.file.fileno(), staged_path, 0, stream_size(file.file))
+    on_finish = None
+    if callback_url is not None:
+        on_finish = lambda job: callbacks.callback_executor.submit(deliver_callback, callback_url, file_id, job)
+    job = await aio.run_io(job_queue.submit, process_staged_upload, file_id, staged_path, file.filename,
+                           on_finish=on_finish, **options)
+    
+    return JSONResponse(status_code=202, content={
+        "job_id": job["job_id"],
+        "file_id": file_id,
+        "status": job["status"],
+        "status_url": f"/jobs/{job['job_id']}",
+        "events_url": f"/jobs/{job['job_id']}/events",
+        "message": "File accepted for chunking"
+    })
+
+@app.post("/upload/batch", response_model=Dict[str, Any])
+async def upload_batch(files: List[UploadFile] = File(...), keep_original: bool = True,
+                       storage: str = CHUNK_STORAGE, split: str = CHUNK_SPLIT,
+                       transcode: Optional[str] = None, dedup: bool = DEDUP,
+                       max_duration: Optional[float] = None, overlap_seconds: float = 0):
+    """
+    Upload several files in one multipart request and chunk them concurrently
+    
+    Every file goes through the same processing as POST /upload, with the
+    same options, and all of them are chunked in parallel on the job worker
+    pool. Returns one manifest: the /upload response of each file keyed by
+    file_id, plus file_ids in upload order. Identical files (with dedup)
+    share one entry, and num_files counts entries, not uploaded files. A
+    file that fails does not fail the batch; its entry holds the error
+    instead.
+    """
+    validate_options(storage, split, transcode, keep_original, max_duration, overlap_seconds)
+    if len(files) > MAX_BATCH_FILES:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_FILES} files per batch")
+    
+    options = {"keep_original": keep_original, "storage": storage, "split": split, "transcode": transcode,
+               "dedup": dedup, "max_duration": max_duration, "overlap_seconds": overlap_seconds}
+    file_ids = [str(uuid.uuid4()) for _ in files]
+    results = await asyncio.gather(*(
+        job_queue.run(process_upload, file_id, file.file, file.filename, **options)
+        for file_id, file in zip(file_ids, files)
+    ), return_exceptions=True)
+    
+    manifest = {}
+    for i, (file, result) in enumerate(zip(files, results)):
+        if isinstance(result, HTTPException):
+            result = {"file_id": file_ids[i], "original_filename": file.filename,
+                      "error": result.detail, "status_code": result.status_code}
+        elif isinstance(result, Exception):
+            result = {"file_id": file_ids[i], "original_filename": file.filename,
+                      "error": str(result), "status_code": 500}
+        # A deduplicated file is listed under the ID of its earlier upload,
+        # so identical files in one batch share a single entry
+        manifest.setdefault(result["file_id"], result)
+    
+    failed = sum(1 for result in manifest.values() if "error" in result)
+    merged = len(files) - len(manifest)
+    return {
+        "num_files": len(manifest),
+        "failed": failed,
+        "deduplicated": merged,
+        "file_ids": list(manifest),
+        "files": manifest,
+        "message": f"Processed {len(manifest) - failed} of {len(manifest)} files" +
+                   (f" ({merged} identical uploads merged)" if merged else "")
+    }
+
+def upload_status(state: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Public view of a resumable upload's state
+    """
+    status = {
+        "upload_id": state["upload_id"],
+        "file_id": state["upload_id"],
+        "filename": state["filename"],
+        "length": state["length"],
+        "offset": upload_offset(state),
+        "received": state["received"],
+        "status": state["status"],
+        "job_id": state["job_id"]
+    }
+    if state["job_id"]:
+        status["status_url"] = f"/jobs/{state['job_id']}"
+    return status
+
+@app.post("/uploads", status_code=201)
+async def create_resumable_upload(filename: str, length: int, keep_original: bool = True,
+                                  storage: str = CHUNK_STORAGE, split: str = CHUNK_SPLIT,
+                                  transcode: Optional[str] = None, dedup: bool = DEDUP,
+                                  max_duration: Optional[float] = None, overlap_seconds: float = 0):
+    """
+    Start a resumable upload of a file of length bytes
+    
+    Send the data with PATCH /uploads/{upload_id} in one or more parts, in
+    any order and in parallel if you like, each with an Upload-Offset
+    header. HEAD /uploads/{upload_id} returns the offset to resume from
+    after a dropped connection. Once every byte has arrived the file is
+    chunked in the background with the options given here (see /upload);
+    the upload then has a job_id to poll. Uploads are removed
+    RESUMABLE_UPLOAD_TTL seconds after their last part or status change.
+    """
+    validate_options(storage, split, transcode, keep_original, max_duration, overlap_seconds)
+    if length <= 0:
+        raise HTTPException(status_code=400, detail="length must be positive")
+    if length > MAX_UPLOAD_SIZE:
+        raise HTTPException(status_code=413, detail=f"length must be at most {MAX_UPLOAD_SIZE} bytes")
+    
+    await aio.run_io(expire_uploads, INCOMING_DIR)
+    upload_id = str(uuid.uuid4())
+    options = {"keep_original": keep_original, "storage": storage, "split": split, "transcode": transcode,
+               "dedup": dedup, "max_duration": max_duration, "overlap_seconds": overlap_seconds}
+    # Parts are written straight into the staged file that is moved into place once complete
+    state = await aio.run_io(create_upload, INCOMING_DIR, upload_id, filename, length, options)
+    
+    return JSONResponse(status_code=201, headers={"location": f"/uploads/{upload_id}"},
+                        content={**upload_status(state), "upload_url": f"/uploads/{upload_id}"})
+
+@app.head("/uploads/{upload_id}")
+async def resumable_upload_offset(upload_id: str):
+    """
+    Offset to resume a resumable upload from (Upload-Offset header)
+    """
+    state = await aio.run_io(read_upload, INCOMING_DIR, upload_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail="Upload ID not found")
+    return Response(headers={
+        "upload-offset": str(upload_offset(state)),
+        "upload-length": str(state["length"]),
+        "cache-control": "no-store"
+    })
+
+@app.get("/uploads/{upload_id}")
+async def get_resumable_upload(upload_id: str):
+    """
+    State of a resumable upload, including every byte range received so far
+    """
+    state = await aio.run_io(read_upload, INCOMING_DIR, upload_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail="Upload ID not found")
+    return upload_status(state)
+
+@app.patch("/uploads/{upload_id}")
+async def patch_resumable_upload(upload_id: str, request: Request):
+    """
+    Write the request body into a resumable upload at the Upload-Offset header
+    
+    Whatever arrives is kept even if the connection drops part way, so the
+    client can resume from the offset returned by HEAD. The part that
+    completes the upload starts the chunking job.
+    """
+    state = await aio.run_io(read_upload, INCOMING_DIR, upload_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail="Upload ID not found")
+    if state["status"] != "uploading":
+        raise HTTPException(status_code=409, detail="Upload is already complete")
+    try:
+        start = int(request.headers["upload-offset"])
+    except (KeyError, ValueError):
+        raise HTTPException(status_code=400, detail="Upload-Offset header is required")
+    if not 0 <= start <= state["length"]:
+        raise HTTPException(status_code=400, detail="Upload-Offset is outside the file")
+    
+    # Write the body as it arrives, in blocks of about COPY_BUFFER_SIZE
+    path = data_path(INCOMING_DIR, upload_id)
+    fd = await aio.run_io(os.open, path, os.O_WRONLY)
+    position = start
+    buffer = bytearray()
+    try:
+        async for block in request.stream():
+            if position + len(buffer) + len(block) > state["length"]:
+                raise HTTPException(status_code=413, detail="Part extends past Upload-Length")
+            buffer += block
+            if len(buffer) >= COPY_BUFFER_SIZE:
+                await aio.run_io(os.pwrite, fd, buffer, position)
+                position += len(buffer)
+                buffer = bytearray()
+        if buffer:
+            await aio.run_io(os.pwrite, fd, buffer, position)
+            position += len(buffer)
+    finally:
+        os.close(fd)
+        state, completed = await aio.run_io(record_part, INCOMING_DIR, upload_id, start, position)
+    if state is None:
+        raise HTTPException(status_code=404, detail="Upload ID not found")
+    
+    if completed:
+        # The upload ends up completed or failed along with its job
+        on_finish = lambda job: update_upload(INCOMING_DIR, upload_id, status=job["status"])
+        job = await aio.run_io(job_queue.submit, process_staged_upload, upload_id, path, state["filename"],
+                               on_finish=on_finish, **state["options"])
+        state = await aio.run_io(update_upload, INCOMING_DIR, upload_id, job_id=job["job_id"])
+    
+    return JSONResponse(content=upload_status(state), headers={"upload-offset": str(upload_offset(state))})
+
+@app.get("/chunks")
+async def get_chunks_batch(ids: str):
+    """
+    Get the chunk information of several files at once
+    
+    ids is a comma-separated list of file IDs; the records are read from
+    the metadata store in a single lookup. Unknown IDs are listed in
+    "missing" rather than failing the request.
+    """
+    file_ids = list(dict.fromkeys(file_id.strip() for file_id in ids.split(",") if file_id.strip()))
+    if not file_ids:
+        raise HTTPException(status_code=400, detail="ids must list at least one file ID")
+    if len(file_ids) > MAX_BATCH_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_IDS} IDs per request")
+    
+    records = await aio.run_io(metadata_store.get_many, file_ids)
+    return {
+        "files": {file_id: records[file_id] for file_id in file_ids if file_id in records},
+        "missing": [file_id for file_id in file_ids if file_id not in records]
+    }
+
 @app.get("/chunks/{file_id}")
 async def get_chunks(file_id: str):
     """
     Get information about chunks for a specific file ID
     """
-    if file_id not in chunked_files:
+    file_info = await aio.run_io(metadata_store.get, file_id)
+    if file_info is None:
         raise HTTPException(status_code=404, detail="File ID not found")
     
-    return chunked_files[file_id]
+    return file_info
+
+def stored_path(file_info: Dict[str, Any]) -> Optional[str]:
+    """
+    File holding the audio of an upload: the transcoded file if one was
+    kept, otherwise the original
+    """
+    return file_info.get("transcoded_path") or file_info["original_path"]
+
+def file_chunks(file_info: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Chunks of an upload; one stored unchunked counts as a single chunk
+    covering the whole stored file
+    """
+    if file_info.get("chunked", True):
+        return file_info["chunks"]
+    path = stored_path(file_info)
+    return [{"chunk_number": 1, "chunk_filename": file_info.get("transcoded_filename", file_info["original_filename"]),
+             "chunk_path": path, "chunk_size": os.path.getsize(path) if os.path.exists(path) else 0}]
+
+def chunk_source(file_info: Dict[str, Any], chunk: Dict[str, Any]):
+    """
+    Resolve a chunk to header bytes plus a byte range of a file on disk
+    
+    Returns:
+        (path, offset, header); the range is chunk_size - len(header) bytes long
+    """
+    if "offset" in chunk:
+        return stored_path(file_info), chunk["offset"], chunk_header(chunk)
+    return chunk["chunk_path"], 0, b""
+
+def reject_container(file_info: Dict[str, Any]):
+    """
+    Refuse to treat an unpacked archive or video as audio; its audio has
+    file IDs of its own
+    """
+    if "container" in file_info:
+        raise HTTPException(status_code=400, detail=f"This upload was a {file_info['container']} container; "
+                                                    f"use the file IDs in file_ids: {', '.join(file_info['file_ids'])}")
+
+def archive_members(file_id: str, file_info: Dict[str, Any], with_crc: bool) -> List[Dict[str, Any]]:
+    """
+    Archive members for the chunks of a file (or the file itself if it
+    was not chunked)
+    
+    With with_crc, each member gets the CRC-32 ZIP needs. It is computed
+    on first use and remembered in the chunk's metadata, like the ETag.
+    """
+    chunks = file_chunks(file_info)
+    members = []
+    for chunk in chunks:
+        path, offset, header = chunk_source(file_info, chunk)
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Chunk data not found")
+        member = {"name": chunk["chunk_filename"], "path": path, "offset": offset,
+                  "length": chunk["chunk_size"] - len(header), "header": header, "mtime": mtime}
+        if with_crc:
+            if "crc32" not in chunk:
+                with open(path, "rb") as f:
+                    chunk["crc32"] = archive.crc32_fd(f.fileno(), offset, member["length"], header)
+                if file_info.get("chunked", True):
+                    metadata_store.update_chunk(file_id, chunk["chunk_number"], {"crc32": chunk["crc32"]})
+            member["crc32"] = chunk["crc32"]
+        members.append(member)
+    return members
+
+@app.api_route("/chunks/{file_id}/archive", methods=["GET", "HEAD"])
+async def download_archive(file_id: str, archive_format: str = Query("tar", alias="format")):
+    """
+    Download all chunks of a file as one tar or zip archive
+    
+    The archive is laid out from the chunk sizes up front and streamed
+    straight from the chunk files (or the original, for virtual chunks)
+    with sendfile where possible: no temporary file, constant memory, and
+    an exact Content-Length. ZIP members are stored uncompressed; their
+    CRC-32 is computed once per chunk and then kept in the metadata.
+    """
+    if archive_format not in archive.ARCHIVE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(archive.ARCHIVE_FORMATS)}")
+    file_info = await aio.run_io(metadata_store.get, file_id)
+    if file_info is None:
+        raise HTTPException(status_code=404, detail="File ID not found")
+    
+    reject_container(file_info)
+    
+    members = await aio.run_io(archive_members, file_id, file_info, archive_format == "zip")
+    if archive_format == "zip":
+        parts, media_type = archive.zip_parts(members), "application/zip"
+    else:
+        parts, media_type = archive.tar_parts(members), "application/x-tar"
+    
+    name = os.path.splitext(file_info["original_filename"])[0] or file_id
+    headers = {"content-disposition": content_disposition(f"{name}_chunks.{archive_format}")}
+    return ConcatResponse(parts, headers=headers, media_type=media_type)
+
+@app.api_route("/chunks/{file_id}/{chunk_number}", methods=["GET", "HEAD"])
+async def download_chunk(file_id: str, chunk_number: int, request: Request):
+    """
+    Download the contents of a single chunk
+    
+    Chunk files are streamed from disk; virtual chunks are streamed
+    straight out of the stored original. Supports Range / If-Range for
+    resuming and a strong ETag (SHA-256 of the chunk) with If-None-Match,
+    so a client that already has the chunk gets a 304 instead of the data.
+    An upload stored unchunked is served as its only chunk, number 1.
+    """
+    file_info = await aio.run_io(metadata_store.get, file_id)
+    if file_info is None:
+        raise HTTPException(status_code=404, detail="File ID not found")
+    
+    chunks = await aio.run_io(file_chunks, file_info)
+    if not 1 <= chunk_number <= len(chunks):
+        raise HTTPException(status_code=404, detail="Chunk not found")
+    chunk = chunks[chunk_number - 1]
+    
+    path, offset, header = chunk_source(file_info, chunk)
+    size = chunk["chunk_size"]
+    if not await aio.exists(path):
+        raise HTTPException(status_code=404, detail="Chunk data not found")
+    
+    # Hash the chunk on first download and remember it for the ETag
+    if "sha256" not in chunk:
+        chunk["sha256"] = await aio.run_io(hash_range, path, offset, size - len(header), header)
+        if file_info.get("chunked", True):
+            await aio.run_io(metadata_store.update_chunk, file_id, chunk_number, {"sha256": chunk["sha256"]})
+    etag = f'"{chunk["sha256"]}"'
+    
+    headers = {
+        "accept-ranges": "bytes",
+        "etag": etag,
+        "content-disposition": content_disposition(chunk["chunk_filename"]),
+    }
+    media_type = mimetypes.guess_type(chunk["chunk_filename"])[0] or "application/octet-stream"
+    
+    # The client already has this exact chunk
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"etag": etag, "accept-ranges": "bytes"})
+    
+    # Only resume a partial download if the chunk has not changed since (If-Range)
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if if_range is not None and if_range.strip() != etag:
+        range_header = None
+    
+    try:
+        byte_range = parse_range(range_header, size)
+    except RangeNotSatisfiable:
+        return Response(status_code=416, headers={"content-range": f"bytes */{size}", "etag": etag})
+    
+    if byte_range is None:
+        return FileRangeResponse(path, offset, size - len(header), headers=headers,
+                                 media_type=media_type, header=header)
+    
+    # Split the requested range between the header bytes and the file range
+    start, end = byte_range
+    headers["content-range"] = f"bytes {start}-{end}/{size}"
+    file_start = max(0, start - len(header))
+    file_end = max(0, end + 1 - len(header))
+    return FileRangeResponse(path, offset + file_start, file_end - file_start, status_code=206,
+                             headers=headers, media_type=media_type, header=header[start:end + 1])
+
+def get_asr_backend() -> asr.ASRBackend:
+    global asr_backend
+    if asr_backend is None:
+        try:
+            asr_backend = asr.create_backend()
+        except (RuntimeError, ValueError) as e:
+            raise HTTPException(status_code=503, detail=f"Transcription is not available: {e}")
+    return asr_backend
+
+def read_chunk_data(file_info: Dict[str, Any], chunk: Dict[str, Any]) -> bytes:
+    """
+    Full contents of a chunk, header included
+    """
+    path, offset, header = chunk_source(file_info, chunk)
+    with open(path, "rb") as f:
+        return header + os.pread(f.fileno(), chunk["chunk_size"] - len(header), offset)
+
+def transcribe_file(file_id: str, language: Optional[str] = None, prompt: Optional[str] = None,
+                    model: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Transcribe every chunk of an upload and merge the transcripts
+    
+    Chunks are sent to the ASR backend ASR_CONCURRENCY at a time, unless
+    the transcript cache already has their content; see
+    asr.transcribe_chunks and asr.merge_transcripts.
+    
+    Returns:
+        The merged text and timed segments, plus the text of each chunk
+    """
+    file_info = metadata_store.get(file_id)
+    if file_info is None:
+        raise HTTPException(status_code=404, detail="File ID not found")
+    reject_container(file_info)
+    
+    chunks = file_chunks(file_info)
+    if not all(os.path.exists(chunk_source(file_info, chunk)[0]) for chunk in chunks):
+        raise HTTPException(status_code=404, detail="Chunk data not found")
+    
+    backend = get_asr_backend()
+    options = {"language": language, "prompt": prompt, "model": model}
+    try:
+        results = asr.transcribe_chunks(backend, chunks, lambda chunk: read_chunk_data(file_info, chunk), options,
+                                        cache=transcript_cache,
+                                        on_chunk=lambda chunk, done, total: report_chunk(chunk, done, total,
+                                                                                         "transcribing"))
+    except asr.ASRError as e:
+        raise HTTPException(status_code=502, detail=f"Transcription failed: {e}")
+    
+    transcript = asr.merge_transcripts(chunks, results)
+    return {
+        "file_id": file_id,
+        "backend": backend.name,
+        "num_chunks": len(chunks),
+        "cached_chunks": sum(1 for result in results if result.get("cached")),
+        "text": transcript["text"],
+        "segments": transcript["segments"],
+        "chunks": [{"chunk_number": chunk["chunk_number"], "text": result.get("text", ""),
+                    **({"start_time": chunk["start_time"], "end_time": chunk["end_time"]}
+                       if "start_time" in chunk else {})}
+                   for chunk, result in zip(chunks, results)]
+    }
+
+@app.get("/transcribe/cache")
+async def transcript_cache_stats():
+    """
+    Size and hit/miss/eviction counters of the transcript cache
+    """
+    if transcript_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **await aio.run_io(transcript_cache.stats)}
+
+@app.post("/transcribe/{file_id}")
+async def transcribe(file_id: str, language: Optional[str] = None, prompt: Optional[str] = None,
+                     model: Optional[str] = None, background: bool = False):
+    """
+    Transcribe an uploaded file chunk by chunk
+    
+    Chunks are sent to the ASR backend (ASR_BACKEND) in parallel, with
+    retries that back off on rate limits, and the transcripts are merged
+    in chunk order. Segment times are offset by each chunk's start_time
+    (or the durations of the chunks before it), and the overlap between
+    overlapping chunks is kept only once. Chunks whose content was
+    transcribed before with the same parameters come from the transcript
+    cache instead of the backend.
+    
+    With background=true the request returns 202 with a job ID; poll
+    GET /jobs/{job_id} for the transcript.
+    """
+    if await aio.run_io(metadata_store.get, file_id) is None:
+        raise HTTPException(status_code=404, detail="File ID not found")
+    
+    options = {"language": language, "prompt": prompt, "model": model}
+    if not background:
+        return await job_queue.run(transcribe_file, file_id, **options)
+    
+    job = await aio.run_io(job_queue.submit, transcribe_file, file_id, **options)
+    return JSONResponse(status_code=202, content={
+        "job_id": job["job_id"],
+        "file_id": file_id,
+        "status": job["status"],
+        "status_url": f"/jobs/{job['job_id']}",
+        "events_url": f"/jobs/{job['job_id']}/events",
+        "message": "File accepted for transcription"
+    })
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """
+    Get the status of a background chunking job
+    
+    Once the job is completed, "result" holds the upload payload
+    (file_id, chunks, ...); a failed job has an "error" message.
+    """
+    job = await aio.run_io(job_queue.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job ID not found")
+    return job
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str, request: Request):
+    """
+    Stream the progress of a background job as Server-Sent Events
+    
+    Each event has the job's event number as its id and its type
+    ("status" or "progress") as the event name; the data is the event as
+    JSON. Status events follow the job through queued, running and
+    completed/failed, the last one carrying the result or error. Progress
+    events report each chunk as it is written or transcribed. The stream
+    ends after the final status; a reconnecting client sends
+    Last-Event-ID to skip the events it already has.
+    """
+    if await aio.run_io(job_queue.get, job_id) is None:
+        raise HTTPException(status_code=404, detail="Job ID not found")
+    try:
+        after = int(request.headers.get("last-event-id", "-1"))
+    except ValueError:
+        after = -1
+    
+    async def stream():
+        async for event in job_queue.events(job_id, after, heartbeat=SSE_HEARTBEAT):
+            if event is None:
+                yield ": keep-alive\n\n"
+            else:
+                yield f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
+    
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"cache-control": "no-cache", "x-accel-buffering": "no"})
 
 @app.get("/health")
 async def health_check():
@@ -2,34 +2,57 @@ import os
 import math
 import uuid
 import json
-from typing import List, Dict, Any
+import random
+import asyncio
+import logging
+from typing import Awaitable, Callable, List, Dict, Any, Optional
 from fastapi import FastAPI, UploadFile, File, Request, HTTPException
 from fastapi.responses import JSONResponse
+from fastapi.concurrency import run_in_threadpool
 
-# Note: Uncomment and use the appropriate cloud storage SDK
-# For Vercel Blob Storage:
-# from vercel_blob import PutBlobResult, del_blob, get_blob, list_blobs, put_blob
+from cache import TTLCache
+from chunking import stream_size
+from metadata import create_store
+from storage import IncompleteUpload, create_storage
 
-# For AWS S3:
-# import boto3
-# s3_client = boto3.client('s3')
-# S3_BUCKET_NAME = os.environ.get('S3_BUCKET_NAME', 'your-bucket-name')
-
-# For Google Cloud Storage:
-# from google.cloud import storage
-# storage_client = storage.Client()
-# GCS_BUCKET_NAME = os.environ.get('GCS_BUCKET_NAME', 'your-bucket-name')
+logger = logging.getLogger(__name__)
 
 app = FastAPI(title="File Chunker API", 
               description="Service to chunk large files into smaller pieces for Whisper transcription")
 
 MAX_CHUNK_SIZE = 25 * 1024 * 1024  # 25MB in bytes
 
-# Store information about chunked files (in-memory cache, will be lost on cold starts)
-chunked_files = {}
+# Chunks uploaded to cloud storage at the same time, and how often a failed
+# chunk upload is retried (with jittered exponential backoff from
+# UPLOAD_BACKOFF seconds)
+UPLOAD_CONCURRENCY = int(os.environ.get("UPLOAD_CONCURRENCY", "4"))
+UPLOAD_RETRIES = int(os.environ.get("UPLOAD_RETRIES", "3"))
+UPLOAD_BACKOFF = float(os.environ.get("UPLOAD_BACKOFF", "0.5"))
+
+# Presigned upload URLs stay valid this long; files larger than
+# PRESIGN_PART_SIZE get one URL per part (S3 needs at least 5MB per part)
+PRESIGN_EXPIRES = int(os.environ.get("PRESIGN_EXPIRES", "3600"))
+PRESIGN_PART_SIZE = max(5 * 1024 * 1024, int(os.environ.get("PRESIGN_PART_SIZE", str(64 * 1024 * 1024))))
+
+# Cloud storage holds the metadata of every chunked file. Set METADATA_STORE
+# (e.g. sqlite with METADATA_DB on a shared path) to also keep it in a
+# metadata store that is checked before cloud storage
+metadata_store = create_store(os.environ["METADATA_STORE"]) if "METADATA_STORE" in os.environ else None
+
+# Bounded in-memory cache in front of the lookups above, so repeated polls
+# for the same file don't each cost a blob-store round trip. Unknown IDs
+# are remembered for a shorter time.
+metadata_cache = TTLCache(
+    maxsize=int(os.environ.get("METADATA_CACHE_SIZE", "1024")),
+    ttl=float(os.environ.get("METADATA_CACHE_TTL", "300")),
+    negative_ttl=float(os.environ.get("METADATA_CACHE_NEGATIVE_TTL", "30")),
+)
+
+# Cloud storage for uploads, chunks and metadata (see STORAGE_BACKEND). The
+# local backend defaults to /tmp, the only writable directory on Vercel
+file_storage = create_storage(root=os.environ.get("STORAGE_ROOT", "/tmp/file-chunker"))
 
 # Helper functions for cloud storage operations
-# Implement these functions based on your chosen cloud storage provider
 
 async def upload_to_cloud(file_path: str, content: bytes) -> Dict[str, Any]:
     """
@@ -37,29 +60,13 @@ async def upload_to_cloud(file_path: str, content: bytes) -> Dict[str, Any]:
     
     Args:
         file_path: Path/key for the file in cloud storage
-        content: File content as bytes
+        content: File content as bytes, or a memoryview over a buffer that is
+            reused once this returns
         
     Returns:
         Dict with information about the uploaded file, including URL
     """
-    # Example implementation for Vercel Blob Storage:
-    # blob_result = await put_blob(file_path, content)
-    # return {"url": blob_result.url, "path": file_path}
-    
-    # Example implementation for AWS S3:
-    # s3_client.put_object(Bucket=S3_BUCKET_NAME, Key=file_path, Body=content)
-    # url = f"https://{S3_BUCKET_NAME}.s3.amazonaws.com/{file_path}"
-    # return {"url": url, "path": file_path}
-    
-    # Example implementation for Google Cloud Storage:
-    # bucket = storage_client.bucket(GCS_BUCKET_NAME)
-    # blob = bucket.blob(file_path)
-    # blob.upload_from_string(content)
-    # url = f"https://storage.googleapis.com/{GCS_BUCKET_NAME}/{file_path}"
-    # return {"url": url, "path": file_path}
-    
-    # Placeholder implementation (replace with actual implementation)
-    return {"url": f"https://example.com/{file_path}", "path": file_path}
+    return await run_in_threadpool(file_storage.put, file_path, content)
 
 async def get_from_cloud(file_path: str) -> bytes:
     """
@@ -71,21 +78,42 @@ async def get_from_cloud(file_path: str) -> bytes:
     Returns:
         File content as bytes
     """
-    # Example implementation for Vercel Blob Storage:
-    # blob = await get_blob(file_path)
-    # return await blob.arrayBuffer()
-    
-    # Example implementation for AWS S3:
-    # response = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=file_path)
-    # return response['Body'].read()
+    try:
+        return await run_in_threadpool(file_storage.get, file_path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found in cloud storage")
+
+async def upload_with_retry(file_path: str, content: bytes) -> Dict[str, Any]:
+    """
+    upload_to_cloud, retried up to UPLOAD_RETRIES times on failure
     
-    # Example implementation for Google Cloud Storage:
-    # bucket = storage_client.bucket(GCS_BUCKET_NAME)
-    # blob = bucket.blob(file_path)
-    # return blob.download_as_bytes()
+    Waits a random time of up to UPLOAD_BACKOFF * 2^attempt seconds before
+    each retry ("full jitter"), so chunks that failed together don't all
+    retry at the same moment.
+    """
+    for attempt in range(UPLOAD_RETRIES + 1):
+        try:
+            return await upload_to_cloud(file_path, content)
+        except Exception:
+            if attempt == UPLOAD_RETRIES:
+                raise
+            await asyncio.sleep(random.uniform(0, UPLOAD_BACKOFF * 2 ** attempt))
+
+def read_into(stream, buffer: bytearray) -> int:
+    """
+    Fill buffer from stream, stopping early only at the end of the stream
     
-    # Placeholder implementation (replace with actual implementation)
-    raise HTTPException(status_code=404, detail="File not found in cloud storage")
+    Returns:
+        Number of bytes read
+    """
+    view = memoryview(buffer)
+    filled = 0
+    while filled < len(buffer):
+        n = stream.readinto(view[filled:])
+        if not n:
+            break
+        filled += n
+    return filled
 
 @app.post("/process")
 async def process(request: Request):
@@ -102,9 +130,9 @@ async def upload_file(file: UploadFile = File(...)):
     # Generate a unique ID for this upload
     file_id = str(uuid.uuid4())
     
-    # Read the file content
-    file_content = await file.read()
-    file_size = len(file_content)
+    # The upload has already been spooled to a temporary file; chunks are
+    # read from there one at a time instead of loading the whole file
+    file_size = await run_in_threadpool(stream_size, file.file)
     
     # Create a unique path for this file
     file_path = f"uploads/{file_id}/{file.filename}"
@@ -113,7 +141,7 @@ async def upload_file(file: UploadFile = File(...)):
     if file_size <= MAX_CHUNK_SIZE:
         # File is small enough, no need to chunk
         # Upload to cloud storage
-        blob_result = await upload_to_cloud(file_path, file_content)
+        blob_result = await upload_to_cloud(file_path, await file.read())
         
         return {
             "file_id": file_id,
@@ -124,53 +152,92 @@ async def upload_file(file: UploadFile = File(...)):
             "message": "File is under 25MB, no chunking needed"
         }
     
+    # Chunks are read from the spooled file in order, into the upload buffers
+    await run_in_threadpool(file.file.seek, 0)
+    
+    async def read_chunk(offset: int, buffer: bytearray) -> int:
+        return await run_in_threadpool(read_into, file.file, buffer)
+    
+    return await chunk_to_cloud(file_id, file.filename, file_size, read_chunk)
+
+async def chunk_to_cloud(file_id: str, filename: str, file_size: int,
+                         read_chunk: Callable[[int, bytearray], Awaitable[int]]) -> Dict[str, Any]:
+    """
+    Split a file into chunks in cloud storage and store its metadata
+    
+    Args:
+        file_id: ID of the file
+        filename: Name the chunk filenames are built from
+        file_size: Size of the file in bytes
+        read_chunk: Reads the chunk at an offset into a buffer and returns
+            its size; called for each chunk in order
+        
+    Returns:
+        Information about the original file and its chunks
+    """
     # Calculate number of chunks needed
     num_chunks = math.ceil(file_size / MAX_CHUNK_SIZE)
-    chunks_info = []
     
-    # Process the file in memory and create chunks
-    for i in range(num_chunks):
-        # Calculate chunk boundaries
-        start = i * MAX_CHUNK_SIZE
-        end = min(start + MAX_CHUNK_SIZE, file_size)
-        
-        # Extract chunk data
-        chunk_data = file_content[start:end]
-        chunk_size = len(chunk_data)
-        
-        # Create chunk filename
-        chunk_filename = f"chunk_{i+1}_of_{num_chunks}_{file.filename}"
-        chunk_path = f"chunks/{file_id}/{chunk_filename}"
-        
-        # Upload chunk to cloud storage
-        blob_result = await upload_to_cloud(chunk_path, chunk_data)
-        
-        # Store chunk info
-        chunks_info.append({
-            "chunk_number": i + 1,
-            "chunk_filename": chunk_filename,
-            "chunk_path": chunk_path,
-            "chunk_size": chunk_size,
-            "blob_url": blob_result["url"]
-        })
-    
-    # Store information about this chunked file (in memory - will be lost on cold starts)
-    chunked_files[file_id] = {
-        "original_filename": file.filename,
+    # One reusable chunk-sized buffer per upload slot. Reading the next chunk
+    # waits for an upload to hand its buffer back, so at most
+    # UPLOAD_CONCURRENCY chunks are in memory (and in flight) at once
+    buffers: asyncio.Queue = asyncio.Queue()
+    for _ in range(max(1, min(UPLOAD_CONCURRENCY, num_chunks))):
+        buffers.put_nowait(bytearray(MAX_CHUNK_SIZE))
+    
+    async def upload_chunk(i: int, buffer: bytearray, chunk_size: int) -> Dict[str, Any]:
+        try:
+            # Create chunk filename
+            chunk_filename = f"chunk_{i+1}_of_{num_chunks}_{filename}"
+            chunk_path = f"chunks/{file_id}/{chunk_filename}"
+            
+            # Upload chunk to cloud storage straight from the buffer
+            blob_result = await upload_with_retry(chunk_path, memoryview(buffer)[:chunk_size])
+            
+            return {
+                "chunk_number": i + 1,
+                "chunk_filename": chunk_filename,
+                "chunk_path": chunk_path,
+                "chunk_size": chunk_size,
+                "blob_url": blob_result["url"]
+            }
+        finally:
+            buffers.put_nowait(buffer)
+    
+    # gather keeps the results in chunk_number order whatever order the
+    # uploads finish in; if one chunk fails for good, cancel the rest
+    tasks = []
+    try:
+        for i in range(num_chunks):
+            buffer = await buffers.get()
+            chunk_size = await read_chunk(i * MAX_CHUNK_SIZE, buffer)
+            tasks.append(asyncio.ensure_future(upload_chunk(i, buffer, chunk_size)))
+        chunks_info = await asyncio.gather(*tasks)
+    except Exception as e:
+        for task in tasks:
+            task.cancel()
+        raise HTTPException(status_code=502, detail=f"Failed to upload chunks to cloud storage: {e}")
+    
+    # Store information about this chunked file
+    file_info = {
+        "original_filename": filename,
         "original_size": file_size,
         "num_chunks": num_chunks,
         "chunks": chunks_info
     }
+    if metadata_store is not None:
+        metadata_store.put(file_id, file_info)
     
     # Also store the chunked file info in cloud storage for persistence
     metadata_path = f"metadata/{file_id}.json"
-    metadata_content = json.dumps(chunked_files[file_id]).encode()
+    metadata_content = json.dumps(file_info).encode()
     await upload_to_cloud(metadata_path, metadata_content)
+    metadata_cache.set(file_id, file_info)
     
     # Return information about the chunked file
     return {
         "file_id": file_id,
-        "original_filename": file.filename,
+        "original_filename": filename,
         "original_size": file_size,
         "chunked": True,
         "num_chunks": num_chunks,
@@ -178,22 +245,123 @@ async def upload_file(file: UploadFile = File(...)):
         "message": f"File successfully chunked into {num_chunks} parts"
     }
 
+@app.post("/uploads/presign")
+async def presign_upload(filename: str, size: int):
+    """
+    Get presigned URLs to upload a file straight to cloud storage
+    
+    Files up to PRESIGN_PART_SIZE get a single "url" to PUT the whole file
+    to. Larger files get a multipart upload: PUT each part's bytes
+    (offset, length) to its "url", in any order or in parallel. Then call
+    POST /uploads/{file_id}/complete to have the file chunked.
+    """
+    if size <= 0:
+        raise HTTPException(status_code=400, detail="size must be positive")
+    
+    file_id = str(uuid.uuid4())
+    file_path = f"uploads/{file_id}/{filename}"
+    pending = {"filename": filename, "size": size, "file_path": file_path, "upload_id": None}
+    response = {"file_id": file_id, "method": "PUT", "expires_in": PRESIGN_EXPIRES,
+                "complete_url": f"/uploads/{file_id}/complete"}
+    try:
+        if size <= PRESIGN_PART_SIZE:
+            response["url"] = await run_in_threadpool(file_storage.presign_put, file_path, PRESIGN_EXPIRES)
+        else:
+            upload_id = await run_in_threadpool(file_storage.create_multipart_upload, file_path)
+            pending["upload_id"] = upload_id
+            parts = []
+            for number, offset in enumerate(range(0, size, PRESIGN_PART_SIZE), start=1):
+                url = await run_in_threadpool(file_storage.presign_part, file_path, upload_id, number,
+                                              PRESIGN_EXPIRES)
+                parts.append({"part_number": number, "offset": offset,
+                              "length": min(PRESIGN_PART_SIZE, size - offset), "url": url})
+            response["parts"] = parts
+    except NotImplementedError:
+        raise HTTPException(status_code=501, detail="Presigned uploads require a remote STORAGE_BACKEND such as s3")
+    
+    # Remember what was asked for until the upload is completed
+    await upload_to_cloud(f"pending/{file_id}.json", json.dumps(pending).encode())
+    return response
+
+@app.post("/uploads/{file_id}/complete")
+async def complete_upload(file_id: str):
+    """
+    Chunk a file uploaded through POST /uploads/presign
+    
+    The file is streamed from cloud storage chunk by chunk, so it never
+    has to pass through the client request.
+    """
+    try:
+        pending = json.loads((await get_from_cloud(f"pending/{file_id}.json")).decode())
+    except HTTPException:
+        raise HTTPException(status_code=404, detail="Upload ID not found")
+    file_path = pending["file_path"]
+    
+    # Missing or bad parts are the client's to fix; anything else is a server error
+    try:
+        if pending["upload_id"]:
+            await run_in_threadpool(file_storage.complete_multipart_upload, file_path, pending["upload_id"])
+        file_size = await run_in_threadpool(file_storage.size, file_path)
+    except (FileNotFoundError, IncompleteUpload):
+        raise HTTPException(status_code=400, detail="The file has not been uploaded completely")
+    if file_size != pending["size"]:
+        raise HTTPException(status_code=400, detail=f"Uploaded {file_size} bytes, expected {pending['size']}")
+    
+    if file_size <= MAX_CHUNK_SIZE:
+        result = {
+            "file_id": file_id,
+            "original_filename": pending["filename"],
+            "original_size": file_size,
+            "chunked": False,
+            "blob_url": file_storage.url(file_path),
+            "message": "File is under 25MB, no chunking needed"
+        }
+    else:
+        async def read_chunk(offset: int, buffer: bytearray) -> int:
+            return await run_in_threadpool(file_storage.get_range_into, file_path, offset, buffer)
+        
+        result = await chunk_to_cloud(file_id, pending["filename"], file_size, read_chunk)
+    
+    await run_in_threadpool(file_storage.delete, f"pending/{file_id}.json")
+    return result
+
 @app.get("/chunks/{file_id}")
 async def get_chunks(file_id: str):
     """
     Get information about chunks for a specific file ID
     """
-    # Try to get from memory first
-    if file_id in chunked_files:
-        return chunked_files[file_id]
-    
-    # If not in memory, try to get from cloud storage
     try:
-        metadata_path = f"metadata/{file_id}.json"
-        metadata_content = await get_from_cloud(metadata_path)
-        return json.loads(metadata_content.decode())
-    except:
+        file_info = await metadata_cache.get_or_load(file_id, lambda: load_metadata(file_id))
+    except Exception as e:
+        # A failing backend is not a missing file. Errors are not cached, so
+        # the next request tries again
+        logger.exception("Could not load the metadata of %s", file_id)
+        raise HTTPException(status_code=502, detail=f"Failed to load file metadata: {e}")
+    if file_info is None:
         raise HTTPException(status_code=404, detail="File ID not found")
+    return file_info
+
+async def load_metadata(file_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Fetch the metadata of a chunked file from the metadata store or cloud storage
+    
+    Returns:
+        The file information, or None if no backend knows the file ID
+    """
+    # Try the metadata store first
+    if metadata_store is not None:
+        file_info = await run_in_threadpool(metadata_store.get, file_id)
+        if file_info is not None:
+            return file_info
+    
+    # If not there, try to get from cloud storage
+    try:
+        metadata_content = await get_from_cloud(f"metadata/{file_id}.json")
+    except HTTPException as e:
+        if e.status_code == 404:
+            return None
+        raise
+    return json.loads(metadata_content.decode())
 
 @app.get("/health")
 async def health_check():
@@ -0,0 +1,312 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional
+
+# Which metadata store to use: "sqlite" (persistent, shared between worker
+# processes) or "memory" (per process, lost on restart)
+METADATA_STORE = os.environ.get("METADATA_STORE", "sqlite")
+METADATA_DB = os.environ.get("METADATA_DB", os.path.join("metadata", "files.db"))
+
+
+class MetadataStore:
+    """
+    Interface for storing information about chunked files
+
+    Records are the JSON-serialisable dicts returned by GET /chunks/{file_id}.
+    """
+
+    def get(self, file_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Record for file_id, or None if it is unknown
+        """
+        raise NotImplementedError
+
+    def get_many(self, file_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        Records of the known file_ids, by file ID
+        """
+        records = ((file_id, self.get(file_id)) for file_id in file_ids)
+        return {file_id: record for file_id, record in records if record is not None}
+
+    def put(self, file_id: str, record: Dict[str, Any], content_hash: Optional[str] = None):
+        """
+        Insert or replace the record for file_id, optionally indexed by the
+        hash of the file contents
+        """
+        raise NotImplementedError
+
+    def update_chunk(self, file_id: str, chunk_number: int, fields: Dict[str, Any]):
+        """
+        Set fields on one chunk of a stored record, in place
+
+        Unlike a get() followed by put(), this cannot undo a concurrent
+        change to another part of the record. Does nothing if the file or
+        chunk is unknown.
+        """
+        raise NotImplementedError
+
+    def delete(self, file_id: str):
+        raise NotImplementedError
+
+    def find_by_hash(self, content_hash: str) -> Optional[str]:
+        """
+        ID of the oldest file stored with this content hash, if any
+        """
+        raise NotImplementedError
+
+    def list_files(self, since: float = 0, limit: int = 100) -> List[str]:
+        """
+        IDs of files created at or after since, oldest first
+        """
+        raise NotImplementedError
+
+    def put_job(self, job: Dict[str, Any]):
+        """
+        Insert or replace a background job record (see JobQueue), so every
+        worker process can report on it
+        """
+        raise NotImplementedError
+
+    def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def add_job_event(self, job_id: str, event: Dict[str, Any]):
+        raise NotImplementedError
+
+    def job_events(self, job_id: str, after: int = -1) -> List[Dict[str, Any]]:
+        """
+        Events of a job with an id above after, in order
+        """
+        raise NotImplementedError
+
+    def expire_jobs(self, before: float):
+        """
+        Remove the jobs last updated before this time, with their events
+        """
+        raise NotImplementedError
+
+
+class MemoryMetadataStore(MetadataStore):
+    """
+    In-process store; fine for a single worker, lost on restart
+    """
+
+    def __init__(self):
+        self._records: Dict[str, Dict[str, Any]] = {}
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._job_events: Dict[str, List[Dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, file_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._records.get(file_id)
+            # Hand out copies so callers cannot change the stored record by accident
+            return json.loads(json.dumps(entry["record"])) if entry else None
+
+    def put(self, file_id: str, record: Dict[str, Any], content_hash: Optional[str] = None):
+        with self._lock:
+            previous = self._records.get(file_id, {})
+            self._records[file_id] = {
+                "record": json.loads(json.dumps(record)),
+                "content_hash": content_hash or previous.get("content_hash"),
+                "created_at": previous.get("created_at", time.time()),
+            }
+
+    def update_chunk(self, file_id: str, chunk_number: int, fields: Dict[str, Any]):
+        with self._lock:
+            entry = self._records.get(file_id)
+            chunks = entry["record"].get("chunks", []) if entry else []
+            if 1 <= chunk_number <= len(chunks):
+                chunks[chunk_number - 1].update(json.loads(json.dumps(fields)))
+
+    def delete(self, file_id: str):
+        with self._lock:
+            self._records.pop(file_id, None)
+
+    def find_by_hash(self, content_hash: str) -> Optional[str]:
+        with self._lock:
+            matches = [(entry["created_at"], file_id) for file_id, entry in self._records.items()
+                       if entry["content_hash"] == content_hash]
+        return min(matches)[1] if matches else None
+
+    def list_files(self, since: float = 0, limit: int = 100) -> List[str]:
+        with self._lock:
+            entries = sorted((entry["created_at"], file_id) for file_id, entry in self._records.items()
+                             if entry["created_at"] >= since)
+        return [file_id for _, file_id in entries[:limit]]
+
+    def put_job(self, job: Dict[str, Any]):
+        with self._lock:
+            self._jobs[job["job_id"]] = json.loads(json.dumps(job))
+
+    def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return json.loads(json.dumps(job)) if job else None
+
+    def add_job_event(self, job_id: str, event: Dict[str, Any]):
+        with self._lock:
+            self._job_events.setdefault(job_id, []).append(json.loads(json.dumps(event)))
+
+    def job_events(self, job_id: str, after: int = -1) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [dict(event) for event in self._job_events.get(job_id, ()) if event["id"] > after]
+
+    def expire_jobs(self, before: float):
+        with self._lock:
+            for job_id in [job_id for job_id, job in self._jobs.items() if job["updated_at"] < before]:
+                del self._jobs[job_id]
+                self._job_events.pop(job_id, None)
+
+
+class SQLiteMetadataStore(MetadataStore):
+    """
+    Embedded SQLite store in WAL mode
+
+    Safe to share between threads and between uvicorn worker processes:
+    each thread gets its own connection, WAL lets readers proceed while a
+    writer commits, and busy_timeout makes concurrent writers wait their
+    turn instead of failing.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        with self._connect() as db:
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS files (
+                    file_id TEXT PRIMARY KEY,
+                    content_hash TEXT,
+                    created_at REAL NOT NULL,
+                    record TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS files_content_hash ON files (content_hash);
+                CREATE INDEX IF NOT EXISTS files_created_at ON files (created_at);
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    updated_at REAL NOT NULL,
+                    record TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS jobs_updated_at ON jobs (updated_at);
+                CREATE TABLE IF NOT EXISTS job_events (
+                    job_id TEXT NOT NULL,
+                    id INTEGER NOT NULL,
+                    event TEXT NOT NULL,
+                    PRIMARY KEY (job_id, id)
+                );
+            """)
+
+    def _connect(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("PRAGMA busy_timeout=30000")
+            self._local.db = db
+        return db
+
+    def get(self, file_id: str) -> Optional[Dict[str, Any]]:
+        row = self._connect().execute(
+            "SELECT record FROM files WHERE file_id = ?", (file_id,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_many(self, file_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        # One query instead of a round trip per file
+        if not file_ids:
+            return {}
+        placeholders = ",".join("?" * len(file_ids))
+        rows = self._connect().execute(
+            f"SELECT file_id, record FROM files WHERE file_id IN ({placeholders})", list(file_ids)
+        ).fetchall()
+        return {file_id: json.loads(record) for file_id, record in rows}
+
+    def put(self, file_id: str, record: Dict[str, Any], content_hash: Optional[str] = None):
+        with self._connect() as db:
+            db.execute(
+                """
+                INSERT INTO files (file_id, content_hash, created_at, record) VALUES (?, ?, ?, ?)
+                ON CONFLICT (file_id) DO UPDATE SET
+                    record = excluded.record,
+                    content_hash = COALESCE(excluded.content_hash, files.content_hash)
+                """,
+                (file_id, content_hash, time.time(), json.dumps(record)),
+            )
+
+    def update_chunk(self, file_id: str, chunk_number: int, fields: Dict[str, Any]):
+        # A single UPDATE with json_set, so it is atomic with respect to
+        # writers in other threads and processes
+        if not fields:
+            return
+        paths = ", ".join("?, json(?)" for _ in fields)
+        args = []
+        for name, value in fields.items():
+            args += [f"$.chunks[{chunk_number - 1}].{name}", json.dumps(value)]
+        with self._connect() as db:
+            db.execute(
+                f"UPDATE files SET record = json_set(record, {paths}) "
+                f"WHERE file_id = ? AND json_type(record, ?) = 'object'",
+                args + [file_id, f"$.chunks[{chunk_number - 1}]"],
+            )
+
+    def delete(self, file_id: str):
+        with self._connect() as db:
+            db.execute("DELETE FROM files WHERE file_id = ?", (file_id,))
+
+    def find_by_hash(self, content_hash: str) -> Optional[str]:
+        row = self._connect().execute(
+            "SELECT file_id FROM files WHERE content_hash = ? ORDER BY created_at LIMIT 1",
+            (content_hash,),
+        ).fetchone()
+        return row[0] if row else None
+
+    def list_files(self, since: float = 0, limit: int = 100) -> List[str]:
+        rows = self._connect().execute(
+            "SELECT file_id FROM files WHERE created_at >= ? ORDER BY created_at LIMIT ?",
+            (since, limit),
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def put_job(self, job: Dict[str, Any]):
+        with self._connect() as db:
+            db.execute("INSERT OR REPLACE INTO jobs (job_id, updated_at, record) VALUES (?, ?, ?)",
+                       (job["job_id"], job["updated_at"], json.dumps(job)))
+
+    def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        row = self._connect().execute("SELECT record FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def add_job_event(self, job_id: str, event: Dict[str, Any]):
+        with self._connect() as db:
+            db.execute("INSERT OR REPLACE INTO job_events (job_id, id, event) VALUES (?, ?, ?)",
+                       (job_id, event["id"], json.dumps(event)))
+
+    def job_events(self, job_id: str, after: int = -1) -> List[Dict[str, Any]]:
+        rows = self._connect().execute(
+            "SELECT event FROM job_events WHERE job_id = ? AND id > ? ORDER BY id", (job_id, after)
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def expire_jobs(self, before: float):
+        with self._connect() as db:
+            db.execute("DELETE FROM job_events WHERE job_id IN (SELECT job_id FROM jobs WHERE updated_at < ?)",
+                       (before,))
+            db.execute("DELETE FROM jobs WHERE updated_at < ?", (before,))
+
+
+def create_store(kind: str = METADATA_STORE, path: str = METADATA_DB) -> MetadataStore:
+    """
+    Build the metadata store selected by METADATA_STORE
+    """
+    if kind == "memory":
+        return MemoryMetadataStore()
+    if kind == "sqlite":
+        return SQLiteMetadataStore(path)
+    raise ValueError(f"Unknown METADATA_STORE: {kind}")
@@ -0,0 +1,162 @@
+import os
+import json
+import time
+import fcntl
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# Largest length a resumable upload may declare (the data file is
+# allocated at that size up front), and seconds after its last part or
+# status change at which an upload is removed, finished or not
+MAX_UPLOAD_SIZE = int(os.environ.get("MAX_UPLOAD_SIZE", str(10 * 1024 ** 3)))
+RESUMABLE_UPLOAD_TTL = float(os.environ.get("RESUMABLE_UPLOAD_TTL", str(24 * 3600)))
+
+
+def data_path(directory: str, upload_id: str) -> str:
+    """
+    File the parts of a resumable upload are written into
+    """
+    return os.path.join(directory, upload_id)
+
+
+def _state_path(directory: str, upload_id: str) -> str:
+    return os.path.join(directory, f"{upload_id}.json")
+
+
+def create_upload(directory: str, upload_id: str, filename: str, length: int,
+                  options: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Start a resumable upload of length bytes
+
+    The data file is created at its full (sparse) size up front, so parts
+    can be written at their offsets in any order.
+    """
+    with open(data_path(directory, upload_id), "wb") as f:
+        f.truncate(length)
+    state = {
+        "upload_id": upload_id,
+        "filename": filename,
+        "length": length,
+        "options": options,
+        "received": [],
+        "status": "uploading",
+        "job_id": None,
+        "created_at": time.time()
+    }
+    with open(_state_path(directory, upload_id), "x") as f:
+        json.dump(state, f)
+    return state
+
+
+@contextmanager
+def _locked(directory: str, upload_id: str, exclusive: bool) -> Iterator[Optional[Tuple[Any, Dict[str, Any]]]]:
+    # flock serialises updates between threads and uvicorn worker processes alike
+    try:
+        f = open(_state_path(directory, upload_id), "r+")
+    except FileNotFoundError:
+        yield None
+        return
+    with f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield f, json.load(f)
+
+
+def read_upload(directory: str, upload_id: str) -> Optional[Dict[str, Any]]:
+    """
+    State of a resumable upload, or None if it is unknown
+    """
+    with _locked(directory, upload_id, exclusive=False) as locked:
+        return locked[1] if locked else None
+
+
+def update_upload(directory: str, upload_id: str, **fields) -> Optional[Dict[str, Any]]:
+    with _locked(directory, upload_id, exclusive=True) as locked:
+        if locked is None:
+            return None
+        f, state = locked
+        state.update(fields)
+        _rewrite(f, state)
+        return state
+
+
+def _rewrite(f, state: Dict[str, Any]):
+    f.seek(0)
+    f.truncate()
+    json.dump(state, f)
+    f.flush()
+
+
+def add_range(ranges: List[List[int]], start: int, end: int) -> List[List[int]]:
+    """
+    Merge [start, end) into a sorted list of disjoint [start, end) ranges
+    """
+    merged = []
+    for range_start, range_end in sorted(ranges + [[start, end]]):
+        if merged and range_start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], range_end)
+        else:
+            merged.append([range_start, range_end])
+    return merged
+
+
+def upload_offset(state: Dict[str, Any]) -> int:
+    """
+    Number of bytes received without gaps from the start of the file,
+    i.e. where a sequential client should resume
+    """
+    received = state["received"]
+    return received[0][1] if received and received[0][0] == 0 else 0
+
+
+def record_part(directory: str, upload_id: str, start: int, end: int) -> Tuple[Dict[str, Any], bool]:
+    """
+    Mark bytes [start, end) as received
+
+    Returns:
+        (state, completed), where completed is True for exactly one call:
+        the one that received the last missing bytes; state is None if the
+        upload has expired meanwhile
+    """
+    with _locked(directory, upload_id, exclusive=True) as locked:
+        if locked is None:
+            return None, False
+        f, state = locked
+        if end > start:
+            state["received"] = add_range(state["received"], start, end)
+        completed = state["status"] == "uploading" and upload_offset(state) == state["length"]
+        if completed:
+            state["status"] = "processing"
+        _rewrite(f, state)
+        return state, completed
+
+
+def expire_uploads(directory: str, ttl: float = RESUMABLE_UPLOAD_TTL) -> int:
+    """
+    Remove the uploads in directory untouched for more than ttl seconds,
+    with whatever data they still have: abandoned ones, finished ones
+    (whose data their job has already moved or removed) and ones whose
+    job died with its worker process
+
+    Returns:
+        Number of uploads removed
+    """
+    cutoff = time.time() - ttl
+    removed = 0
+    for name in os.listdir(directory):
+        if not name.endswith(".json"):
+            continue
+        upload_id = name[:-len(".json")]
+        try:
+            if os.path.getmtime(_state_path(directory, upload_id)) >= cutoff:
+                continue
+        except FileNotFoundError:
+            continue
+        with _locked(directory, upload_id, exclusive=True) as locked:
+            # Checked again under the lock, in case a part arrived meanwhile
+            if locked is None or os.fstat(locked[0].fileno()).st_mtime >= cutoff:
+                continue
+            if os.path.exists(data_path(directory, upload_id)):
+                os.remove(data_path(directory, upload_id))
+            os.remove(_state_path(directory, upload_id))
+            removed += 1
+    return removed
@@ -0,0 +1,124 @@
+import os
+import shutil
+import subprocess
+from typing import List, Optional
+
+try:
+    import numpy as np
+except ImportError:  # numpy is only needed for split=silence
+    np = None
+
+from audio import AudioStream
+from chunking import ChunkRange
+
+# Rate and length of the energy windows computed from the decoded audio
+ENERGY_SAMPLE_RATE = 8000
+ENERGY_WINDOW_SECONDS = 0.02
+
+# Samples decoded per read from ffmpeg, so memory stays bounded for long recordings
+DECODE_BLOCK_SAMPLES = ENERGY_SAMPLE_RATE * 30
+
+# How far before each size limit we look for the quietest cut point
+SILENCE_TOLERANCE_SECONDS = float(os.environ.get("SILENCE_TOLERANCE_SECONDS", "15"))
+
+# Energy is averaged over this span around a cut so we land in a pause, not a dip
+SILENCE_SMOOTHING_SECONDS = 0.3
+
+
+def silence_available() -> bool:
+    """
+    Whether split=silence can run here (needs numpy and ffmpeg)
+    """
+    return np is not None and shutil.which("ffmpeg") is not None
+
+
+def rms_energy(fd: int) -> "np.ndarray":
+    """
+    Windowed RMS energy of the audio behind fd
+
+    ffmpeg decodes to mono 8kHz 16-bit PCM, which is streamed in blocks;
+    each block is reduced to per-window RMS values in one vectorised step.
+
+    Returns:
+        float32 array with one value per ENERGY_WINDOW_SECONDS window
+    """
+    window = int(ENERGY_SAMPLE_RATE * ENERGY_WINDOW_SECONDS)
+    process = subprocess.Popen(
+        ["ffmpeg", "-v", "error", "-nostdin", "-i", f"/dev/fd/{fd}",
+         "-ac", "1", "-ar", str(ENERGY_SAMPLE_RATE), "-f", "s16le", "-"],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, pass_fds=(fd,),
+    )
+    energies = []
+    leftover = np.empty(0, dtype=np.int16)
+    try:
+        while True:
+            block = process.stdout.read(DECODE_BLOCK_SAMPLES * 2)
+            if not block:
+                break
+            samples = np.concatenate([leftover, np.frombuffer(block[:len(block) // 2 * 2], dtype=np.int16)])
+            usable = len(samples) // window * window
+            frames = samples[:usable].astype(np.float32).reshape(-1, window)
+            energies.append(np.sqrt(np.mean(frames * frames, axis=1)))
+            leftover = samples[usable:]
+    finally:
+        process.stdout.close()
+        stderr = process.stderr.read()
+        process.stderr.close()
+        returncode = process.wait()
+    if returncode != 0:
+        raise RuntimeError(f"ffmpeg failed to decode audio: {stderr.decode(errors='replace').strip()}")
+    return np.concatenate(energies) if energies else np.zeros(0, dtype=np.float32)
+
+
+def plan_silence_ranges(fd: int, file_size: int, chunk_size: int,
+                        tolerance: float = SILENCE_TOLERANCE_SECONDS) -> Optional[List[ChunkRange]]:
+    """
+    Plan chunks that end in the quietest moment before each size limit
+
+    For every chunk, the frame boundaries that fit under chunk_size and lie
+    within tolerance seconds of the limit are scored by the smoothed energy
+    around them, and the quietest one is used. Cuts stay on frame
+    boundaries, so nothing is re-encoded.
+
+    Returns:
+        List of (offset, length, header) ranges, or None if the file is not
+        in a format whose frames can be timed
+    """
+    stream = AudioStream.open(fd, file_size, chunk_size)
+    if stream is None:
+        return None
+
+    # Candidate cut offsets and the time each one starts at
+    if stream.fmt == "wav":
+        times = np.arange(0, (stream.end - stream.start) / stream.byte_rate, ENERGY_WINDOW_SECONDS)
+        offsets = stream.start + (times * stream.byte_rate // stream.align).astype(np.int64) * stream.align
+    else:
+        timeline = stream.timeline()
+        if timeline is None:
+            return None
+        offsets = np.frombuffer(timeline[0], dtype=np.int64)
+        times = np.frombuffer(timeline[1], dtype=np.float64)
+    if len(offsets) == 0:
+        return None
+
+    energy = rms_energy(fd)
+    smoothing = max(1, int(SILENCE_SMOOTHING_SECONDS / ENERGY_WINDOW_SECONDS))
+    energy = np.convolve(energy, np.ones(smoothing) / smoothing, mode="same")
+    # Score every candidate by the energy of the window it falls into
+    windows = np.minimum((times / ENERGY_WINDOW_SECONDS).astype(np.int64), max(len(energy) - 1, 0))
+    scores = energy[windows] if len(energy) else np.zeros(len(offsets))
+
+    def quietest_cut(position: int, limit: int) -> int:
+        lo = np.searchsorted(offsets, position, side="right")
+        hi = np.searchsorted(offsets, limit, side="right")
+        if hi <= lo:
+            return stream.frame_cut(position, limit)
+        # Only consider boundaries within the tolerance window before the limit,
+        # and never in the first half of the chunk
+        earliest = max(times[hi - 1] - tolerance, (times[lo] + times[hi - 1]) / 2)
+        lo = max(lo, int(np.searchsorted(times, earliest, side="left")))
+        # Among equally quiet candidates, take the latest to keep chunks large
+        quietest = hi - 1 - int(np.argmin(scores[lo:hi][::-1]))
+        return int(offsets[quietest])
+
+    return stream.plan(chunk_size, quietest_cut)
@@ -0,0 +1,359 @@
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+from chunking import copy_range
+
+try:
+    import boto3
+    from botocore.config import Config
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+# Where uploaded files and chunks are stored: "local" (a directory on disk)
+# or "s3" (any S3-compatible object store: AWS, MinIO, ...)
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "local")
+STORAGE_ROOT = os.environ.get("STORAGE_ROOT", ".")
+
+# Base URL stored files are publicly reachable under, if any
+STORAGE_PUBLIC_URL = os.environ.get("STORAGE_PUBLIC_URL")
+
+S3_BUCKET_NAME = os.environ.get("S3_BUCKET_NAME")
+S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL")  # e.g. http://localhost:9000 for MinIO
+S3_PREFIX = os.environ.get("S3_PREFIX", "")
+
+# Keep-alive connections kept open to S3, which is also the number of
+# multipart parts uploaded at once
+S3_MAX_CONNECTIONS = int(os.environ.get("S3_MAX_CONNECTIONS", "16"))
+
+# Objects larger than the threshold are sent as a multipart upload of
+# S3_MULTIPART_PART_SIZE parts (S3 requires at least 5MB per part)
+S3_MULTIPART_THRESHOLD = int(os.environ.get("S3_MULTIPART_THRESHOLD", str(5 * 1024 * 1024)))
+S3_MULTIPART_PART_SIZE = max(5 * 1024 * 1024,
+                             int(os.environ.get("S3_MULTIPART_PART_SIZE", str(8 * 1024 * 1024))))
+
+
+class StorageBackend:
+    """
+    Interface for storing uploaded files and chunks under "/"-separated keys
+
+    put/put_file return {"url": ..., "path": key}. Reading a missing key
+    raises FileNotFoundError.
+    """
+
+    def put(self, key: str, data: bytes) -> Dict[str, Any]:
+        """
+        Store data (bytes or any bytes-like object, e.g. a memoryview) under key
+        """
+        raise NotImplementedError
+
+    def put_file(self, key: str, fd: int, offset: int = 0, length: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Store length bytes of the file behind fd, starting at offset, under key
+
+        The data is read straight from the file, never held in memory as a whole.
+        """
+        raise NotImplementedError
+
+    def get(self, key: str) -> bytes:
+        raise NotImplementedError
+
+    def get_range(self, key: str, offset: int, length: int) -> bytes:
+        raise NotImplementedError
+
+    def get_range_into(self, key: str, offset: int, buffer: bytearray) -> int:
+        """
+        Read up to len(buffer) bytes of key starting at offset into buffer
+
+        Returns:
+            Number of bytes read (less than len(buffer) only at the end of the object)
+        """
+        data = self.get_range(key, offset, len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def size(self, key: str) -> int:
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        raise NotImplementedError
+
+    def url(self, key: str) -> str:
+        raise NotImplementedError
+
+    def local_path(self, key: str) -> Optional[str]:
+        """
+        Path of key on the local disk, or None if the backend is remote
+        """
+        return None
+
+    # Presigned uploads let clients send data straight to the backend. Only
+    # remote backends support them; the others raise NotImplementedError.
+
+    def presign_put(self, key: str, expires: int) -> str:
+        """
+        URL a client can PUT the whole object to within expires seconds
+        """
+        raise NotImplementedError
+
+    def create_multipart_upload(self, key: str) -> str:
+        """
+        Start a multipart upload of key and return its upload ID
+        """
+        raise NotImplementedError
+
+    def presign_part(self, key: str, upload_id: str, part_number: int, expires: int) -> str:
+        """
+        URL a client can PUT part part_number (counting from 1) of a multipart upload to
+        """
+        raise NotImplementedError
+
+    def complete_multipart_upload(self, key: str, upload_id: str):
+        """
+        Assemble the parts uploaded so far into the object
+
+        Raises:
+            IncompleteUpload: if the parts do not make up a valid object
+        """
+        raise NotImplementedError
+
+
+class IncompleteUpload(Exception):
+    """
+    Raised when the parts of a multipart upload cannot be assembled,
+    e.g. because some were never sent or a part is too small
+    """
+
+
+def _file_length(fd: int, offset: int, length: Optional[int]) -> int:
+    return os.fstat(fd).st_size - offset if length is None else length
+
+
+class LocalStorage(StorageBackend):
+    """
+    Files in a directory on the local disk
+    """
+
+    def __init__(self, root: str):
+        self.root = os.path.normpath(root)
+
+    def local_path(self, key: str) -> str:
+        path = os.path.normpath(os.path.join(self.root, key))
+        if path != self.root and not path.startswith(os.path.join(self.root, "")):
+            raise ValueError(f"Storage key escapes the storage root: {key}")
+        return path
+
+    def _write(self, key: str, write: Callable[[str], Any]) -> Dict[str, Any]:
+        # Write to a temporary name and rename, so readers never see a partial file
+        path = self.local_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{uuid.uuid4().hex}.part"
+        try:
+            write(temp_path)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return {"url": self.url(key), "path": key}
+
+    def put(self, key: str, data: bytes) -> Dict[str, Any]:
+        def write(path):
+            with open(path, "wb") as f:
+                f.write(data)
+        return self._write(key, write)
+
+    def put_file(self, key: str, fd: int, offset: int = 0, length: Optional[int] = None) -> Dict[str, Any]:
+        length = _file_length(fd, offset, length)
+        return self._write(key, lambda path: copy_range(fd, path, offset, length))
+
+    def get(self, key: str) -> bytes:
+        with open(self.local_path(key), "rb") as f:
+            return f.read()
+
+    def get_range(self, key: str, offset: int, length: int) -> bytes:
+        with open(self.local_path(key), "rb") as f:
+            return os.pread(f.fileno(), length, offset)
+
+    def get_range_into(self, key: str, offset: int, buffer: bytearray) -> int:
+        view = memoryview(buffer)
+        filled = 0
+        with open(self.local_path(key), "rb") as f:
+            while filled < len(view):
+                n = os.preadv(f.fileno(), [view[filled:]], offset + filled)
+                if not n:
+                    break
+                filled += n
+        return filled
+
+    def size(self, key: str) -> int:
+        return os.path.getsize(self.local_path(key))
+
+    def delete(self, key: str):
+        path = self.local_path(key)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def url(self, key: str) -> str:
+        if STORAGE_PUBLIC_URL:
+            return f"{STORAGE_PUBLIC_URL.rstrip('/')}/{key}"
+        return "file://" + os.path.abspath(self.local_path(key))
+
+
+class S3Storage(StorageBackend):
+    """
+    Objects in an S3-compatible bucket
+
+    A single client is shared by all threads; botocore keeps a pool of up
+    to max_connections keep-alive connections, so requests after the first
+    skip the TCP and TLS handshakes. Large objects are sent as multipart
+    uploads whose parts are uploaded in parallel over that pool.
+    """
+
+    def __init__(self, bucket: str, endpoint_url: Optional[str] = None, prefix: str = "",
+                 max_connections: int = S3_MAX_CONNECTIONS):
+        if boto3 is None:
+            raise RuntimeError("The s3 storage backend requires boto3")
+        self.bucket = bucket
+        self.endpoint_url = endpoint_url
+        self.prefix = prefix
+        self.client = boto3.client("s3", endpoint_url=endpoint_url, config=Config(
+            max_pool_connections=max_connections,
+            tcp_keepalive=True,
+            retries={"max_attempts": 5, "mode": "standard"},
+        ))
+        self.executor = ThreadPoolExecutor(max_workers=max_connections, thread_name_prefix="s3")
+
+    def _key(self, key: str) -> str:
+        return self.prefix + key
+
+    def _upload(self, key: str, length: int, read: Callable[[int, int], bytes]) -> Dict[str, Any]:
+        """
+        Upload length bytes, fetched part by part with read(offset, size)
+        """
+        if length <= S3_MULTIPART_THRESHOLD:
+            self.client.put_object(Bucket=self.bucket, Key=self._key(key), Body=read(0, length))
+            return {"url": self.url(key), "path": key}
+
+        upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=self._key(key))["UploadId"]
+        try:
+            # Each part is read inside its worker, so at most max_connections
+            # parts are in memory at a time
+            jobs = [
+                self.executor.submit(self._upload_part, key, upload_id, number, read, offset,
+                                     min(S3_MULTIPART_PART_SIZE, length - offset))
+                for number, offset in enumerate(range(0, length, S3_MULTIPART_PART_SIZE), start=1)
+            ]
+            parts = [job.result() for job in jobs]
+            self.client.complete_multipart_upload(Bucket=self.bucket, Key=self._key(key), UploadId=upload_id,
+                                                  MultipartUpload={"Parts": parts})
+        except BaseException:
+            # Don't leave the uploaded parts behind (S3 bills for them)
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self._key(key), UploadId=upload_id)
+            raise
+        return {"url": self.url(key), "path": key}
+
+    def _upload_part(self, key: str, upload_id: str, number: int,
+                     read: Callable[[int, int], bytes], offset: int, size: int) -> Dict[str, Any]:
+        response = self.client.upload_part(Bucket=self.bucket, Key=self._key(key), UploadId=upload_id,
+                                           PartNumber=number, Body=read(offset, size))
+        return {"PartNumber": number, "ETag": response["ETag"]}
+
+    def put(self, key: str, data: bytes) -> Dict[str, Any]:
+        view = memoryview(data)
+        return self._upload(key, len(view), lambda offset, size: bytes(view[offset:offset + size]))
+
+    def put_file(self, key: str, fd: int, offset: int = 0, length: Optional[int] = None) -> Dict[str, Any]:
+        length = _file_length(fd, offset, length)
+        return self._upload(key, length, lambda start, size: os.pread(fd, size, offset + start))
+
+    def _request(self, method: Callable[..., Dict[str, Any]], key: str, **kwargs) -> Dict[str, Any]:
+        try:
+            return method(Bucket=self.bucket, Key=self._key(key), **kwargs)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404", "NotFound"):
+                raise FileNotFoundError(key)
+            raise
+
+    def get(self, key: str) -> bytes:
+        return self._request(self.client.get_object, key)["Body"].read()
+
+    def get_range(self, key: str, offset: int, length: int) -> bytes:
+        if length <= 0:
+            return b""
+        response = self._request(self.client.get_object, key, Range=f"bytes={offset}-{offset + length - 1}")
+        return response["Body"].read()
+
+    def get_range_into(self, key: str, offset: int, buffer: bytearray) -> int:
+        if not buffer:
+            return 0
+        response = self._request(self.client.get_object, key, Range=f"bytes={offset}-{offset + len(buffer) - 1}")
+        # Copy the body in as it streams, never holding a second copy of the range
+        view = memoryview(buffer)
+        filled = 0
+        for block in response["Body"].iter_chunks(1024 * 1024):
+            view[filled:filled + len(block)] = block
+            filled += len(block)
+        return filled
+
+    def size(self, key: str) -> int:
+        return self._request(self.client.head_object, key)["ContentLength"]
+
+    def delete(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+    def presign_put(self, key: str, expires: int) -> str:
+        return self.client.generate_presigned_url(
+            "put_object", Params={"Bucket": self.bucket, "Key": self._key(key)}, ExpiresIn=expires)
+
+    def create_multipart_upload(self, key: str) -> str:
+        return self.client.create_multipart_upload(Bucket=self.bucket, Key=self._key(key))["UploadId"]
+
+    def presign_part(self, key: str, upload_id: str, part_number: int, expires: int) -> str:
+        return self.client.generate_presigned_url(
+            "upload_part", ExpiresIn=expires,
+            Params={"Bucket": self.bucket, "Key": self._key(key), "UploadId": upload_id, "PartNumber": part_number})
+
+    def complete_multipart_upload(self, key: str, upload_id: str):
+        # The part ETags come from S3 itself, so clients don't have to report them
+        parts: List[Dict[str, Any]] = []
+        try:
+            for page in self.client.get_paginator("list_parts").paginate(
+                    Bucket=self.bucket, Key=self._key(key), UploadId=upload_id):
+                parts += [{"PartNumber": part["PartNumber"], "ETag": part["ETag"]}
+                          for part in page.get("Parts", [])]
+            self.client.complete_multipart_upload(Bucket=self.bucket, Key=self._key(key), UploadId=upload_id,
+                                                  MultipartUpload={"Parts": parts})
+        except ClientError as e:
+            code = e.response.get("Error", {}).get("Code")
+            if code == "NoSuchUpload":
+                # Completed by an earlier call, unless the object is missing too
+                try:
+                    self.size(key)
+                    return
+                except FileNotFoundError:
+                    raise IncompleteUpload(f"No multipart upload {upload_id} for {key}") from e
+            if code in ("InvalidPart", "InvalidPartOrder", "EntityTooSmall", "MalformedXML"):
+                raise IncompleteUpload(str(e)) from e
+            raise
+
+    def url(self, key: str) -> str:
+        if STORAGE_PUBLIC_URL:
+            return f"{STORAGE_PUBLIC_URL.rstrip('/')}/{key}"
+        if self.endpoint_url:
+            return f"{self.endpoint_url.rstrip('/')}/{self.bucket}/{self._key(key)}"
+        return f"https://{self.bucket}.s3.amazonaws.com/{self._key(key)}"
+
+
+def create_storage(kind: str = STORAGE_BACKEND, root: str = STORAGE_ROOT) -> StorageBackend:
+    """
+    Build the storage backend selected by STORAGE_BACKEND
+    """
+    if kind == "local":
+        return LocalStorage(root)
+    if kind == "s3":
+        if not S3_BUCKET_NAME:
+            raise ValueError("STORAGE_BACKEND=s3 requires S3_BUCKET_NAME")
+        return S3Storage(S3_BUCKET_NAME, endpoint_url=S3_ENDPOINT_URL, prefix=S3_PREFIX)
+    raise ValueError(f"Unknown STORAGE_BACKEND: {kind}")
@@ -1,7 +1,9 @@
 import os
+import time
 import requests
 import argparse
 import json
+from concurrent.futures import ThreadPoolExecutor
 
 def upload_file(file_path, server_url="http://localhost:8000"):
     """
@@ -49,6 +51,93 @@ def upload_file(file_path, server_url="http://localhost:8000"):
         print(response.text)
         return None
 
+def upload_part(upload_url, file_path, offset, length, retries=5):
+    """
+    PATCH one part of a resumable upload, retrying from where the server got to
+    """
+    end = offset + length
+    for attempt in range(retries + 1):
+        try:
+            with open(file_path, 'rb') as f:
+                f.seek(offset)
+                response = requests.patch(upload_url, data=f.read(end - offset),
+                                          headers={'Upload-Offset': str(offset),
+                                                   'Content-Type': 'application/offset+octet-stream'})
+            response.raise_for_status()
+            return response.json()
+        except requests.exceptions.RequestException as e:
+            if attempt == retries:
+                raise
+            print(f"  Part at {offset} failed ({e}), retrying")
+            time.sleep(2 ** attempt)
+            # Only send what the server does not have yet
+            state = requests.get(upload_url).json()
+            for start, stop in state['received']:
+                if start <= offset < stop:
+                    offset = min(stop, end)
+            if offset >= end:
+                return state
+
+def resumable_upload(file_path, server_url="http://localhost:8000", part_size_mb=8, parallel=4,
+                     upload_id=None):
+    """
+    Upload a file with the resumable upload protocol, several parts at a time
+    
+    Args:
+        file_path: Path to the file to upload
+        server_url: URL of the chunking service
+        part_size_mb: Size of each PATCH request in MB
+        parallel: Number of parts uploaded at the same time
+        upload_id: ID of an earlier, interrupted upload of this file to resume
+        
+    Returns:
+        Response JSON of the finished chunking job
+    """
+    if not os.path.exists(file_path):
+        print(f"Error: File {file_path} does not exist")
+        return None
+    
+    file_size = os.path.getsize(file_path)
+    print(f"File size: {file_size / (1024 * 1024):.2f} MB")
+    
+    if upload_id is None:
+        response = requests.post(f"{server_url}/uploads",
+                                 params={'filename': os.path.basename(file_path), 'length': file_size})
+        if response.status_code != 201:
+            print(f"Error: {response.status_code}")
+            print(response.text)
+            return None
+        upload_id = response.json()['upload_id']
+        print(f"Created upload {upload_id}")
+    upload_url = f"{server_url}/uploads/{upload_id}"
+    
+    # Work out which parts are still missing (everything, for a new upload)
+    state = requests.get(upload_url).json()
+    part_size = part_size_mb * 1024 * 1024
+    parts = []
+    position = 0
+    for start, stop in state['received'] + [[file_size, file_size]]:
+        for offset in range(position, start, part_size):
+            parts.append((offset, min(part_size, start - offset)))
+        position = stop
+    print(f"Uploading {len(parts)} parts, {parallel} at a time")
+    
+    with ThreadPoolExecutor(max_workers=parallel) as pool:
+        list(pool.map(lambda part: upload_part(upload_url, file_path, *part), parts))
+    
+    # Chunking starts once the last byte has arrived; wait for the job
+    while True:
+        state = requests.get(upload_url).json()
+        if state.get('job_id'):
+            job = requests.get(f"{server_url}/jobs/{state['job_id']}").json()
+            if job['status'] == 'completed':
+                print("Upload successful!")
+                return job['result']
+            if job['status'] == 'failed':
+                print(f"Error: {job['error']}")
+                return None
+        time.sleep(1)
+
 def get_chunks_info(file_id, server_url="http://localhost:8000"):
     """
     Get information about chunks for a specific file ID
@@ -110,11 +199,20 @@ def main():
     parser.add_argument('--file', help='Path to the file to upload')
     parser.add_argument('--file-id', help='File ID to get chunks for')
     parser.add_argument('--health', action='store_true', help='Check the health of the service')
+    parser.add_argument('--resumable', action='store_true', help='Upload --file with the resumable upload protocol')
+    parser.add_argument('--resume', metavar='UPLOAD_ID', help='Resume an interrupted resumable upload of --file')
+    parser.add_argument('--part-size', type=int, default=8, help='Part size in MB for resumable uploads')
+    parser.add_argument('--parallel', type=int, default=4, help='Parts uploaded at once for resumable uploads')
     
     args = parser.parse_args()
     
     if args.health:
         check_health(args.url)
+    elif args.file and (args.resumable or args.resume):
+        result = resumable_upload(args.file, args.url, args.part_size, args.parallel, args.resume)
+        if result:
+            print("\nFull response:")
+            print(json.dumps(result, indent=2))
     elif args.file:
         result = upload_file(args.file, args.url)
         if result:
@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# The service modules are flat files next to this directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Keep the service's files and metadata out of the working tree
+os.environ.setdefault("STORAGE_ROOT", tempfile.mkdtemp(prefix="file-chunker-tests-"))
+os.environ.setdefault("METADATA_STORE", "memory")
@@ -0,0 +1,106 @@
+import io
+import os
+import zlib
+import tarfile
+import zipfile
+
+import pytest
+from starlette.applications import Starlette
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+import archive
+from http_responses import ConcatResponse
+
+
+@pytest.fixture
+def members(tmp_path):
+    # Two chunk files, and a virtual chunk: an ID3 header prepended to a
+    # range in the middle of an original
+    first = tmp_path / "chunk_001.mp3"
+    first.write_bytes(os.urandom(70000))
+    second = tmp_path / "chunk_002.mp3"
+    second.write_bytes(b"")
+    original = tmp_path / "original.mp3"
+    original.write_bytes(os.urandom(5000))
+    members = [
+        {"name": "chunk_001.mp3", "path": str(first), "offset": 0, "length": 70000, "header": b""},
+        {"name": "chunk_002.mp3", "path": str(second), "offset": 0, "length": 0, "header": b""},
+        {"name": "chunk_003 é.mp3", "path": str(original), "offset": 1000, "length": 3001,
+         "header": b"ID3\x04\x00\x00\x00\x00\x00\x00"},
+    ]
+    for member in members:
+        member["mtime"] = 1700000000
+        with open(member["path"], "rb") as f:
+            member["crc32"] = archive.crc32_fd(f.fileno(), member["offset"], member["length"], member["header"])
+    return members
+
+
+def contents(member):
+    with open(member["path"], "rb") as f:
+        f.seek(member["offset"])
+        return member["header"] + f.read(member["length"])
+
+
+def serve(parts):
+    app = Starlette(routes=[Route("/", lambda request: ConcatResponse(parts))])
+    return TestClient(app).get("/")
+
+
+def test_zip_streams_with_exact_length(members):
+    response = serve(archive.zip_parts(members))
+    assert int(response.headers["content-length"]) == len(response.content)
+
+    with zipfile.ZipFile(io.BytesIO(response.content)) as zf:
+        assert zf.testzip() is None
+        assert zf.namelist() == [member["name"] for member in members]
+        for member in members:
+            assert zf.read(member["name"]) == contents(member)
+
+
+def test_tar_streams_with_exact_length(members):
+    response = serve(archive.tar_parts(members))
+    assert int(response.headers["content-length"]) == len(response.content)
+    assert len(response.content) % tarfile.BLOCKSIZE == 0
+
+    with tarfile.open(fileobj=io.BytesIO(response.content)) as tf:
+        assert tf.getnames() == [member["name"] for member in members]
+        for member in members:
+            assert tf.extractfile(member["name"]).read() == contents(member)
+
+
+def test_zip64_past_4gb(tmp_path):
+    # A sparse 5GB chunk followed by a small one whose local header lies
+    # past 4GB. The archive is written out sparse too: file ranges of the
+    # big chunk are holes, so only the headers take up disk space.
+    big = tmp_path / "big.mp3"
+    with open(big, "wb") as f:
+        f.truncate(5 * 1024 ** 3)
+    small = tmp_path / "small.mp3"
+    small.write_bytes(b"tail of the recording")
+    members = [
+        {"name": "chunk_001.mp3", "path": str(big), "offset": 0, "length": 5 * 1024 ** 3, "header": b"",
+         "mtime": 1700000000, "crc32": 0},
+        {"name": "chunk_002.mp3", "path": str(small), "offset": 0, "length": 21, "header": b"",
+         "mtime": 1700000000, "crc32": zlib.crc32(b"tail of the recording")},
+    ]
+    parts = archive.zip_parts(members)
+
+    path = tmp_path / "chunks.zip"
+    with open(path, "wb") as out:
+        for part in parts:
+            if isinstance(part, bytes):
+                out.write(part)
+            elif part[0] == str(big):
+                out.seek(part[2], os.SEEK_CUR)
+            else:
+                out.write(contents({"path": part[0], "offset": part[1], "length": part[2], "header": b""}))
+    assert int(ConcatResponse(parts).headers["content-length"]) == os.path.getsize(path)
+
+    with zipfile.ZipFile(path) as zf:
+        first, second = zf.infolist()
+        assert first.file_size == first.compress_size == 5 * 1024 ** 3
+        assert second.header_offset > 0xFFFFFFFF
+        assert zf.read("chunk_002.mp3") == b"tail of the recording"
+        with zf.open("chunk_001.mp3") as stream:
+            assert stream.read(16) == b"\0" * 16
@@ -0,0 +1,220 @@
+import random
+import struct
+
+import pytest
+
+import audio
+
+CHUNK_SIZE = 20_000
+
+
+def mp3_stream(rng, frames, tag=b""):
+    """
+    MPEG-1 Layer III frames at 128kbps/44.1kHz after an optional ID3v2 tag
+
+    Returns:
+        (data, frame offsets)
+    """
+    data = bytearray()
+    if tag:
+        size = len(tag)
+        data += b"ID3\x03\x00\x00" + bytes([size >> 21 & 0x7F, size >> 14 & 0x7F, size >> 7 & 0x7F, size & 0x7F])
+        data += tag
+    offsets = []
+    for n in range(frames):
+        padding = n % 3 == 0
+        offsets.append(len(data))
+        data += bytes([0xFF, 0xFB, 0x90 | padding << 1, 0x44]) + rng.randbytes(417 + padding - 4)
+    return bytes(data), offsets
+
+
+def adts_stream(rng, frames):
+    data = bytearray()
+    offsets = []
+    for _ in range(frames):
+        length = rng.randint(200, 700)
+        offsets.append(len(data))
+        # AAC LC, 44.1kHz, stereo, no CRC
+        data += bytes([0xFF, 0xF1, 0x50, 0x80 | length >> 11 & 3, length >> 3 & 0xFF,
+                       (length & 7) << 5 | 0x1F, 0xFC]) + rng.randbytes(length - 7)
+    return bytes(data), offsets
+
+
+def ogg_page(granule, payload, serial=1, sequence=0):
+    lacing = [255] * (len(payload) // 255) + [len(payload) % 255]
+    return (b"OggS" + bytes([0, 0]) + struct.pack("<qIII", granule, serial, sequence, 0) +
+            bytes([len(lacing)]) + bytes(lacing) + payload)
+
+
+def ogg_stream(rng, pages):
+    """
+    Vorbis-like stream: identification and setup header pages, then audio
+
+    Returns:
+        (data, audio page offsets, length of the header pages)
+    """
+    identification = b"\x01vorbis" + struct.pack("<IBI", 0, 2, 44100) + rng.randbytes(15)
+    data = ogg_page(0, identification) + ogg_page(0, b"\x03vorbis" + rng.randbytes(3000), sequence=1)
+    header_end = len(data)
+    offsets = []
+    for n in range(pages):
+        offsets.append(len(data))
+        data += ogg_page(1024 * (n + 1), rng.randbytes(rng.randint(1000, 5000)), sequence=n + 2)
+    return data, offsets, header_end
+
+
+def wav_file(rng, data_size, block_align=4):
+    fmt = b"fmt " + struct.pack("<IHHIIHH", 16, 1, 2, 16000, 16000 * block_align, block_align, 16)
+    return b"RIFF" + struct.pack("<I", 4 + len(fmt) + 8 + data_size) + b"WAVE" + fmt + \
+        b"data" + struct.pack("<I", data_size) + rng.randbytes(data_size)
+
+
+@pytest.fixture
+def open_audio(tmp_path):
+    files = []
+
+    def open_audio(data):
+        path = tmp_path / f"audio{len(files)}"
+        path.write_bytes(data)
+        files.append(open(path, "rb"))
+        return files[-1].fileno()
+
+    yield open_audio
+    for f in files:
+        f.close()
+
+
+def assert_contiguous(ranges, start, end):
+    position = start
+    for offset, length, header in ranges:
+        assert offset == position
+        assert len(header) + length <= CHUNK_SIZE
+        position += length
+    assert position == end
+
+
+@pytest.mark.parametrize("make, fmt", [(mp3_stream, "mp3"), (adts_stream, "aac")])
+def test_frame_streams_are_cut_between_frames(open_audio, make, fmt):
+    data, offsets = make(random.Random(1), 300)
+    fd = open_audio(data)
+    assert audio.detect_format(fd, len(data)) == fmt
+
+    ranges = audio.plan_audio_ranges(fd, len(data), CHUNK_SIZE)
+    assert len(ranges) > 1
+    assert_contiguous(ranges, 0, len(data))
+    for offset, _, header in ranges[1:]:
+        assert offset in offsets
+        assert header == b""
+
+
+def test_adts_timeline(open_audio):
+    data, offsets = adts_stream(random.Random(2), 100)
+    stream = audio.AudioStream.open(open_audio(data), len(data), CHUNK_SIZE)
+    frame_offsets, times = stream.timeline()
+    assert list(frame_offsets) == offsets
+    assert times[1] == pytest.approx(1024 / 44100)
+
+
+def test_ogg_header_pages_are_repeated_in_each_chunk(open_audio):
+    data, offsets, header_end = ogg_stream(random.Random(3), 60)
+    fd = open_audio(data)
+    assert audio.detect_format(fd, len(data)) == "ogg"
+
+    ranges = audio.plan_audio_ranges(fd, len(data), CHUNK_SIZE)
+    assert len(ranges) > 1
+    assert_contiguous(ranges, 0, len(data))
+    assert ranges[0][2] == b""
+    for offset, _, header in ranges[1:]:
+        assert offset in offsets
+        assert header == data[:header_end]
+
+
+def test_ogg_timed_plan_uses_granule_positions(open_audio):
+    data, offsets, _ = ogg_stream(random.Random(4), 60)
+    ranges, spans = audio.plan_timed_ranges(open_audio(data), len(data), CHUNK_SIZE)
+    assert spans[0][0] == 0
+    assert spans[-1][1] == pytest.approx(60 * 1024 / 44100)
+    for (_, end), (start, _) in zip(spans, spans[1:]):
+        assert start == end
+
+
+def test_wav_chunks_get_their_own_riff_header(open_audio):
+    data = wav_file(random.Random(5), 70_002, block_align=4)
+    fd = open_audio(data)
+    assert audio.detect_format(fd, len(data)) == "wav"
+
+    ranges = audio.plan_audio_ranges(fd, len(data), CHUNK_SIZE)
+    assert len(ranges) > 1
+    assert_contiguous(ranges, 44, len(data))
+    samples = b""
+    for offset, length, header in ranges:
+        assert header[:4] == b"RIFF" and header[8:16] == b"WAVEfmt "
+        assert struct.unpack_from("<I", header, 4)[0] == len(header) + length - 8
+        assert header[36:40] == b"data"
+        assert struct.unpack_from("<I", header, 40)[0] == length
+        assert header[12:36] == data[12:36]
+        if offset + length < len(data):
+            assert length % 4 == 0
+        samples += data[offset:offset + length]
+    assert samples == data[44:]
+
+
+def test_false_sync_inside_id3_tag_is_not_a_cut(open_audio):
+    # Cover art made of bytes that look like a run of MP3 frames
+    fake_frame = bytes([0xFF, 0xFB, 0x90, 0x44]) + b"\x00" * 413
+    tag = b"APIC" + fake_frame * 30
+    data, offsets = mp3_stream(random.Random(6), 300, tag=tag)
+    fd = open_audio(data)
+    assert audio.detect_format(fd, len(data)) == "mp3"
+
+    ranges = audio.plan_audio_ranges(fd, len(data), CHUNK_SIZE)
+    assert ranges[0][0] + ranges[0][1] > offsets[0]
+    for offset, _, _ in ranges[1:]:
+        assert offset in offsets
+
+    frame_offsets, _ = audio.AudioStream.open(fd, len(data), CHUNK_SIZE).timeline()
+    assert list(frame_offsets) == offsets
+
+
+def vbr_mp3_stream(rng, frames, xing=False):
+    # MPEG-1 Layer III at 44.1kHz whose bitrate changes every 50 frames, or
+    # at 128kbps throughout behind a Xing header frame
+    data = bytearray()
+    for n in range(frames):
+        bitrate_index = 9 if xing else (5, 9, 11, 14)[n // 50 % 4]
+        length = 144 * audio._MP3_BITRATES[(3, 1)][bitrate_index] * 1000 // 44100
+        body = rng.randbytes(length - 4)
+        if xing and n == 0:
+            body = body[:32] + b"Xing" + body[36:]
+        data += bytes([0xFF, 0xFB, bitrate_index << 4, 0x44]) + body
+    return bytes(data)
+
+
+@pytest.mark.parametrize("make", [
+    lambda rng: mp3_stream(rng, 2000)[0],
+    lambda rng: wav_file(rng, 300_000),
+])
+def test_estimated_times_follow_the_bitrate(open_audio, make):
+    data = make(random.Random(7))
+    fd = open_audio(data)
+    ranges, spans = audio.plan_estimated_ranges(fd, len(data), CHUNK_SIZE * 5)
+    assert ranges == audio.plan_audio_ranges(fd, len(data), CHUNK_SIZE * 5)
+    _, exact = audio.plan_timed_ranges(fd, len(data), CHUNK_SIZE * 5)
+    assert len(spans) == len(exact) > 1
+    duration = exact[-1][1]
+    for (start, end), (exact_start, exact_end) in zip(spans, exact):
+        assert start == pytest.approx(exact_start, abs=duration * 0.05)
+        assert end == pytest.approx(exact_end, abs=duration * 0.05)
+
+
+@pytest.mark.parametrize("make", [
+    lambda rng: vbr_mp3_stream(rng, 2000),
+    lambda rng: vbr_mp3_stream(rng, 2000, xing=True),
+    lambda rng: adts_stream(rng, 2000)[0],
+    lambda rng: ogg_stream(rng, 300)[0],
+])
+def test_variable_bitrate_times_are_not_estimated(open_audio, make):
+    data = make(random.Random(7))
+    fd = open_audio(data)
+    assert audio.plan_estimated_ranges(fd, len(data), CHUNK_SIZE * 5) is None
+    assert audio.plan_timed_ranges(fd, len(data), CHUNK_SIZE * 5) is not None
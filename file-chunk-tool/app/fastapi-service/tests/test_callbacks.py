@@ -0,0 +1,100 @@
+import socket
+
+import pytest
+
+import callbacks
+
+
+@pytest.fixture
+def resolve(monkeypatch):
+    addresses = {}
+
+    def getaddrinfo(host, port, *args, **kwargs):
+        if host not in addresses:
+            raise socket.gaierror(host)
+        return [(socket.AF_INET6 if ":" in address else socket.AF_INET, socket.SOCK_STREAM, 6, "",
+                 (address, port)) for address in addresses[host]]
+
+    monkeypatch.setattr(callbacks.socket, "getaddrinfo", getaddrinfo)
+    monkeypatch.setattr(callbacks, "CALLBACK_ALLOWED_HOSTS", set())
+    return addresses
+
+
+@pytest.mark.parametrize("address", [
+    "127.0.0.1", "10.1.2.3", "172.16.0.1", "192.168.1.1", "169.254.169.254", "100.64.0.1",
+    "0.0.0.0", "224.0.0.1", "::1", "fe80::1", "fd00::1", "::ffff:127.0.0.1",
+])
+def test_internal_addresses_are_rejected(resolve, address):
+    resolve["hooks.example.com"] = [address]
+    assert not callbacks.valid_callback_url("https://hooks.example.com/done")
+
+
+def test_public_host_is_accepted(resolve):
+    resolve["hooks.example.com"] = ["93.184.216.34", "2606:2800:220:1::1"]
+    assert callbacks.valid_callback_url("https://hooks.example.com/done")
+
+
+def test_any_internal_address_rejects_the_host(resolve):
+    resolve["hooks.example.com"] = ["93.184.216.34", "10.0.0.5"]
+    assert not callbacks.valid_callback_url("http://hooks.example.com/done")
+
+
+@pytest.mark.parametrize("url", [
+    "ftp://hooks.example.com/done", "hooks.example.com/done", "http:///done", "http://unknown.example/done",
+    "http://hooks.example.com:99999/done",
+])
+def test_malformed_or_unresolvable_urls_are_rejected(resolve, url):
+    resolve["hooks.example.com"] = ["93.184.216.34"]
+    assert not callbacks.valid_callback_url(url)
+
+
+def test_allowlist_replaces_the_address_check(resolve, monkeypatch):
+    monkeypatch.setattr(callbacks, "CALLBACK_ALLOWED_HOSTS", {"n8n.internal"})
+    assert callbacks.valid_callback_url("http://n8n.internal:5678/webhook")
+    assert not callbacks.valid_callback_url("https://hooks.example.com/done")
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+def test_retry_after_is_capped(resolve, monkeypatch):
+    resolve["hooks.example.com"] = ["93.184.216.34"]
+    responses = [FakeResponse(429, {"retry-after": "86400"}), FakeResponse(200)]
+    sleeps = []
+    monkeypatch.setattr(callbacks.requests, "post", lambda *args, **kwargs: responses.pop(0))
+    monkeypatch.setattr(callbacks.time, "sleep", sleeps.append)
+
+    report = callbacks.post_callback("https://hooks.example.com/done", {}, max_delay=5)
+    assert report["delivered"] and report["attempts"] == 2
+    assert sleeps == [5]
+
+
+def test_delivery_gives_up_at_max_time(resolve, monkeypatch):
+    resolve["hooks.example.com"] = ["93.184.216.34"]
+    clock = [0.0]
+    monkeypatch.setattr(callbacks.time, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(callbacks.time, "sleep", lambda seconds: clock.__setitem__(0, clock[0] + seconds))
+    monkeypatch.setattr(callbacks.requests, "post",
+                        lambda *args, **kwargs: FakeResponse(503, {"retry-after": "40"}))
+
+    report = callbacks.post_callback("https://hooks.example.com/done", {}, retries=10, max_time=100)
+    assert not report["delivered"]
+    assert report["attempts"] == 3
+    assert clock[0] == 80
+
+
+def test_redirects_are_not_followed(resolve, monkeypatch):
+    resolve["hooks.example.com"] = ["93.184.216.34"]
+    calls = []
+
+    def post(url, **kwargs):
+        calls.append(kwargs)
+        return FakeResponse(302, {"location": "http://169.254.169.254/"})
+
+    monkeypatch.setattr(callbacks.requests, "post", post)
+    report = callbacks.post_callback("https://hooks.example.com/done", {})
+    assert not report["delivered"] and report["status_code"] == 302
+    assert len(calls) == 1 and calls[0]["allow_redirects"] is False
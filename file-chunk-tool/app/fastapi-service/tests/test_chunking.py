@@ -0,0 +1,38 @@
+import os
+
+import pytest
+
+import chunking
+
+
+def chunk_files(chunks):
+    return [(chunk["chunk_number"], chunk["chunk_filename"], chunk["chunk_size"],
+             open(chunk["chunk_path"], "rb").read()) for chunk in chunks]
+
+
+@pytest.mark.parametrize("size, ranges", [
+    (10000, None),
+    (10000, [(0, 4000, b""), (3500, 4000, b"HDR"), (7000, 3000, b"HDR")]),  # overlap and headers
+    (10000, [(100, 2000, b""), (5000, 2000, b""), (9000, 0, b"")]),  # gaps and an empty range
+    (10000, [(0, 6000, b""), (6000, 9000, b""), (12000, 10, b"HDR")]),  # past the end of the source
+    (0, None),
+])
+def test_single_pass_matches_kernel_copies(tmp_path, monkeypatch, size, ranges):
+    # Small blocks, so ranges start and end inside and across blocks
+    monkeypatch.setattr(chunking, "COPY_BUFFER_SIZE", 777)
+    data = os.urandom(size)
+    source_path = tmp_path / "upload.mp3"
+    source_path.write_bytes(data)
+    (tmp_path / "copied").mkdir()
+    (tmp_path / "single").mkdir()
+
+    progress = []
+    with open(source_path, "rb") as source:
+        copied = chunking.split_file(source, str(tmp_path / "copied"), "a.mp3", size, 3000, ranges)
+        single = chunking.split_file(source, str(tmp_path / "single"), "a.mp3", size, 3000, ranges,
+                                     on_chunk=lambda chunk, done, total: progress.append((done, total)),
+                                     original_path=str(tmp_path / "original.mp3"))
+
+    assert (tmp_path / "original.mp3").read_bytes() == data
+    assert chunk_files(single) == chunk_files(copied)
+    assert progress == [(n, len(copied)) for n in range(1, len(copied) + 1)]
@@ -0,0 +1,59 @@
+import io
+import os
+import bz2
+import gzip
+import lzma
+import tarfile
+
+import pytest
+
+import containers
+
+
+def tar_bytes():
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w", format=tarfile.GNU_FORMAT) as archive:
+        data = os.urandom(3000)
+        info = tarfile.TarInfo("rec/a.mp3")
+        info.size = len(data)
+        archive.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def detect(tmp_path):
+    def detect(data):
+        path = tmp_path / "upload.bin"
+        path.write_bytes(data)
+        with open(path, "rb") as f:
+            f.seek(7)
+            kind = containers.detect_container(f.fileno())
+            # Detection must not move the file position
+            assert f.tell() == 7
+        return kind
+    return detect
+
+
+@pytest.mark.parametrize("compress", [gzip.compress, bz2.compress, lzma.compress])
+def test_compressed_tar_is_recognised_by_content(detect, compress):
+    assert detect(compress(tar_bytes())) == "tar"
+
+
+@pytest.mark.parametrize("data", [
+    gzip.compress(os.urandom(5000)),
+    bz2.compress(b"not a tar" * 1000),
+    lzma.compress(b"x"),
+    gzip.compress(tar_bytes())[:20],
+    b"BZh9" + os.urandom(100),
+])
+def test_other_compressed_files_are_not_containers(detect, data):
+    assert detect(data) is None
+
+
+def test_plain_tar_and_zip(detect):
+    assert detect(tarfile.BLOCKSIZE * b"\0") is None
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w", format=tarfile.PAX_FORMAT) as archive:
+        archive.addfile(tarfile.TarInfo("empty.mp3"))
+    assert detect(buffer.getvalue()) == "tar"
+    assert detect(b"PK\x03\x04" + os.urandom(100)) == "zip"
@@ -0,0 +1,41 @@
+import os
+import hashlib
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+
+@pytest.fixture
+def client():
+    return TestClient(main.app)
+
+
+def test_unchunked_upload_is_chunk_one(client):
+    data = os.urandom(5000)
+    record = client.post("/upload?dedup=false", files={"file": ("short.mp3", data)}).json()
+    assert record["chunked"] is False
+    file_id = record["file_id"]
+
+    response = client.get(f"/chunks/{file_id}/1")
+    assert response.status_code == 200
+    assert response.content == data
+    assert response.headers["etag"] == f'"{hashlib.sha256(data).hexdigest()}"'
+    assert "short.mp3" in response.headers["content-disposition"]
+
+    partial = client.get(f"/chunks/{file_id}/1", headers={"Range": "bytes=100-199"})
+    assert partial.status_code == 206 and partial.content == data[100:200]
+    assert client.get(f"/chunks/{file_id}/1", headers={"If-None-Match": response.headers["etag"]}).status_code == 304
+    assert client.get(f"/chunks/{file_id}/2").status_code == 404
+
+
+def test_chunked_upload_keeps_its_numbering(client, monkeypatch):
+    monkeypatch.setattr(main, "MAX_CHUNK_SIZE", 1000)
+    data = os.urandom(3500)
+    record = client.post("/upload?dedup=false", files={"file": ("long.mp3", data)}).json()
+    assert record["num_chunks"] == 4
+    file_id = record["file_id"]
+
+    assert b"".join(client.get(f"/chunks/{file_id}/{n}").content for n in range(1, 5)) == data
+    assert client.get(f"/chunks/{file_id}/5").status_code == 404
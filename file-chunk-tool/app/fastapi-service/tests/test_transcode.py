@@ -0,0 +1,33 @@
+import pytest
+
+import transcode
+
+
+def test_failed_segmenting_leaves_no_files(tmp_path, monkeypatch):
+    def run_segment(src_fd, dst_path, start, end, profile, container):
+        with open(dst_path, "wb") as f:
+            f.write(b"\0" * 100)
+        if start >= 20:
+            raise RuntimeError(f"ffmpeg failed on segment {start:.3f}-{end:.3f}s: broken frame")
+        return 0.1
+
+    monkeypatch.setattr(transcode, "segment_format", lambda src_fd, filename, profile: ("mp3", filename))
+    monkeypatch.setattr(transcode, "_run_segment", run_segment)
+    segments = [(0, 10), (10, 20), (20, 30), (30, 40)]
+    with pytest.raises(RuntimeError, match="broken frame"):
+        transcode.segment_file(0, str(tmp_path), "talk.mp3", segments, 1000, workers=2)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_segments_are_numbered_in_time_order(tmp_path, monkeypatch):
+    def run_segment(src_fd, dst_path, start, end, profile, container):
+        with open(dst_path, "wb") as f:
+            f.write(b"\0" * int(end - start) * 100)
+        return 0.1
+
+    monkeypatch.setattr(transcode, "segment_format", lambda src_fd, filename, profile: ("mp3", filename))
+    monkeypatch.setattr(transcode, "_run_segment", run_segment)
+    # 12s comes out too large and is redone as two halves
+    chunks = transcode.segment_file(0, str(tmp_path), "talk.mp3", [(0, 8), (8, 20)], 1000, workers=2)
+    assert [(chunk["start_time"], chunk["end_time"]) for chunk in chunks] == [(0, 8), (8, 14), (14, 20)]
+    assert sorted(path.name for path in tmp_path.iterdir()) == [chunk["chunk_filename"] for chunk in chunks]
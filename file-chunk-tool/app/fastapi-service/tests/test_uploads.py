@@ -0,0 +1,48 @@
+import io
+import os
+import zipfile
+
+import pytest
+from fastapi.testclient import TestClient
+
+import containers
+import main
+
+
+@pytest.fixture
+def client():
+    return TestClient(main.app)
+
+
+def zip_of(files):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for name, data in files.items():
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+def test_archive_error_is_kept_when_nothing_was_staged(client, monkeypatch):
+    # The member fails before its staged file exists; cleaning up must not
+    # replace the archive error with FileNotFoundError
+    def copy_member(stream, dst_path, limit):
+        raise containers.ArchiveError("Bad CRC-32")
+
+    monkeypatch.setattr(containers, "copy_member", copy_member)
+    response = client.post("/upload?dedup=false", files={"file": ("rec.zip", zip_of({"a.mp3": os.urandom(100)}))})
+    assert response.status_code == 422
+    assert response.json()["detail"] == "Could not read the archive: Bad CRC-32"
+
+
+def test_identical_files_in_a_batch_share_one_entry(client):
+    data, other = os.urandom(3000), os.urandom(3000)
+    earlier = client.post("/upload?dedup=true", files={"file": ("a.mp3", data)}).json()
+
+    batch = client.post("/upload/batch?dedup=true", files=[
+        ("files", ("a.mp3", data)), ("files", ("copy of a.mp3", data)), ("files", ("b.mp3", other)),
+    ]).json()
+    assert batch["file_ids"][0] == earlier["file_id"]
+    assert batch["num_files"] == len(batch["file_ids"]) == len(batch["files"]) == 2
+    assert batch["deduplicated"] == 1
+    assert set(batch["file_ids"]) == set(batch["files"])
+    assert batch["files"][earlier["file_id"]]["deduplicated"] is True
@@ -0,0 +1,44 @@
+import json
+import uuid
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main_vercel
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(main_vercel, "file_storage", main_vercel.create_storage("local", str(tmp_path)))
+    return TestClient(main_vercel.app)
+
+
+def test_missing_file_is_404(client):
+    response = client.get(f"/chunks/{uuid.uuid4()}")
+    assert response.status_code == 404
+
+
+def test_stored_metadata_is_returned(client):
+    file_id = str(uuid.uuid4())
+    main_vercel.file_storage.put(f"metadata/{file_id}.json", json.dumps({"num_chunks": 2}).encode())
+    response = client.get(f"/chunks/{file_id}")
+    assert response.status_code == 200 and response.json() == {"num_chunks": 2}
+
+
+def test_backend_failure_is_not_reported_as_missing(client, monkeypatch):
+    storage_get = main_vercel.file_storage.get
+    down = [True]
+
+    def get(path):
+        if down[0]:
+            raise ConnectionError("storage unreachable")
+        return storage_get(path)
+
+    monkeypatch.setattr(main_vercel.file_storage, "get", get)
+    file_id = str(uuid.uuid4())
+    response = client.get(f"/chunks/{file_id}")
+    assert response.status_code == 502
+
+    # The failure was not cached
+    down[0] = False
+    assert client.get(f"/chunks/{file_id}").status_code == 404
@@ -0,0 +1,339 @@
+import os
+import json
+import math
+import time
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Any, List, Optional, Tuple
+
+from chunking import chunk_filename
+
+# Number of ffmpeg processes run at once by the parallel segmenter
+SEGMENT_WORKERS = int(os.environ.get("SEGMENT_WORKERS", os.cpu_count() or 1))
+
+# Plan segments to fill this fraction of the chunk size, leaving room for bitrate variation
+SEGMENT_FILL = 0.9
+
+# Speech-friendly output formats: mono 16kHz is all Whisper uses anyway,
+# so an hour of speech fits well under 25MB in either profile
+TRANSCODE_PROFILES: Dict[str, Dict[str, Any]] = {
+    "opus16k": {
+        "extension": ".ogg",
+        "format": "ogg",
+        "args": ["-ac", "1", "-ar", "16000", "-c:a", "libopus", "-b:a", "24k", "-application", "voip"],
+        "bitrate": 24000,
+    },
+    "mp3_16k": {
+        "extension": ".mp3",
+        "format": "mp3",
+        "args": ["-ac", "1", "-ar", "16000", "-c:a", "libmp3lame", "-b:a", "32k"],
+        "bitrate": 32000,
+    },
+}
+
+
+def transcode_available() -> bool:
+    """
+    Whether ffmpeg is installed, which transcoding needs
+    """
+    return shutil.which("ffmpeg") is not None
+
+
+def segmenting_available() -> bool:
+    """
+    Whether ffmpeg and ffprobe are installed, which the segmenter needs
+    """
+    return transcode_available() and shutil.which("ffprobe") is not None
+
+
+def transcoded_filename(filename: str, profile: str) -> str:
+    """
+    Name of the transcoded file, e.g. meeting.wav -> meeting.ogg
+    """
+    return os.path.splitext(filename)[0] + TRANSCODE_PROFILES[profile]["extension"]
+
+
+def transcode_file(src_fd: int, dst_path: str, profile: str):
+    """
+    Downmix and re-encode the audio behind src_fd into dst_path
+
+    Video and other non-audio streams are dropped.
+
+    Raises:
+        RuntimeError: if ffmpeg fails
+    """
+    args = TRANSCODE_PROFILES[profile]["args"]
+    result = subprocess.run(
+        ["ffmpeg", "-v", "error", "-nostdin", "-y", "-i", f"/dev/fd/{src_fd}", "-vn", "-sn", "-dn",
+         *args, dst_path],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, pass_fds=(src_fd,),
+    )
+    if result.returncode != 0:
+        if os.path.exists(dst_path):
+            os.remove(dst_path)
+        raise RuntimeError(f"ffmpeg failed to transcode: {result.stderr.decode(errors='replace').strip()}")
+
+
+def probe_duration(src_fd: int) -> Optional[float]:
+    """
+    Duration in seconds of the media behind src_fd according to its container
+    """
+    result = subprocess.run(
+        ["ffprobe", "-v", "error", "-show_entries", "format=duration",
+         "-of", "default=noprint_wrappers=1:nokey=1", f"/dev/fd/{src_fd}"],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, pass_fds=(src_fd,),
+    )
+    try:
+        duration = float(result.stdout.strip())
+    except ValueError:
+        return None
+    return duration if duration > 0 else None
+
+
+# Container to stream-copy each audio codec into when demuxing a video,
+# preferring ones the frame splitter can cut (ADTS, MP3, Ogg, WAV)
+DEMUX_FORMATS: Dict[str, Tuple[str, str]] = {
+    "aac": ("adts", ".aac"),
+    "mp3": ("mp3", ".mp3"),
+    "opus": ("ogg", ".ogg"),
+    "vorbis": ("ogg", ".ogg"),
+    "flac": ("flac", ".flac"),
+    "pcm_s16le": ("wav", ".wav"),
+}
+
+
+def probe_streams(src_fd: int) -> Optional[List[Dict[str, Any]]]:
+    """
+    Streams of the media behind src_fd (index, codec_type, codec_name and
+    whether a video stream is just cover art), or None if ffprobe cannot
+    read it
+    """
+    result = subprocess.run(
+        ["ffprobe", "-v", "error", "-show_entries",
+         "stream=index,codec_type,codec_name:stream_disposition=attached_pic",
+         "-of", "json", f"/dev/fd/{src_fd}"],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, pass_fds=(src_fd,),
+    )
+    if result.returncode != 0:
+        return None
+    try:
+        streams = json.loads(result.stdout).get("streams", [])
+    except ValueError:
+        return None
+    return [{
+        "index": stream["index"],
+        "codec_type": stream.get("codec_type"),
+        "codec_name": stream.get("codec_name"),
+        "attached_pic": bool(stream.get("disposition", {}).get("attached_pic"))
+    } for stream in streams]
+
+
+def demuxed_extension(codec: Optional[str]) -> str:
+    """
+    Extension of the file extract_audio writes for an audio codec
+    """
+    return DEMUX_FORMATS.get(codec, ("matroska", ".mka"))[1]
+
+
+def extract_audio(src_fd: int, dst_path: str, stream_index: int, codec: Optional[str]):
+    """
+    Copy one audio stream out of a video into dst_path without re-encoding
+
+    Raises:
+        RuntimeError: if ffmpeg fails
+    """
+    container = DEMUX_FORMATS.get(codec, ("matroska", ".mka"))[0]
+    result = subprocess.run(
+        ["ffmpeg", "-v", "error", "-nostdin", "-y", "-i", f"/dev/fd/{src_fd}",
+         "-map", f"0:{stream_index}", "-vn", "-sn", "-dn", "-c:a", "copy", "-f", container, dst_path],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, pass_fds=(src_fd,),
+    )
+    if result.returncode != 0:
+        if os.path.exists(dst_path):
+            os.remove(dst_path)
+        raise RuntimeError(f"ffmpeg failed to extract audio stream {stream_index}: "
+                           f"{result.stderr.decode(errors='replace').strip()}")
+
+
+def plan_segments(duration: float, file_size: int, chunk_size: int, profile: Optional[str] = None,
+                  max_duration: Optional[float] = None, overlap: float = 0) -> List[Tuple[float, float]]:
+    """
+    Split [0, duration) into equal time ranges expected to fit in chunk_size
+    and last at most max_duration seconds
+
+    The output size is estimated from the profile bitrate, or from the
+    average bitrate of the input for a stream copy. Every range but the
+    first starts overlap seconds early, so it repeats the end of the one
+    before.
+
+    Returns:
+        List of (start, end) times in seconds
+    """
+    if profile:
+        expected_size = duration * TRANSCODE_PROFILES[profile]["bitrate"] / 8
+    else:
+        expected_size = file_size
+    # Longest segment expected to fit, minus the overlap it repeats
+    # (but never less than half of it, so the plan keeps moving)
+    seconds = chunk_size * SEGMENT_FILL / (expected_size / duration)
+    if max_duration:
+        seconds = min(seconds, max_duration)
+    count = max(1, math.ceil(duration / max(seconds - overlap, seconds / 2)))
+    step = duration / count
+    return [(max(0.0, i * step - overlap) if i else 0.0, duration if i == count - 1 else (i + 1) * step)
+            for i in range(count)]
+
+
+# Container for stream-copied segments, by the extension of the upload
+SEGMENT_FORMATS: Dict[str, str] = {
+    ".mp3": "mp3",
+    ".aac": "adts",
+    ".m4a": "ipod",
+    ".m4b": "ipod",
+    ".mp4": "mp4",
+    ".mov": "mov",
+    ".ogg": "ogg",
+    ".oga": "ogg",
+    ".opus": "ogg",
+    ".wav": "wav",
+    ".flac": "flac",
+    ".webm": "webm",
+    ".mka": "matroska",
+    ".mkv": "matroska",
+}
+
+
+def segment_format(src_fd: int, filename: str, profile: Optional[str] = None) -> Tuple[str, str]:
+    """
+    Container to write segments in, and the name to build their chunk
+    filenames from
+
+    Transcoded segments use the profile's container. Stream-copied ones
+    keep the container named by the extension, or for a missing or
+    unknown extension get the one extract_audio would use for the audio
+    codec, with its extension appended to the name.
+    """
+    if profile:
+        return TRANSCODE_PROFILES[profile]["format"], filename
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in SEGMENT_FORMATS:
+        return SEGMENT_FORMATS[extension], filename
+    streams = probe_streams(src_fd) or []
+    codec = next((stream["codec_name"] for stream in streams if stream["codec_type"] == "audio"), None)
+    container, extension = DEMUX_FORMATS.get(codec, ("matroska", ".mka"))
+    return container, filename + extension
+
+
+def _run_segment(src_fd: int, dst_path: str, start: float, end: float,
+                 profile: Optional[str], container: str) -> float:
+    """
+    Cut [start, end) of the audio into dst_path; returns the time it took
+    """
+    codec_args = TRANSCODE_PROFILES[profile]["args"] if profile else ["-c:a", "copy"]
+    began = time.monotonic()
+    result = subprocess.run(
+        ["ffmpeg", "-v", "error", "-nostdin", "-y", "-ss", f"{start:.3f}", "-t", f"{end - start:.3f}",
+         "-i", f"/dev/fd/{src_fd}", "-map", "0:a:0", *codec_args, "-f", container, dst_path],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, pass_fds=(src_fd,),
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed on segment {start:.3f}-{end:.3f}s: "
+                           f"{result.stderr.decode(errors='replace').strip()}")
+    return time.monotonic() - began
+
+
+def segment_file(src_fd: int, chunk_dir: str, filename: str, segments: List[Tuple[float, float]],
+                 chunk_size: int, profile: Optional[str] = None, workers: int = SEGMENT_WORKERS,
+                 on_chunk: Optional[Callable[[Dict[str, Any], int, int], None]] = None,
+                 overlap: float = 0) -> List[Dict[str, Any]]:
+    """
+    Cut the audio into time segments with ffmpeg, running up to workers
+    ffmpeg processes at once
+
+    Each segment is stream-copied, or re-encoded with the given transcode
+    profile, into its own chunk file (see segment_format). Segments that
+    still come out larger than chunk_size are halved and redone, the
+    second half again starting overlap seconds early.
+
+    Args:
+        src_fd: File descriptor of the source media
+        chunk_dir: Directory to write the chunk files to
+        filename: Name the chunk filenames are built from
+        segments: (start, end) times from plan_segments
+        chunk_size: Maximum size of a chunk file
+        profile: Transcode profile, or None to copy the audio stream as is
+        workers: Number of concurrent ffmpeg processes
+        on_chunk: Called as on_chunk(segment_info, segments_done,
+            num_segments) as each segment is finished; num_segments grows
+            if segments have to be redone as halves
+        overlap: Overlap of the segments in seconds, as given to plan_segments
+
+    Returns:
+        Chunk information dicts in time order, including each segment's
+        start_time/end_time and how long ffmpeg took for it
+        (segment_seconds)
+
+    Raises:
+        RuntimeError: if ffmpeg fails on a segment, or a segment of a
+            second or less is still larger than chunk_size
+    """
+    container, filename = segment_format(src_fd, filename, profile)
+    done: Dict[Tuple[float, float], Dict[str, Any]] = {}
+    pending = list(segments)
+    written = []
+    pool = ThreadPoolExecutor(max_workers=max(1, workers))
+    try:
+        while pending:
+            jobs = []
+            for start, end in pending:
+                path = os.path.join(chunk_dir, f"segment_{start:.3f}_{filename}")
+                job = pool.submit(_run_segment, src_fd, path, start, end, profile, container)
+                jobs.append((start, end, path, job))
+                written.append(path)
+            pending = []
+            for i, (start, end, path, job) in enumerate(jobs):
+                elapsed = job.result()
+                size = os.path.getsize(path)
+                if size > chunk_size:
+                    os.remove(path)
+                    if end - start <= 1:
+                        raise RuntimeError(f"Segment {start:.3f}-{end:.3f}s is {size} bytes, "
+                                           f"more than the chunk size of {chunk_size} bytes")
+                    # Bitrate was higher than estimated here; redo as two halves,
+                    # overlapping like the planned segments (by at most half a half)
+                    middle = (start + end) / 2
+                    pending += [(start, middle), (middle - min(overlap, (middle - start) / 2), end)]
+                    continue
+                done[(start, end)] = {"path": path, "size": size, "elapsed": elapsed}
+                if on_chunk is not None:
+                    total = len(done) + len(jobs) - i - 1 + len(pending)
+                    on_chunk({"start_time": round(start, 3), "end_time": round(end, 3), "chunk_size": size},
+                             len(done), total)
+    except BaseException:
+        # Skip the segments not started yet, wait for the running ffmpeg
+        # processes, and remove every segment file written so far
+        pool.shutdown(cancel_futures=True)
+        for path in written:
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    pool.shutdown()
+
+    # Number the segments in time order and give them the usual chunk names
+    chunks_info = []
+    ordered = sorted(done.items())
+    for i, ((start, end), segment) in enumerate(ordered):
+        name = chunk_filename(i + 1, len(ordered), filename)
+        path = os.path.join(chunk_dir, name)
+        os.replace(segment["path"], path)
+        chunks_info.append({
+            "chunk_number": i + 1,
+            "chunk_filename": name,
+            "chunk_path": path,
+            "chunk_size": segment["size"],
+            "start_time": round(start, 3),
+            "end_time": round(end, 3),
+            "segment_seconds": round(segment["elapsed"], 3)
+        })
+    return chunks_info
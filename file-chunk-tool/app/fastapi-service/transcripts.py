@@ -0,0 +1,131 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from typing import Any, Dict, Optional
+
+# Transcripts are cached by chunk content and ASR parameters, so a chunk
+# seen before (in any upload) is never sent to the backend again. The
+# cache is trimmed to TRANSCRIPT_CACHE_MAX_BYTES, least recently used
+# first; 0 disables it
+TRANSCRIPT_CACHE_DB = os.environ.get("TRANSCRIPT_CACHE_DB", os.path.join("metadata", "transcripts.db"))
+TRANSCRIPT_CACHE_MAX_BYTES = int(os.environ.get("TRANSCRIPT_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+
+def transcript_key(content_sha256: str, **params) -> str:
+    """
+    Cache key of a chunk's transcript
+
+    Every parameter that changes the transcript (backend, model, language,
+    prompt) is part of the key.
+    """
+    settings = ",".join(f"{name}={params[name]}" for name in sorted(params) if params[name] is not None)
+    return f"sha256:{content_sha256}:{settings}"
+
+
+class TranscriptCache:
+    """
+    Persistent, size-bounded transcript cache in SQLite
+
+    Shared between threads and worker processes the same way as
+    SQLiteMetadataStore. Hit, miss and eviction counters are kept in the
+    database too, so they cover every worker and survive restarts.
+    """
+
+    def __init__(self, path: str = TRANSCRIPT_CACHE_DB, max_bytes: int = TRANSCRIPT_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        with self._connect() as db:
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS transcripts (
+                    key TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    last_used REAL NOT NULL,
+                    result TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS transcripts_last_used ON transcripts (last_used);
+                CREATE TABLE IF NOT EXISTS counters (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                );
+            """)
+
+    def _connect(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("PRAGMA busy_timeout=30000")
+            self._local.db = db
+        return db
+
+    @staticmethod
+    def _count(db: sqlite3.Connection, name: str, amount: int = 1):
+        db.execute(
+            "INSERT INTO counters (name, value) VALUES (?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET value = value + excluded.value",
+            (name, amount),
+        )
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+        Cached transcript for key, or None; counts a hit or a miss
+        """
+        with self._connect() as db:
+            row = db.execute("SELECT result FROM transcripts WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self._count(db, "misses")
+                return None
+            db.execute("UPDATE transcripts SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._count(db, "hits")
+        return json.loads(row[0])
+
+    def put(self, key: str, result: Dict[str, Any]):
+        """
+        Store a transcript, then evict the least recently used ones while
+        the cache is over max_bytes
+        """
+        data = json.dumps(result)
+        with self._connect() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO transcripts (key, size, last_used, result) VALUES (?, ?, ?, ?)",
+                (key, len(data), time.time(), data),
+            )
+            total = db.execute("SELECT COALESCE(SUM(size), 0) FROM transcripts").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            evicted = []
+            for old_key, size in db.execute("SELECT key, size FROM transcripts ORDER BY last_used"):
+                if total <= self.max_bytes:
+                    break
+                evicted.append((old_key,))
+                total -= size
+            db.executemany("DELETE FROM transcripts WHERE key = ?", evicted)
+            self._count(db, "evictions", len(evicted))
+
+    def stats(self) -> Dict[str, int]:
+        db = self._connect()
+        entries, size = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM transcripts").fetchone()
+        counters = dict(db.execute("SELECT name, value FROM counters").fetchall())
+        return {
+            "entries": entries,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+            "hits": counters.get("hits", 0),
+            "misses": counters.get("misses", 0),
+            "evictions": counters.get("evictions", 0)
+        }
+
+
+def create_transcript_cache(path: str = TRANSCRIPT_CACHE_DB,
+                            max_bytes: int = TRANSCRIPT_CACHE_MAX_BYTES) -> Optional[TranscriptCache]:
+    """
+    Build the transcript cache, or None if TRANSCRIPT_CACHE_MAX_BYTES is 0
+    """
+    return TranscriptCache(path, max_bytes) if max_bytes > 0 else None